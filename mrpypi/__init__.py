@@ -28,3 +28,15 @@ from .memory_index \
 
 from .mongo_index \
     import MongoIndex
+
+from .sqlite_index \
+    import SQLiteIndex
+
+from .cluster \
+    import ClusterPeers
+
+from .disk_cache \
+    import DiskCache
+
+from .prefetch \
+    import DependencyPrefetcher
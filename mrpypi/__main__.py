@@ -21,11 +21,24 @@
 #
 
 from argparse import ArgumentParser
-from wsgiref.simple_server import make_server
+import os
+import sys
+from wsgiref.simple_server import WSGIServer, make_server
 
-from . import MrPyPi, MemoryIndex, MongoIndex
+from chisel import Context
+
+from . import ClusterPeers, DependencyPrefetcher, DiskCache, MrPyPi, MemoryIndex, MongoIndex, SQLiteIndex
+from .archive import export_archive, import_archive
+from .compat import socketserver_ThreadingMixIn, urllib_request_Request, urllib_request_urlopen
 from .index_util import DEFAULT_PIP_INDEX
 from .mongo_index import DEFAULT_MONGO_URI
+from .profiler import RequestProfiler
+from .static_mirror import export_static_mirror
+from .upstream import UpstreamAdmission, configure_upstream_admission
+
+
+class ThreadingWSGIServer(socketserver_ThreadingMixIn, WSGIServer):
+    daemon_threads = True
 
 
 def main():
@@ -38,25 +51,163 @@ def main():
                         help='upstream pypi index URL (default is "{0}")'.format(DEFAULT_PIP_INDEX))
     parser.add_argument('--no-index', dest='index_url', action='store_const', const=None,
                         help='disable upstream pypi index')
+    parser.add_argument('--upstream-concurrency', dest='upstream_concurrency', type=int, default=32, metavar='N',
+                        help='maximum concurrent upstream index refreshes and downloads (default is 32)')
+    parser.add_argument('--upstream-queue', dest='upstream_queue', type=int, default=64, metavar='N',
+                        help='maximum requests waiting for upstream - overflow is served stale data or 503 (default is 64)')
+    parser.add_argument('--upstream-deadline', dest='upstream_deadline', type=float, default=5.0, metavar='SECONDS',
+                        help='maximum wait for upstream - overdue requests are served stale data or 503 (default is 5)')
     parser.add_argument('--mongo', dest='mongo', action='store_true',
                         help='use MongoDB index')
     parser.add_argument('--mongo-uri', dest='mongo_uri', type=str, default=DEFAULT_MONGO_URI, metavar='URI',
                         help='MongoDB URI (default is "{0}")'.format(DEFAULT_MONGO_URI))
+    parser.add_argument('--mongo-quota', dest='mongo_quota', type=int, metavar='BYTES',
+                        help='MongoDB storage quota - upstream package files are evicted when exceeded')
+    parser.add_argument('--mongo-eviction', dest='mongo_eviction', choices=MongoIndex.EVICTION_POLICIES, default='access',
+                        help='MongoDB storage quota eviction policy (default is "access")')
+    parser.add_argument('--sqlite', dest='sqlite_path', metavar='FILE',
+                        help='use a SQLite index database, shared by processes on the host (package files are stored in FILE-blobs)')
+    parser.add_argument('--disk-cache', dest='disk_cache', metavar='DIR',
+                        help='cache MongoDB package files in this local directory')
+    parser.add_argument('--disk-cache-quota', dest='disk_cache_quota', type=int, metavar='BYTES',
+                        help='local disk cache quota - the least-recently used files are evicted when exceeded')
+    parser.add_argument('--accel-redirect', dest='accel_redirect', metavar='URI',
+                        help='serve disk cached files with an nginx X-Accel-Redirect to this internal location URI prefix')
+    parser.add_argument('--sendfile', dest='sendfile', action='store_true',
+                        help='serve disk cached files with an X-Sendfile header')
+    parser.add_argument('--export', dest='export_path', metavar='FILE',
+                        help='export the index and package files to an archive file, then exit')
+    parser.add_argument('--import', dest='import_source', metavar='SOURCE',
+                        help='import an index archive file ("-" for stdin) or URL (a node\'s "/export") before serving - '
+                        'an interrupted import is resumed by importing again')
+    parser.add_argument('--export-token', dest='export_token', metavar='TOKEN',
+                        help='serve index archives at "/export" to requests with an X-MrPyPi-Export-Token header of TOKEN - '
+                        'the header is also sent when importing from a URL')
+    parser.add_argument('--static-mirror', dest='static_mirror', metavar='PATH',
+                        help='export the index as a static mirror tree, linked to by PATH, then exit - only changed packages '
+                        'are rewritten and the link is replaced atomically')
+    parser.add_argument('--static-mirror-stored', dest='static_mirror_stored', action='store_true',
+                        help='only mirror the package files stored by the index - don\'t download upstream package files')
+    parser.add_argument('--gc', dest='gc', action='store_true',
+                        help='garbage collect the MongoDB index and storage, then exit')
+    parser.add_argument('--cluster-node', dest='cluster_node', metavar='URL',
+                        help="this node's URL, as seen by its cluster peers")
+    parser.add_argument('--cluster-peer', dest='cluster_peers', action='append', default=[], metavar='URL',
+                        help='cluster peer node URL - package files are downloaded from their owner peer before upstream')
+    parser.add_argument('--prefetch', dest='prefetch', action='store_true',
+                        help='prefetch the dependencies of downloaded packages in the background')
+    parser.add_argument('--prefetch-depth', dest='prefetch_depth', type=int, default=1, metavar='N',
+                        help='dependency levels to prefetch (default is 1)')
+    parser.add_argument('--prefetch-workers', dest='prefetch_workers', type=int, default=2, metavar='N',
+                        help='concurrent dependency prefetches (default is 2)')
+    parser.add_argument('--profile-dir', dest='profile_dir', metavar='DIR',
+                        default=os.environ.get(RequestProfiler.ENV_PROFILE_DIR),
+                        help='write per-request cProfile profiles to this directory (default is $MRPYPI_PROFILE_DIR)')
+    parser.add_argument('--profile-rate', dest='profile_rate', type=float, metavar='RATE',
+                        default=float(os.environ.get(RequestProfiler.ENV_SAMPLE_RATE, '0')),
+                        help='fraction of requests to profile (default is $MRPYPI_PROFILE_RATE or 0)')
+    parser.add_argument('--profile-token', dest='profile_token', metavar='TOKEN',
+                        default=os.environ.get(RequestProfiler.ENV_TOKEN),
+                        help='profile requests with an "X-MrPyPi-Profile: TOKEN" header (default is $MRPYPI_PROFILE_TOKEN)')
     args = parser.parse_args()
+    if args.sqlite_path and args.mongo:
+        parser.error('--sqlite and --mongo are mutually exclusive')
+    if args.static_mirror_stored and not args.static_mirror:
+        parser.error('--static-mirror-stored requires --static-mirror')
+    if args.gc and not args.mongo:
+        parser.error('--gc requires --mongo')
+    if args.disk_cache and not args.mongo:
+        parser.error('--disk-cache requires --mongo')
+    if (args.accel_redirect or args.sendfile or args.disk_cache_quota) and not args.disk_cache:
+        parser.error('--disk-cache-quota, --accel-redirect and --sendfile require --disk-cache')
+    if args.cluster_peers and not args.cluster_node:
+        parser.error('--cluster-peer requires --cluster-node')
+    if args.cluster_peers and args.mongo:
+        parser.error('--cluster-peer is not supported with --mongo - Mongo nodes share their package files')
+    if args.cluster_peers and args.sqlite_path:
+        parser.error('--cluster-peer is not supported with --sqlite')
+
+    # Upstream admission control
+    configure_upstream_admission(UpstreamAdmission(max_concurrent=args.upstream_concurrency, max_queue=args.upstream_queue,
+                                                   deadline=args.upstream_deadline))
 
     # Create the index
     print('Upstream pypi index URL: {0}'.format(args.index_url))
     if args.mongo:
         print('Mongo index with URI: {0}'.format(args.mongo_uri))
-        index = MongoIndex(index_url=args.index_url, mongo_uri=args.mongo_uri)
+        disk_cache = None
+        if args.disk_cache:
+            print('Caching package files in: {0}'.format(args.disk_cache))
+            disk_cache = DiskCache(args.disk_cache, max_bytes=args.disk_cache_quota, accel_redirect=args.accel_redirect,
+                                   sendfile=args.sendfile)
+        index = MongoIndex(index_url=args.index_url, mongo_uri=args.mongo_uri,
+                           max_storage_bytes=args.mongo_quota, eviction_policy=args.mongo_eviction, disk_cache=disk_cache)
+    elif args.sqlite_path:
+        print('SQLite index database: {0}'.format(args.sqlite_path))
+        index = SQLiteIndex(args.sqlite_path, index_url=args.index_url)
     else:
         print('Using memory index')
-        index = MemoryIndex(index_url=args.index_url)
+        cluster = None
+        if args.cluster_peers:
+            print('Cluster node {0} with peers: {1}'.format(args.cluster_node, ', '.join(args.cluster_peers)))
+            cluster = ClusterPeers(args.cluster_node, args.cluster_peers)
+        index = MemoryIndex(index_url=args.index_url, cluster=cluster)
+
+    # Create the application
+    profiler = None
+    if args.profile_dir:
+        print('Writing request profiles to: {0}'.format(args.profile_dir))
+        profiler = RequestProfiler(args.profile_dir, sample_rate=args.profile_rate, token=args.profile_token)
+    prefetcher = None
+    if args.prefetch:
+        print('Prefetching dependencies to depth {0} with {1} workers'.format(args.prefetch_depth, args.prefetch_workers))
+        prefetcher = DependencyPrefetcher(index, workers=args.prefetch_workers, max_depth=args.prefetch_depth)
+    application = MrPyPi(index, profiler=profiler, prefetcher=prefetcher, export_token=args.export_token)
+
+    # Import an index archive?
+    if args.import_source:
+        print('Importing index archive: {0}'.format(args.import_source))
+        if args.import_source == '-':
+            archive_file = getattr(sys.stdin, 'buffer', sys.stdin)
+        elif '://' in args.import_source:
+            headers = {'X-MrPyPi-Export-Token': args.export_token} if args.export_token is not None else {}
+            archive_file = urllib_request_urlopen(urllib_request_Request(args.import_source, headers=headers))
+        else:
+            archive_file = open(args.import_source, 'rb')
+        try:
+            counts = import_archive(Context(application, {'wsgi.errors': sys.stderr}, None, {}), index, archive_file)
+        finally:
+            archive_file.close()
+        print('Imported {entries} index entries and {files} package files; skipped {skipped} existing entries and '
+              '{invalid} invalid package files'.format(**counts))
+
+    # Export an index archive?
+    if args.export_path:
+        print('Exporting index archive: {0}'.format(args.export_path))
+        with open(args.export_path, 'wb') as archive_file:
+            for data in export_archive(Context(application, {'wsgi.errors': sys.stderr}, None, {}), index):
+                archive_file.write(data)
+        return
+
+    # Export a static mirror?
+    if args.static_mirror:
+        print('Exporting static mirror: {0}'.format(args.static_mirror))
+        counts = export_static_mirror(Context(application, {'wsgi.errors': sys.stderr}, None, {}), index, args.static_mirror,
+                                      download_upstream=not args.static_mirror_stored)
+        print('Exported {packages} packages ({updated} updated, {unchanged} unchanged); wrote {files} package files, '
+              '{missing} missing'.format(**counts))
+        return
+
+    # Garbage collect?
+    if args.gc:
+        result = index.gc(Context(application, {'wsgi.errors': sys.stderr}, None, {}))
+        print('Deleted {files} orphaned files, {chunks} orphaned chunks, {entries} orphaned index entries; '
+              'evicted {evicted} files'.format(**result))
+        return
 
     # Start the application
-    application = MrPyPi(index)
     print('Serving on port {0}...'.format(args.port))
-    make_server('', args.port, application).serve_forever()
+    make_server('', args.port, application, server_class=ThreadingWSGIServer).serve_forever()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,134 @@
+#
+# Copyright (C) 2014-2015 Craig Hobbs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+from datetime import datetime
+import json
+import tarfile
+import time
+
+from .index_util import IndexEntry
+
+
+# Tar block size - member content is padded to a multiple of the block size
+ARCHIVE_BLOCK_SIZE = 512
+
+# Member content read chunk size
+ARCHIVE_CHUNK_SIZE = 65536
+
+# Index entry member name suffix - the entry's package file content, if any, is the next member
+ARCHIVE_ENTRY_SUFFIX = '.json'
+
+
+def export_archive(ctx, index):
+    """
+    Generate the chunks of an index archive - a sequential (uncompressed) tar stream of each index entry, as a JSON
+    member, followed by its package file content member, if the index has the content. Package file content is read
+    and written in chunks, so the archive is streamed in constant memory.
+    """
+
+    for index_entry, content_file, content_size in index.export_packages(ctx):
+        member_name = '/'.join((index_entry.name, index_entry.version, index_entry.filename))
+        entry_json = json.dumps(_entry_json(index_entry, content_size), sort_keys=True).encode('utf-8')
+        yield _member_header(member_name + ARCHIVE_ENTRY_SUFFIX, len(entry_json))
+        yield entry_json
+        yield _member_padding(len(entry_json))
+        if content_file is not None:
+            yield _member_header(member_name, content_size)
+            remaining = content_size
+            while remaining > 0:
+                data = content_file.read(min(ARCHIVE_CHUNK_SIZE, remaining))
+                if not data:
+                    raise IOError('Package file "{0}" is shorter than {1} bytes'.format(member_name, content_size))
+                remaining -= len(data)
+                yield data
+            yield _member_padding(content_size)
+
+    # End-of-archive marker
+    yield b'\0' * (2 * ARCHIVE_BLOCK_SIZE)
+
+
+def import_archive(ctx, index, archive_file, batch_size=100):
+    """
+    Import an index archive, read sequentially from a file object, into the index. The index writes in batches of
+    batch_size entries and skips the entries and package files it already has, so an interrupted import is resumed by
+    importing the archive again. Returns the index's import counts.
+    """
+
+    with tarfile.open(fileobj=archive_file, mode='r|') as archive:
+        return index.import_packages(ctx, _archive_packages(archive), batch_size=batch_size)
+
+
+def _archive_packages(archive):
+
+    # Generate (index_entry, content_file) tuples - content_file must be read before the next tuple is generated
+    index_entry = None
+    for member in archive:
+        if member.name.endswith(ARCHIVE_ENTRY_SUFFIX):
+            if index_entry is not None:
+                yield index_entry, None
+            entry_json = json.loads(archive.extractfile(member).read().decode('utf-8'))
+            index_entry = _json_entry(entry_json)
+            if entry_json.get('size') is None:
+                yield index_entry, None
+                index_entry = None
+        elif index_entry is not None:
+            yield index_entry, archive.extractfile(member)
+            index_entry = None
+    if index_entry is not None:
+        yield index_entry, None
+
+
+def _member_header(name, size):
+    tar_info = tarfile.TarInfo(name)
+    tar_info.size = size
+    tar_info.mtime = int(time.time())
+    tar_info.mode = 0o644
+    return tar_info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape' if str is not bytes else 'strict')
+
+
+def _member_padding(size):
+    return b'\0' * (-size % ARCHIVE_BLOCK_SIZE)
+
+
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _entry_json(index_entry, content_size):
+    entry_json = index_entry._asdict()
+    if index_entry.datetime is not None:
+        entry_json['datetime'] = index_entry.datetime.strftime(_DATETIME_FORMAT)
+    entry_json['size'] = content_size
+    return entry_json
+
+
+def _json_entry(entry_json):
+    entry_datetime = entry_json.get('datetime')
+    return IndexEntry(name=entry_json['name'],
+                      version=entry_json['version'],
+                      filename=entry_json['filename'],
+                      hash=entry_json.get('hash'),
+                      hash_name=entry_json.get('hash_name'),
+                      url=entry_json.get('url'),
+                      datetime=datetime.strptime(entry_datetime, _DATETIME_FORMAT) if entry_datetime is not None else None,
+                      sha256=entry_json.get('sha256'),
+                      md5=entry_json.get('md5'),
+                      size=entry_json.get('size'))
@@ -0,0 +1,126 @@
+#
+# Copyright (C) 2014-2015 Craig Hobbs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import bisect
+
+from .compat import hashlib_new, urllib_parse_quote
+from .index_util import PackageDigest
+from .upstream import UpstreamSession, UpstreamUnavailable
+
+
+def _ring_hash(value):
+    return int(hashlib_new('md5', value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring of node names. Each node is placed at many points (replicas) around the ring so keys are spread
+    evenly - adding or removing a node moves only the keys of the points it gains or loses.
+    """
+
+    __slots__ = ('nodes', '_points', '_point_nodes')
+
+    DEFAULT_REPLICAS = 128
+
+    def __init__(self, nodes, replicas=DEFAULT_REPLICAS):
+        self.nodes = tuple(sorted(set(nodes)))
+        points = sorted((_ring_hash('{0}#{1}'.format(node, replica)), node) for node in self.nodes for replica in range(replicas))
+        self._points = [point for point, dummy_node in points]
+        self._point_nodes = [node for dummy_point, node in points]
+
+    def node(self, key):
+        """
+        Return the node owning the key - the node of the first point at or after the key's hash
+        """
+
+        if not self._points:
+            return None
+        return self._point_nodes[bisect.bisect_left(self._points, _ring_hash(key)) % len(self._points)]
+
+
+class ClusterPeers(object):
+    """
+    Cluster of mrpypi nodes sharing their package file caches. Each package file (name, version, filename) is owned by
+    one node of a consistent hash ring, and the other nodes download the file from its owner rather than from upstream,
+    so the cluster downloads each file from upstream once. Requests between peers are marked with the peer header and
+    are never forwarded again, preventing request loops between nodes with inconsistent peer lists.
+    """
+
+    __slots__ = ('node_url', 'ring', 'session')
+
+    # Request header (X-MrPyPi-Peer) marking package file requests from a peer
+    PEER_HEADER = 'X-MrPyPi-Peer'
+    PEER_HEADER_ENVIRON = 'HTTP_X_MRPYPI_PEER'
+
+    def __init__(self, node_url, peer_urls, replicas=HashRing.DEFAULT_REPLICAS, session=None):
+        self.node_url = node_url.rstrip('/')
+        self.ring = HashRing([self.node_url] + [peer_url.rstrip('/') for peer_url in peer_urls], replicas=replicas)
+
+        # Peers fail fast - an unavailable peer falls back to upstream rather than delaying the download
+        self.session = session if session is not None else \
+            UpstreamSession(connect_timeout=1.0, retries=0, failure_threshold=3, reset_timeout=10.0)
+
+    def owner(self, package_name, version, filename):
+        return self.ring.node('/'.join((package_name, version, filename)))
+
+    def peer_package_content(self, ctx, index_entry):
+        """
+        Download a package file from its owner peer and return the (content, digest) tuple. Returns None if this node
+        owns the file, the request is from a peer, or the owner can't provide verified content.
+        """
+
+        # Peer requests are never forwarded
+        if ctx.environ.get(self.PEER_HEADER_ENVIRON):
+            return None
+        owner = self.owner(index_entry.name, index_entry.version, index_entry.filename)
+        if owner == self.node_url:
+            return None
+
+        # Download the package file from the owner - the owner downloads it from upstream, if necessary
+        from pip._vendor import requests
+        url = '{0}/download/{1}/{2}/{3}'.format(owner, urllib_parse_quote(index_entry.name), urllib_parse_quote(index_entry.version),
+                                                urllib_parse_quote(index_entry.filename))
+        ctx.log.info('Downloading package "%s", version "%s" with filename "%s" from peer "%s"',
+                     index_entry.name, index_entry.version, index_entry.filename, owner)
+        digest = PackageDigest.for_index_entry(index_entry)
+        chunks = []
+        try:
+            response = self.session.get(url, stream=True, headers={self.PEER_HEADER: self.node_url})
+            try:
+                response.raise_for_status()
+                for data in response.iter_content(PEER_CHUNK_SIZE):
+                    digest.update(data)
+                    chunks.append(data)
+            finally:
+                response.close()
+        except (requests.RequestException, UpstreamUnavailable) as exc:
+            ctx.log.warning('Peer download from "%s" failed: %s', owner, exc)
+            return None
+
+        # Verify the peer's content
+        if not digest.verify(index_entry):
+            ctx.log.warning('Peer download from "%s" failed: hash mismatch for filename "%s"', owner, index_entry.filename)
+            return None
+        return b''.join(chunks), digest
+
+
+PEER_CHUNK_SIZE = 65536
@@ -26,20 +26,50 @@ PY3 = (sys.version_info >= (3, 0))
 
 # dict
 if PY3:
+    def iteritems(dict_):
+        return iter(dict_.items())
     def itervalues(dict_):
         return iter(dict_.values())
 else: # pragma: no cover
+    def iteritems(dict_):
+        return dict_.iteritems()
     def itervalues(dict_):
         return dict_.itervalues()
 
 # hashlib
+from hashlib import new as hashlib_new # pylint: disable=unused-import
+
+# urllib
+if PY3:
+    from urllib.parse import quote as urllib_parse_quote, urlsplit as urllib_parse_urlsplit # pylint: disable=unused-import
+else: # pragma: no cover
+    from urllib import quote as urllib_parse_quote # pylint: disable=import-error,no-name-in-module
+    from urlparse import urlsplit as urllib_parse_urlsplit # pylint: disable=import-error
 if PY3:
-    from hashlib import md5 as hashlib_md5_new # pylint: disable=unused-import
+    from urllib.request import Request as urllib_request_Request, urlopen as urllib_request_urlopen # pylint: disable=unused-import
 else: # pragma: no cover
-    from md5 import new as hashlib_md5_new # pylint: disable=import-error,unused-import
+    from urllib2 import Request as urllib_request_Request, urlopen as urllib_request_urlopen # pylint: disable=import-error
 
-# urllib
+# socketserver
+if PY3:
+    from socketserver import ThreadingMixIn as socketserver_ThreadingMixIn # pylint: disable=unused-import
+else: # pragma: no cover
+    from SocketServer import ThreadingMixIn as socketserver_ThreadingMixIn # pylint: disable=import-error
+
+# queue
+if PY3:
+    from queue import Full as queue_Full, Queue as queue_Queue # pylint: disable=unused-import
+else: # pragma: no cover
+    from Queue import Full as queue_Full, Queue as queue_Queue # pylint: disable=import-error
+
+# http
+if PY3:
+    from http.client import HTTPConnection as http_client_HTTPConnection # pylint: disable=unused-import
+else: # pragma: no cover
+    from httplib import HTTPConnection as http_client_HTTPConnection # pylint: disable=import-error
 if PY3:
-    from urllib.request import urlopen as urllib_request_urlopen # pylint: disable=unused-import
+    from http.server import BaseHTTPRequestHandler as http_server_BaseHTTPRequestHandler, \
+        HTTPServer as http_server_HTTPServer # pylint: disable=unused-import
 else: # pragma: no cover
-    from urllib2 import urlopen as urllib_request_urlopen # pylint: disable=import-error
+    from BaseHTTPServer import BaseHTTPRequestHandler as http_server_BaseHTTPRequestHandler, \
+        HTTPServer as http_server_HTTPServer # pylint: disable=import-error
@@ -0,0 +1,186 @@
+#
+# Copyright (C) 2014-2015 Craig Hobbs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+from collections import namedtuple
+import os
+import tempfile
+import threading
+
+from .compat import hashlib_new
+from .index_util import background_context
+
+
+# A package file in the local disk cache - offload_header is the response header (and offload_value its value) that
+# hands the file to the front-end server, or None if the file is served by the application
+CachedFile = namedtuple('CachedFile', (
+    'path',
+    'size',
+    'offload_header',
+    'offload_value'
+))
+
+
+class DiskCache(object):
+    """
+    Local disk read-through cache of package files. Files are written to a temporary file as they're streamed and
+    renamed into place once complete, so readers only see complete files. When the cache exceeds its quota the
+    least-recently used files are evicted in the background.
+
+    Cached files can be served by the front-end server - an nginx "X-Accel-Redirect" header with the internal location
+    URI prefix that aliases the cache directory, or an "X-Sendfile" header with the file path.
+    """
+
+    __slots__ = ('cache_dir', 'max_bytes', 'accel_redirect', 'sendfile', '_size', '_size_lock', '_evicting')
+
+    TEMP_PREFIX = '.tmp-'
+
+    def __init__(self, cache_dir, max_bytes=None, accel_redirect=None, sendfile=False):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.accel_redirect = accel_redirect
+        self.sendfile = sendfile
+        self._size = None
+        self._size_lock = threading.Lock()
+        self._evicting = False
+
+    def _relpath(self, key):
+        key_hash = hashlib_new('sha256', key.encode('utf-8')).hexdigest()
+        return key_hash[:2] + '/' + key_hash
+
+    def get(self, key):
+        """
+        Return the CachedFile of the key - None if the key isn't cached
+        """
+
+        relpath = self._relpath(key)
+        path = os.path.join(self.cache_dir, *relpath.split('/'))
+        try:
+            size = os.stat(path).st_size
+            os.utime(path, None)
+        except OSError:
+            return None
+        if self.accel_redirect is not None:
+            return CachedFile(path, size, 'X-Accel-Redirect', self.accel_redirect.rstrip('/') + '/' + relpath)
+        if self.sendfile:
+            return CachedFile(path, size, 'X-Sendfile', path)
+        return CachedFile(path, size, None, None)
+
+    def writer(self, key):
+        """
+        Return a writer that adds the key's file to the cache once committed
+        """
+
+        return DiskCacheWriter(self, os.path.join(self.cache_dir, *self._relpath(key).split('/')))
+
+    def _add_size(self, ctx, size):
+
+        # Keep a running cache size and start a background eviction when it exceeds the quota
+        if self.max_bytes is None:
+            return
+        with self._size_lock:
+            if self._size is not None:
+                self._size += size
+                if self._size <= self.max_bytes:
+                    return
+            if self._evicting:
+                return
+            self._evicting = True
+        thread = threading.Thread(target=self._evict_background, args=(background_context(ctx),))
+        thread.daemon = True
+        thread.start()
+
+    def _evict_background(self, ctx):
+        try:
+            self._evict(ctx)
+        except Exception as exc: # pylint: disable=broad-except
+            ctx.log.error('Disk cache eviction failed: %s', exc)
+        finally:
+            with self._size_lock:
+                self._evicting = False
+
+    def _evict(self, ctx):
+
+        # Scan the cache, least-recently used first
+        cache_files = []
+        for dirpath, dummy_dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.startswith(self.TEMP_PREFIX):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    cache_files.append((stat.st_mtime, stat.st_size, path))
+        cache_files.sort()
+
+        # Evict until under quota - resync the running size with the scanned size
+        size = sum(file_size for dummy_mtime, file_size, dummy_path in cache_files)
+        evicted = 0
+        for dummy_mtime, file_size, path in cache_files:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= file_size
+            evicted += 1
+        with self._size_lock:
+            self._size = size
+        if evicted:
+            ctx.log.info('Evicted %d files from the disk cache', evicted)
+
+
+class DiskCacheWriter(object):
+    """
+    Writes a cache file to a temporary file - commit() moves it into place and abort() discards it
+    """
+
+    __slots__ = ('_disk_cache', '_path', '_file', '_temp_path', '_size')
+
+    def __init__(self, disk_cache, path):
+        self._disk_cache = disk_cache
+        self._path = path
+        self._size = 0
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+        file_descriptor, self._temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=DiskCache.TEMP_PREFIX)
+        self._file = os.fdopen(file_descriptor, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+        self._size += len(data)
+
+    def commit(self, ctx):
+        self._file.close()
+        os.rename(self._temp_path, self._path)
+        self._disk_cache._add_size(ctx, self._size) # pylint: disable=protected-access
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._temp_path)
+        except OSError:
+            pass
@@ -21,13 +21,23 @@
 #
 
 from collections import namedtuple
+from functools import partial
+from multiprocessing.pool import ThreadPool
+import os
+import posixpath
+import re
+import sys
+import tempfile
+import threading
 
-from pip.cmdoptions import index_url
-from pip.download import PipSession
-from pip.index import FormatControl, PackageFinder
+from chisel import Context
 
+from .compat import hashlib_new, itervalues, urllib_parse_quote
+from .upstream import UpstreamUnavailable, upstream_admission, upstream_session
 
-DEFAULT_PIP_INDEX = index_url.keywords['default']
+
+# pip's default index URL - pip is imported on first use, not to find its default
+DEFAULT_PIP_INDEX = 'https://pypi.python.org/simple'
 
 
 IndexEntry = namedtuple('IndexEntry', (
@@ -37,20 +47,525 @@ IndexEntry = namedtuple('IndexEntry', (
     'hash',
     'hash_name',
     'url',
-    'datetime'
+    'datetime',
+    'sha256',
+    'md5',
+    'size'
 ))
 
 
+# The digests computed for every package file as its content is read or written
+PACKAGE_HASH_NAMES = ('sha256', 'md5')
+
+UPSTREAM_CHUNK_SIZE = 65536
+
+# Upstream package files at least this large are downloaded in concurrent byte range segments, if upstream supports them
+UPSTREAM_RANGED_MIN_SIZE = 32 * 1024 * 1024
+UPSTREAM_RANGED_SEGMENTS = 4
+
+# Worker threads of the process-wide pool that runs bulk upstream operations
+UPSTREAM_PARALLELISM = 8
+
+
 PipPackage = namedtuple('PipPackageVersion', (
     'version',
     'link'
 ))
 
 
-def pip_package_versions(index, package):
-    format_control = FormatControl(no_binary=(':all:'), only_binary=())
-    session = PipSession()
-    finder = PackageFinder([], [index], format_control=format_control, session=session,
-                           allow_external=[package], allow_unverified=[package])
-    return sorted((PipPackage(str(pv.version), pv.location) for pv in finder._find_all_versions(package)), # pylint: disable=protected-access
-                  key=lambda pp: (pp.version, {'.tar.gz': 1, '.zip': 2, '.tar.bz2': 3}.get(pp.link.ext, 10000)))
+# The upstream cache validators of a package's index page
+UpstreamValidators = namedtuple('UpstreamValidators', (
+    'etag',
+    'last_modified'
+))
+
+
+def _mirror_package_finder(*args, **kwargs):
+
+    # The finder class is defined on first use so pip is only imported when the upstream index is searched
+    global _MIRROR_PACKAGE_FINDER # pylint: disable=global-statement
+    if _MIRROR_PACKAGE_FINDER is None:
+        from pip.index import InstallationCandidate, PackageFinder
+
+        class MirrorPackageFinder(PackageFinder):
+            """
+            Package finder that accepts wheels for every platform tag, not just the server's own
+            """
+
+            def _link_package_versions(self, link, search):
+                if link.egg_fragment or link.ext != WHEEL_EXT:
+                    return super(MirrorPackageFinder, self)._link_package_versions(link, search)
+                wheel_name_version = parse_wheel_filename(link.filename)
+                if wheel_name_version is None or canonical_package_name(wheel_name_version[0]) != canonical_package_name(search.canonical):
+                    return None
+                return InstallationCandidate(search.supplied, wheel_name_version[1], link)
+
+        _MIRROR_PACKAGE_FINDER = MirrorPackageFinder
+    return _MIRROR_PACKAGE_FINDER(*args, **kwargs)
+
+_MIRROR_PACKAGE_FINDER = None
+
+
+WHEEL_EXT = '.whl'
+
+
+def parse_wheel_filename(filename):
+    """
+    Return the (name, version) tuple of a wheel filename - None if the filename isn't a valid wheel filename. Escaped
+    name and version characters are unescaped as pip does.
+    """
+
+    match = _WHEEL_FILENAME_RE.match(filename)
+    if match is None:
+        return None
+    return match.group('name').replace('_', '-'), match.group('ver').replace('_', '-')
+
+_WHEEL_FILENAME_RE = re.compile(r'^(?P<name>.+?)-(?P<ver>\d.*?)(-(?P<build>\d.*?))?-(?P<pyver>.+?)-(?P<abi>.+?)-(?P<plat>.+?)\.whl$')
+
+
+def canonical_package_name(package_name):
+    """
+    Return the PEP 503 normalized package name - runs of "-", "_" and "." become "-"
+    """
+
+    return _CANONICAL_NAME_RE.sub('-', package_name).lower()
+
+_CANONICAL_NAME_RE = re.compile(r'[-_.]+')
+
+
+def package_filename_matches(filename, package_name, version):
+    """
+    Return True if a distribution filename is for the package name and version
+    """
+
+    # Wheel filenames are parsed - name and version are escaped
+    if filename.endswith(WHEEL_EXT):
+        wheel_name_version = parse_wheel_filename(filename)
+        if wheel_name_version is None:
+            return False
+        return canonical_package_name(wheel_name_version[0]) == canonical_package_name(package_name) and \
+            wheel_name_version[1] == version
+
+    # Source distribution filenames are "<name>-<version>.<ext>"
+    for ext in SDIST_EXTS:
+        if filename.endswith(ext):
+            stem = filename[:-len(ext)]
+            return stem.endswith('-' + version) and \
+                canonical_package_name(stem[:-len(version) - 1]) == canonical_package_name(package_name)
+    return False
+
+
+# Source distribution filename extensions, in preference order
+SDIST_EXTS = ('.tar.gz', '.zip', '.tar.bz2')
+
+
+def pip_package_versions(index, package, session=None):
+    return pip_package_versions_conditional(index, package, session=session)[0]
+
+
+def pip_package_versions_conditional(index, package, validators=None, session=None):
+    """
+    Find the upstream package versions - returns (pip_packages, validators). If the validators of the package's last
+    index page are given, the page is requested conditionally and pip_packages is None if it's not modified.
+    """
+
+    from pip.index import FormatControl
+    from pip.utils.logging import _log_state as pip_log_state
+
+    # pip's log indentation is thread-local and only initialized on the thread that imported pip
+    if not hasattr(pip_log_state, 'indentation'):
+        pip_log_state.indentation = 0
+
+    format_control = FormatControl(no_binary=set(), only_binary=set())
+    if session is None:
+        session = upstream_session()
+    page_session = _PackagePageSession(session, posixpath.join(index, urllib_parse_quote(package.lower())) + '/', validators)
+    finder = _mirror_package_finder([], [index], format_control=format_control, session=page_session,
+                                    allow_external=[package], allow_unverified=[package])
+    try:
+        with upstream_admission():
+            pip_versions = finder._find_all_versions(package) # pylint: disable=protected-access
+    except _PackagePageNotModified:
+        return None, validators
+    pip_packages = sorted((PipPackage(str(pv.version), pv.location) for pv in pip_versions),
+                          key=lambda pp: (pp.version, {'.tar.gz': 1, '.zip': 2, '.tar.bz2': 3, '.whl': 4}.get(pp.link.ext, 10000),
+                                          pp.link.filename))
+    return pip_packages, page_session.validators()
+
+
+class _PackagePageNotModified(Exception):
+    pass
+
+
+class _PackagePageSession(object):
+    """
+    Upstream session wrapper for the pip finder - the package's index page is requested once, conditionally if the
+    validators of the last page are given
+    """
+
+    __slots__ = ('session', 'url', 'validators_request', 'response')
+
+    def __init__(self, session, url, validators_request):
+        self.session = session
+        self.url = url
+        self.validators_request = validators_request
+        self.response = None
+
+    def validators(self):
+        if self.response is None or self.response.status_code != 200:
+            return None
+        etag = self.response.headers.get('ETag')
+        last_modified = self.response.headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            return None
+        return UpstreamValidators(etag=etag, last_modified=last_modified)
+
+    def get(self, url, **kwargs):
+        if url != self.url:
+            return self.session.get(url, **kwargs)
+        if self.response is None:
+            headers = dict(kwargs.pop('headers', None) or ())
+            if self.validators_request is not None:
+                if self.validators_request.etag is not None:
+                    headers['If-None-Match'] = self.validators_request.etag
+                if self.validators_request.last_modified is not None:
+                    headers['If-Modified-Since'] = self.validators_request.last_modified
+            response = self.session.get(url, headers=headers, **kwargs)
+            if response.status_code == 304:
+                response.close()
+                raise _PackagePageNotModified()
+            self.response = response
+        return self.response
+
+    def head(self, url, **kwargs):
+        return self.session.head(url, **kwargs)
+
+
+def parallel_map(function, items):
+    """
+    Call the function for each item on the process-wide pool of worker threads and return the (result, exception)
+    tuples in item order - exception is None if the call succeeded
+    """
+
+    items = list(items)
+    if len(items) <= 1:
+        return [_parallel_call(function, item) for item in items]
+    return _parallel_pool().map(partial(_parallel_call, function), items)
+
+
+def upstream_update_errors(package_names, results):
+    """
+    Return the dict of package name to UpstreamUnavailable exception of parallel_map package index updates - other
+    exceptions are re-raised
+    """
+
+    update_errors = {}
+    for package_name, (dummy_result, exc) in zip(package_names, results):
+        if exc is not None:
+            if not isinstance(exc, UpstreamUnavailable):
+                raise exc
+            update_errors[package_name] = exc
+    return update_errors
+
+
+def _parallel_call(function, item):
+    try:
+        return function(item), None
+    except Exception as exc: # pylint: disable=broad-except
+        return None, exc
+
+
+_PARALLEL_POOL = None
+_PARALLEL_POOL_PID = None
+_PARALLEL_POOL_LOCK = threading.Lock()
+
+
+def _parallel_pool():
+
+    # The pool is created on first use in each process - a forked process doesn't inherit the worker threads
+    global _PARALLEL_POOL, _PARALLEL_POOL_PID # pylint: disable=global-statement
+    if _PARALLEL_POOL is None or _PARALLEL_POOL_PID != os.getpid():
+        with _PARALLEL_POOL_LOCK:
+            if _PARALLEL_POOL is None or _PARALLEL_POOL_PID != os.getpid():
+                _PARALLEL_POOL = ThreadPool(UPSTREAM_PARALLELISM)
+                _PARALLEL_POOL_PID = os.getpid()
+    return _PARALLEL_POOL
+
+
+def background_context(ctx):
+    """
+    Return a context for background work started by a request - it logs to the process's stderr, since the request's
+    WSGI error stream isn't valid once the request completes
+    """
+
+    return Context(ctx.app, {'wsgi.errors': sys.stderr})
+
+
+def index_entry_hash(index_entry):
+    """
+    Return the (hash_name, hash) tuple advertised for an index entry, preferring SHA-256
+    """
+
+    if index_entry.sha256 is not None:
+        return 'sha256', index_entry.sha256
+    return index_entry.hash_name, index_entry.hash
+
+
+class PackageHashMismatch(Exception):
+    """
+    Raised when downloaded package content doesn't match its index entry's hash
+    """
+
+    __slots__ = ('index_entry',)
+
+    def __init__(self, index_entry):
+        Exception.__init__(self, 'Hash mismatch for package ({0}, {1}, {2}) from "{3}" (expected {4}={5})'.format(
+            index_entry.name, index_entry.version, index_entry.filename, index_entry.url, index_entry.hash_name, index_entry.hash))
+        self.index_entry = index_entry
+
+
+class PackageDigest(object):
+    """
+    Incremental package file digests, updated chunk-by-chunk as content flows through
+    """
+
+    __slots__ = ('_hashes', 'size')
+
+    def __init__(self, hash_names=PACKAGE_HASH_NAMES):
+        self._hashes = {hash_name: hashlib_new(hash_name) for hash_name in hash_names}
+        self.size = 0
+
+    @classmethod
+    def for_index_entry(cls, index_entry):
+        hash_names = set(PACKAGE_HASH_NAMES)
+        if index_entry.hash_name is not None:
+            hash_names.add(index_entry.hash_name)
+        return cls(hash_names)
+
+    def update(self, data):
+        for hash_ in itervalues(self._hashes):
+            hash_.update(data)
+        self.size += len(data)
+
+    def hexdigest(self, hash_name):
+        return self._hashes[hash_name].hexdigest()
+
+    def verify(self, index_entry):
+        if index_entry.hash is None:
+            return True
+        hash_ = self._hashes.get(index_entry.hash_name)
+        return hash_ is not None and hash_.hexdigest() == index_entry.hash
+
+    def index_entry(self, index_entry):
+        return index_entry._replace(sha256=self.hexdigest('sha256'), md5=self.hexdigest('md5'), size=self.size)
+
+
+def upstream_package_chunks(url, chunk_size=UPSTREAM_CHUNK_SIZE, session=None, ranged_min_size=UPSTREAM_RANGED_MIN_SIZE,
+                            ranged_segments=UPSTREAM_RANGED_SEGMENTS):
+    """
+    Start downloading an upstream package file and return an iterator of its content chunks. The upstream admission slot
+    is acquired and the upstream response started before returning, so overload and upstream errors are raised before a
+    client response starts. The content is read into temporary storage on background threads and the slot is released
+    once upstream is read, not when the (possibly slow) consumer finishes.
+    """
+
+    if session is None:
+        session = upstream_session()
+    admission = upstream_admission()
+    admission.acquire()
+    slots = 1
+    response = None
+    started = False
+    try:
+        response = session.get(url, stream=True)
+        response.raise_for_status()
+
+        # Large file from an upstream that supports byte ranges? If so, download its segments concurrently. Each segment
+        # takes its own admission slot - fewer segments are downloaded if slots aren't free.
+        size = _ranged_download_size(response, ranged_min_size)
+        if size is not None:
+            while slots < ranged_segments and admission.try_acquire():
+                slots += 1
+        if slots > 1:
+            segment_size = -(-size // slots)
+            segments = [(start, min(start + segment_size, size)) for start in range(0, size, segment_size)]
+            while slots > len(segments):
+                admission.release()
+                slots -= 1
+        else:
+            size = None
+            segments = [(0, None)]
+        download = _UpstreamDownload(session, response.url, chunk_size, size, segments, admission)
+        download.start(response)
+        started = True
+    finally:
+        if not started:
+            if response is not None:
+                response.close()
+            for dummy_slot in range(slots):
+                admission.release()
+    return download.chunks()
+
+
+def _ranged_download_size(response, ranged_min_size):
+    if response.status_code != 200 or response.headers.get('Accept-Ranges', '').lower() != 'bytes' or \
+       response.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+        return None
+    try:
+        size = int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+    return size if size >= ranged_min_size else None
+
+
+class _UpstreamDownload(object):
+    """
+    An upstream package file download in progress. The first segment is read from the initial response and the other
+    segments are requested concurrently. Each segment is written into temporary storage by its own thread, which holds an
+    admission slot, and the storage is streamed in order as content arrives. If upstream ignores the byte ranges, the
+    other segments are cancelled and the first segment's thread reads the entire file from the initial response.
+    """
+
+    __slots__ = ('session', 'url', 'chunk_size', 'size', 'segments', 'admission', '_storage', '_storage_lock', '_condition',
+                 '_progress', '_complete', '_errors', '_cancelled', '_pending', '_ranges_ignored')
+
+    def __init__(self, session, url, chunk_size, size, segments, admission):
+        self.session = session
+        self.url = url
+        self.chunk_size = chunk_size
+        self.size = size
+        self.segments = segments
+        self.admission = admission
+        self._storage = tempfile.TemporaryFile()
+        if len(segments) > 1:
+            try:
+                os.posix_fallocate(self._storage.fileno(), 0, size)
+            except (AttributeError, OSError):
+                self._storage.truncate(size)
+        self._storage_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._progress = [start for start, _ in segments]
+        self._complete = False
+        self._errors = []
+        self._cancelled = False
+        # The number of segment responses not yet received
+        self._pending = len(segments) - 1
+        self._ranges_ignored = False
+
+    def start(self, response):
+        threads = [threading.Thread(target=self._read_segment, args=(0, response))]
+        threads.extend(threading.Thread(target=self._fetch_segment, args=(ix_segment,)) for ix_segment in range(1, len(self.segments)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+    def _fetch_segment(self, ix_segment):
+        start, end = self.segments[ix_segment]
+        try:
+            response = self.session.get(self.url, stream=True, headers={'Range': 'bytes={0}-{1}'.format(start, end - 1)})
+        except Exception as exc: # pylint: disable=broad-except
+            self._error(exc)
+            self.admission.release()
+            return
+
+        # Upstream ignored the range and responded with the entire file? If so, fall back to the initial response.
+        with self._condition:
+            self._pending -= 1
+            if response.status_code == 200:
+                self._ranges_ignored = True
+            self._condition.notify_all()
+        if response.status_code == 200:
+            response.close()
+            self.admission.release()
+            return
+        self._read_segment(ix_segment, response)
+
+    def _wait_ranges_ignored(self):
+        # Wait for the other segments' responses - return True if upstream ignored their ranges
+        with self._condition:
+            while self._pending and not self._ranges_ignored and not self._errors:
+                self._condition.wait()
+            return self._ranges_ignored
+
+    def _read_segment(self, ix_segment, response):
+        start, end = self.segments[ix_segment]
+        try:
+            response.raise_for_status()
+            if ix_segment != 0 and \
+               not response.headers.get('Content-Range', '').startswith('bytes {0}-{1}/'.format(start, end - 1)):
+                raise IOError('Unexpected upstream content range "{0}"'.format(response.headers.get('Content-Range')))
+            offset = start
+            for data in response.iter_content(self.chunk_size):
+                if self._cancelled or (ix_segment != 0 and self._ranges_ignored):
+                    return
+
+                # The end of the first segment? If upstream ignored the ranges, read the entire file.
+                if ix_segment == 0 and end is not None and end < self.size and offset + len(data) >= end and \
+                   self._wait_ranges_ignored():
+                    end = self.size
+                if end is not None:
+                    data = data[:end - offset]
+                with self._storage_lock:
+                    self._storage.seek(offset)
+                    self._storage.write(data)
+                offset += len(data)
+                with self._condition:
+                    self._progress[ix_segment] = offset
+                    self._condition.notify_all()
+                if end is not None and offset >= end:
+                    break
+            if end is not None and offset < end:
+                raise IOError('Upstream download ended {0} bytes early'.format(end - offset))
+
+            # The end of a download of unknown size
+            if end is None:
+                with self._condition:
+                    self._complete = True
+                    self._condition.notify_all()
+        except Exception as exc: # pylint: disable=broad-except
+            self._error(exc)
+        finally:
+            response.close()
+            self.admission.release()
+
+    def _error(self, exc):
+        with self._condition:
+            self._errors.append(exc)
+            self._condition.notify_all()
+
+    def _available(self, offset):
+        # Return the end of the content available at offset and whether the download is complete
+        if self.size is None:
+            return self._progress[0], self._complete
+        if offset >= self.size:
+            return offset, True
+        ix_segment = next(ix for ix, (dummy_start, end) in enumerate(self.segments) if offset < end)
+        if self._ranges_ignored:
+            return max(self._progress[0], self._progress[ix_segment]), False
+        return self._progress[ix_segment], False
+
+    def chunks(self):
+        try:
+            offset = 0
+            while True:
+                with self._condition:
+                    while True:
+                        if self._errors:
+                            raise self._errors[0]
+                        available, complete = self._available(offset)
+                        if available > offset or complete:
+                            break
+                        self._condition.wait()
+                if available <= offset:
+                    break
+                while offset < available:
+                    with self._storage_lock:
+                        self._storage.seek(offset)
+                        data = self._storage.read(min(self.chunk_size, available - offset))
+                    offset += len(data)
+                    yield data
+        finally:
+            # Stop the segment downloads if the download fails or is closed early
+            self._cancelled = True
+            with self._storage_lock:
+                self._storage.close()
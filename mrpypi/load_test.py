@@ -0,0 +1,447 @@
+#
+# Copyright (C) 2014-2015 Craig Hobbs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import argparse
+import calendar
+from collections import namedtuple
+import json
+import re
+import sys
+import threading
+import time
+
+from .compat import http_client_HTTPConnection, http_server_BaseHTTPRequestHandler, http_server_HTTPServer, iteritems, \
+    socketserver_ThreadingMixIn, urllib_parse_quote, urllib_parse_urlsplit
+from .index_util import PackageDigest, canonical_package_name
+
+
+ReplayRequest = namedtuple('ReplayRequest', (
+    'time',
+    'method',
+    'path'
+))
+
+
+# Only requests without bodies can be replayed from an access log
+REPLAY_METHODS = ('GET', 'HEAD')
+
+
+def parse_request_log(lines):
+    """
+    Parse a request log - returns a list of ReplayRequest in time order. Each line is either an access log line in the
+    common/combined log format (as written by nginx, Apache or mrpypi's own server) or a JSON object with "time" (seconds),
+    "method" and "path" members. Unparsable lines and requests that can't be replayed are skipped.
+    """
+
+    requests = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            try:
+                request_json = json.loads(line)
+                request = ReplayRequest(float(request_json.get('time', 0)), request_json.get('method', 'GET').upper(), request_json['path'])
+            except (KeyError, TypeError, ValueError):
+                continue
+        else:
+            match = _ACCESS_LOG_RE.search(line)
+            if match is None:
+                continue
+            request_time = _parse_log_time(match.group('time'))
+            if request_time is None:
+                continue
+            request = ReplayRequest(request_time, match.group('method').upper(), match.group('path'))
+        if request.method in REPLAY_METHODS and request.path.startswith('/'):
+            requests.append(request)
+    requests.sort(key=lambda request: request.time)
+    return requests
+
+_ACCESS_LOG_RE = re.compile(r'\[(?P<time>[^\]]+)\] "(?P<method>[A-Za-z]+) (?P<path>\S+)[^"]*"')
+
+
+def _parse_log_time(log_time):
+
+    # "10/Oct/2000:13:55:36 -0700" (nginx and Apache) or "10/Oct/2000 13:55:36" (wsgiref)
+    offset_match = _LOG_TIME_OFFSET_RE.search(log_time)
+    if offset_match is not None:
+        log_time = log_time[:offset_match.start()]
+    for time_format in ('%d/%b/%Y:%H:%M:%S', '%d/%b/%Y %H:%M:%S'):
+        try:
+            seconds = calendar.timegm(time.strptime(log_time, time_format))
+            break
+        except ValueError:
+            pass
+    else:
+        return None
+    if offset_match is not None:
+        offset = int(offset_match.group('hours')) * 3600 + int(offset_match.group('minutes')) * 60
+        seconds -= offset if offset_match.group('sign') == '+' else -offset
+    return float(seconds)
+
+_LOG_TIME_OFFSET_RE = re.compile(r' (?P<sign>[+-])(?P<hours>\d{2})(?P<minutes>\d{2})$')
+
+
+def request_route(path):
+    """
+    Return the name of the mrpypi action that serves a request path
+    """
+
+    path = path.split('?', 1)[0].rstrip('/')
+    if path.startswith('/download/'):
+        return 'pypi_download'
+    elif path.startswith('/simple/'):
+        return 'pypi_index'
+    elif path == '/simple':
+        return 'pypi_root_index'
+    elif path == '/export':
+        return 'pypi_export'
+    return 'other'
+
+
+def application_sender(application):
+    """
+    Return a request function, send(method, path) -> (status_code, size), that calls the application directly
+    """
+
+    def send(method, path):
+        path_info, _, query_string = path.partition('?')
+        status, _, content = application.request(method, path_info, query_string=query_string)
+        return int(status.split(' ', 1)[0]), len(content)
+    return send
+
+
+def http_sender(url, timeout=60.0):
+    """
+    Return a request function, send(method, path) -> (status_code, size), that requests a running server - each
+    replay thread keeps its own connection alive
+    """
+
+    url_parts = urllib_parse_urlsplit(url)
+    local = threading.local()
+
+    def send(method, path):
+        connection = getattr(local, 'connection', None)
+        if connection is None:
+            connection = local.connection = http_client_HTTPConnection(url_parts.hostname, url_parts.port, timeout=timeout)
+        try:
+            connection.request(method, url_parts.path.rstrip('/') + path)
+            response = connection.getresponse()
+            size = 0
+            while True:
+                data = response.read(65536)
+                if not data:
+                    break
+                size += len(data)
+            return response.status, size
+        except Exception:
+            connection.close()
+            local.connection = None
+            raise
+    return send
+
+
+class LoadReport(object):
+    """
+    Per-route replay results - request counts, throughput, latency percentiles and error rates. Errors are failed
+    requests and server errors (5xx statuses).
+    """
+
+    __slots__ = ('elapsed', 'max_lag', '_results', '_lock')
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self):
+        self.elapsed = None
+        self.max_lag = 0.0
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def add(self, route, status, latency, size, lag=0.0):
+        with self._lock:
+            self._results.setdefault(route, []).append((status, latency, size))
+            self.max_lag = max(self.max_lag, lag)
+
+    @staticmethod
+    def _percentile(latencies, percentile):
+
+        # Nearest-rank percentile of sorted latencies
+        return latencies[max(0, int(len(latencies) * percentile / 100.0 + 0.5) - 1)]
+
+    def summary(self):
+        """
+        Return a dict of route name (and "total") to a dict of its statistics - latencies are in seconds
+        """
+
+        with self._lock:
+            results = {route: list(route_results) for route, route_results in iteritems(self._results)}
+        results['total'] = [result for route_results in results.values() for result in route_results]
+        elapsed = self.elapsed or 0.0
+        summary = {}
+        for route, route_results in iteritems(results):
+            if not route_results:
+                continue
+            latencies = sorted(latency for _, latency, _ in route_results)
+            errors = sum(1 for status, _, _ in route_results if status is None or status >= 500)
+            route_bytes = sum(size for _, _, size in route_results)
+            route_summary = {
+                'requests': len(route_results),
+                'errors': errors,
+                'error_rate': float(errors) / len(route_results),
+                'statuses': {},
+                'throughput': len(route_results) / elapsed if elapsed else None,
+                'bytes': route_bytes,
+                'bytes_per_second': route_bytes / elapsed if elapsed else None,
+                'max': latencies[-1]
+            }
+            for status, _, _ in route_results:
+                route_summary['statuses'][status] = route_summary['statuses'].get(status, 0) + 1
+            for percentile in self.PERCENTILES:
+                route_summary['p{0}'.format(percentile)] = self._percentile(latencies, percentile)
+            summary[route] = route_summary
+        return summary
+
+    def format(self):
+        summary = self.summary()
+        lines = ['{0:<16} {1:>8} {2:>7} {3:>7} {4:>9} {5:>9} {6:>9} {7:>9} {8:>9} {9:>9}'.format(
+            'route', 'requests', 'errors', 'error%', 'req/s', 'MB/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+        for route in sorted(summary, key=lambda route: (route == 'total', route)):
+            route_summary = summary[route]
+            lines.append('{0:<16} {1:>8} {2:>7} {3:>7.2f} {4:>9.1f} {5:>9.2f} {6:>9.1f} {7:>9.1f} {8:>9.1f} {9:>9.1f}'.format(
+                route, route_summary['requests'], route_summary['errors'], 100 * route_summary['error_rate'],
+                route_summary['throughput'] or 0.0, (route_summary['bytes_per_second'] or 0.0) / (1024 * 1024),
+                1000 * route_summary['p50'], 1000 * route_summary['p90'], 1000 * route_summary['p99'], 1000 * route_summary['max']))
+        lines.append('elapsed {0:.2f} seconds, maximum schedule lag {1:.2f} seconds'.format(self.elapsed or 0.0, self.max_lag))
+        return '\n'.join(lines)
+
+
+def replay_requests(requests, send, speedup=1.0, concurrency=8):
+    """
+    Replay requests with their recorded timing divided by speedup on concurrency threads - returns a LoadReport. If
+    speedup is None the requests are sent as fast as possible. Latencies are measured from each request's scheduled
+    time, so requests that wait for a busy replay thread include their queueing delay.
+    """
+
+    report = LoadReport()
+    requests = list(requests)
+    requests_iter = iter(requests)
+    requests_lock = threading.Lock()
+    time_first = requests[0].time if requests else 0.0
+    time_start = time.time()
+
+    def replay_thread():
+        while True:
+            with requests_lock:
+                request = next(requests_iter, None)
+            if request is None:
+                break
+
+            # Wait for the request's scheduled time
+            now = time.time()
+            scheduled = time_start + (request.time - time_first) / speedup if speedup else now
+            if scheduled > now:
+                time.sleep(scheduled - now)
+                now = time.time()
+
+            try:
+                status, size = send(request.method, request.path)
+            except Exception: # pylint: disable=broad-except
+                status, size = None, 0
+            report.add(request_route(request.path), status, time.time() - scheduled, size, lag=now - scheduled)
+
+    threads = [threading.Thread(target=replay_thread) for _ in range(max(1, min(concurrency, len(requests))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report.elapsed = time.time() - time_start
+    return report
+
+
+class UpstreamStandIn(object):
+    """
+    Local stand-in for the upstream pypi index. Each package's index page links the package files (synthetic content
+    of file_size bytes) requested by the replayed downloads - packages without replayed downloads have a single
+    version. Responses are delayed to simulate upstream latency.
+    """
+
+    __slots__ = ('packages', 'file_size', 'delay', 'requests', '_server', '_thread', '_digests', '_lock')
+
+    DEFAULT_VERSION = '1.0.0'
+
+    def __init__(self, packages=None, file_size=65536, delay=0.0, port=0):
+        self.packages = packages or {}
+        self.file_size = file_size
+        self.delay = delay
+        self.requests = 0
+        self._digests = {}
+        self._lock = threading.Lock()
+
+        stand_in = self
+
+        class StandInHandler(http_server_BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self): # pylint: disable=invalid-name
+                with stand_in._lock: # pylint: disable=protected-access
+                    stand_in.requests += 1
+                time.sleep(stand_in.delay)
+                content_type, body = stand_in._response(self.path) # pylint: disable=protected-access
+                self.send_response(200 if body is not None else 404)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body or b'')))
+                self.end_headers()
+                self.wfile.write(body or b'')
+
+            def log_message(self, *args): # pylint: disable=arguments-differ
+                pass
+
+        class StandInServer(socketserver_ThreadingMixIn, http_server_HTTPServer):
+            daemon_threads = True
+
+        self._server = StandInServer(('127.0.0.1', port), StandInHandler)
+        self._thread = None
+
+    @classmethod
+    def for_requests(cls, requests, **kwargs):
+        """
+        Create the stand-in for the packages of the replayed requests
+        """
+
+        packages = {}
+        for request in requests:
+            path_parts = request.path.split('?', 1)[0].strip('/').split('/')
+            if len(path_parts) == 4 and path_parts[0] == 'download':
+                packages.setdefault(canonical_package_name(path_parts[1]), set()).add(path_parts[3])
+            elif len(path_parts) == 2 and path_parts[0] == 'simple':
+                packages.setdefault(canonical_package_name(path_parts[1]), set())
+        return cls(packages, **kwargs)
+
+    @property
+    def index_url(self):
+        return 'http://127.0.0.1:{0}/simple'.format(self._server.server_port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _content(self, filename):
+        line = filename.encode('utf-8') + b'\n'
+        return (line * (self.file_size // len(line) + 1))[:self.file_size]
+
+    def _sha256(self, filename):
+        with self._lock:
+            sha256 = self._digests.get(filename)
+        if sha256 is None:
+            digest = PackageDigest()
+            digest.update(self._content(filename))
+            sha256 = digest.hexdigest('sha256')
+            with self._lock:
+                self._digests[filename] = sha256
+        return sha256
+
+    def _response(self, path):
+        path_parts = path.split('?', 1)[0].strip('/').split('/')
+
+        # Package index page
+        if len(path_parts) == 2 and path_parts[0] == 'simple':
+            package_name = canonical_package_name(path_parts[1])
+            filenames = self.packages.get(package_name)
+            if filenames is None:
+                return 'text/html', None
+            filenames = sorted(filenames) or ['{0}-{1}.tar.gz'.format(path_parts[1], self.DEFAULT_VERSION)]
+            links = ''.join('<a href="../../packages/{0}#sha256={1}">{2}</a>\n'.format(
+                urllib_parse_quote(filename), self._sha256(filename), filename) for filename in filenames)
+            return 'text/html', '<html><body>\n{0}</body></html>'.format(links).encode('utf-8')
+
+        # Package file
+        if len(path_parts) == 2 and path_parts[0] == 'packages':
+            return 'application/octet-stream', self._content(path_parts[1])
+
+        return 'text/plain', None
+
+
+def main(argv=None):
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(prog='python -m mrpypi.load_test', description='Replay a request log against mrpypi')
+    parser.add_argument('log', metavar='LOG',
+                        help='request log file - an access log or JSON lines of "time", "method" and "path" ("-" for stdin)')
+    parser.add_argument('--url', dest='url', metavar='URL',
+                        help='replay against a running server (default is an in-process memory index application)')
+    parser.add_argument('--sqlite', dest='sqlite_path', metavar='FILE',
+                        help='replay in-process with a SQLite index database')
+    parser.add_argument('--speedup', dest='speedup', type=float, default=1.0, metavar='X',
+                        help='replay the log X times faster than recorded - 0 replays as fast as possible (default is 1)')
+    parser.add_argument('--concurrency', dest='concurrency', type=int, default=8, metavar='N',
+                        help='number of concurrent replay threads (default is 8)')
+    parser.add_argument('--file-size', dest='file_size', type=int, default=65536, metavar='BYTES',
+                        help='size of the upstream stand-in package files (default is 65536)')
+    parser.add_argument('--upstream-delay', dest='upstream_delay', type=float, default=0.0, metavar='SECONDS',
+                        help='upstream stand-in response delay (default is 0)')
+    parser.add_argument('--upstream-port', dest='upstream_port', type=int, default=0, metavar='N',
+                        help='upstream stand-in port, for a running server started with "--index" of the stand-in')
+    args = parser.parse_args(args=argv)
+    if args.url and args.sqlite_path:
+        parser.error('--sqlite is not supported with --url')
+
+    # Read the request log
+    if args.log == '-':
+        requests = parse_request_log(sys.stdin)
+    else:
+        with open(args.log) as log_file:
+            requests = parse_request_log(log_file)
+    print('Replaying {0} requests {1} with {2} threads'.format(
+        len(requests), 'at {0}x speed'.format(args.speedup) if args.speedup else 'as fast as possible', args.concurrency))
+
+    # Start the upstream stand-in
+    stand_in = UpstreamStandIn.for_requests(requests, file_size=args.file_size, delay=args.upstream_delay,
+                                            port=args.upstream_port).start()
+    print('Upstream stand-in index URL: {0}'.format(stand_in.index_url))
+    try:
+        if args.url:
+            send = http_sender(args.url)
+        else:
+            from . import MemoryIndex, MrPyPi, SQLiteIndex
+            if args.sqlite_path:
+                index = SQLiteIndex(args.sqlite_path, index_url=stand_in.index_url)
+            else:
+                index = MemoryIndex(index_url=stand_in.index_url)
+            send = application_sender(MrPyPi(index))
+
+        # Replay and report
+        report = replay_requests(requests, send, speedup=args.speedup or None, concurrency=args.concurrency)
+        print(report.format())
+        print('Upstream stand-in requests: {0}'.format(stand_in.requests))
+    finally:
+        stand_in.stop()
+
+
+if __name__ == '__main__':
+    main()
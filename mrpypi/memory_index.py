@@ -21,43 +21,138 @@
 #
 
 from datetime import datetime
+from functools import partial
+from io import BytesIO
+import threading
 
-from .compat import hashlib_md5_new, itervalues, urllib_request_urlopen
-from .index_util import IndexEntry, DEFAULT_PIP_INDEX, pip_package_versions
+from .compat import itervalues
+from .index_util import IndexEntry, DEFAULT_PIP_INDEX, PackageDigest, PackageHashMismatch, parallel_map, \
+    pip_package_versions_conditional, upstream_package_chunks, upstream_update_errors
+from .upstream import UpstreamUnavailable
+
+
+class _Flight(object):
+    __slots__ = ('event', 'exception')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.exception = None
 
 
 class MemoryIndex(object):
-    __slots__ = ('_index', '_index_url', '_index_content')
+    """
+    In-memory package index, safe for multi-threaded servers. Each package's index is an immutable snapshot that's
+    replaced (copy-on-write) under the package's lock stripe, so readers never lock. Upstream refreshes and downloads
+    are single-flight - concurrent misses for the same package or file wait on one upstream request. Refreshes are
+    conditional on the upstream validators of each package's last index page. In cluster mode, package files are
+    downloaded from their owner peer before upstream.
+    """
 
-    def __init__(self, index_url=DEFAULT_PIP_INDEX):
+    __slots__ = ('_index', '_index_url', '_index_content', '_validators', '_generation', '_generation_lock', '_locks', '_flights',
+                 '_cluster')
+
+    def __init__(self, index_url=DEFAULT_PIP_INDEX, lock_stripes=64, cluster=None):
         self._index = {}
         self._index_url = index_url
+        self._cluster = cluster
         self._index_content = {}
+        self._validators = {}
+        self._generation = 0
+        self._generation_lock = threading.Lock()
+        self._locks = [threading.Lock() for _ in range(lock_stripes)]
+        self._flights = {}
+
+    def _lock(self, package_name):
+        return self._locks[hash(package_name) % len(self._locks)]
+
+    def _increment_generation(self):
+        with self._generation_lock:
+            self._generation += 1
+
+    def _publish(self, package_name, package_index_update):
+
+        # Replace the package's index snapshot - the caller holds the package's lock stripe
+        package_index = self._index.get(package_name)
+        if not package_index:
+            self._increment_generation()
+        package_index = dict(package_index or ())
+        package_index.update(package_index_update)
+        self._index[package_name] = package_index
+
+    def _single_flight(self, package_name, key, function):
+
+        # The first caller for a key runs the function - concurrent callers wait for it to finish
+        with self._lock(package_name):
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._flights[key] = _Flight()
+        if not is_leader:
+            flight.event.wait()
+            if flight.exception is not None:
+                raise flight.exception # pylint: disable=raising-bad-type
+            return
+        try:
+            function()
+        except Exception as exc:
+            flight.exception = exc
+            raise
+        finally:
+            with self._lock(package_name):
+                del self._flights[key]
+            flight.event.set()
 
     def _update_index(self, ctx, package_name):
 
         # Upstream pypi index disabled?
         if self._index_url is None:
             return
+        self._single_flight(package_name, ('index', package_name), partial(self._update_index_upstream, ctx, package_name))
+
+    def _update_index_upstream(self, ctx, package_name):
 
         # Load upstream pypi index
         ctx.log.info('Updating index for package "%s"', package_name)
-        pip_packages = pip_package_versions(self._index_url, package_name)
+        validators = self._validators.get(package_name) if self._index.get(package_name) else None
+        try:
+            pip_packages, validators = pip_package_versions_conditional(self._index_url, package_name, validators)
+        except UpstreamUnavailable as exc:
+            # Serve the cached index, if any - otherwise the package is unavailable, not missing
+            if not self._index.get(package_name):
+                raise
+            ctx.log.warning('Package versions unavailable for "%s": %s', package_name, exc)
+            return
+
+        # Upstream index page not modified since the last refresh?
+        if pip_packages is None:
+            ctx.log.info('Index for package "%s" not modified', package_name)
+            return
+        if validators is not None:
+            self._validators[package_name] = validators
+        else:
+            self._validators.pop(package_name, None)
         if not pip_packages:
             return
 
-        # Add missing upstream versions to the index
-        package_index = self._index.setdefault(package_name, {})
-        for pip_package in pip_packages:
-            if pip_package.version not in package_index:
-                index_entry = IndexEntry(name=package_name,
-                                         version=pip_package.version,
-                                         filename=pip_package.link.filename,
-                                         hash=pip_package.link.hash,
-                                         hash_name=pip_package.link.hash_name,
-                                         url=pip_package.link.url,
-                                         datetime=None)
-                package_index[pip_package.version] = index_entry
+        # Add missing upstream package files to the index
+        with self._lock(package_name):
+            package_index = self._index.get(package_name) or {}
+            package_index_update = {}
+            for pip_package in pip_packages:
+                if pip_package.link.filename not in package_index:
+                    index_entry = IndexEntry(name=package_name,
+                                             version=pip_package.version,
+                                             filename=pip_package.link.filename,
+                                             hash=pip_package.link.hash,
+                                             hash_name=pip_package.link.hash_name,
+                                             url=pip_package.link.url,
+                                             datetime=None,
+                                             sha256=None,
+                                             md5=None,
+                                             size=None)
+                    package_index_update[pip_package.link.filename] = index_entry
+            if package_index_update:
+                self._publish(package_name, package_index_update)
 
     def get_package_index(self, ctx, package_name, force_update=False):
 
@@ -74,52 +169,179 @@ class MemoryIndex(object):
         # Return iter of index entry objects
         return itervalues(package_index)
 
-    def add_package(self, ctx, package_name, version, filename, content):
+    def get_package_indexes(self, ctx, package_names, force_update=False):
+
+        # Update the packages missing from the index from the upstream pypi index in parallel
+        package_names = list(package_names)
+        update_names = sorted(set(package_name for package_name in package_names if force_update or package_name not in self._index))
+        update_errors = upstream_update_errors(update_names, parallel_map(partial(self._update_index, ctx), update_names))
+
+        # Return dict of package name to iter of index entry objects - None indicates package not found and an
+        # UpstreamUnavailable exception that the package is unavailable
+        package_indexes = {}
+        for package_name in package_names:
+            package_index = self._index.get(package_name)
+            package_indexes[package_name] = itervalues(package_index) if package_index is not None else update_errors.get(package_name)
+        return package_indexes
+
+    def get_index_generation(self, ctx): # pylint: disable=unused-argument
+
+        # The generation changes only when a package name is added or removed
+        return self._generation
 
-        # Existing package version? If so, return False to indicate failure
-        index_entry = self._index.setdefault(package_name, {}).get(version)
-        if index_entry is not None:
-            ctx.log.info('Attempt to re-add package "%s", version "%s"',
-                         index_entry.name, index_entry.version)
-            return False
+    def get_package_names(self, ctx): # pylint: disable=unused-argument
 
-        # Add the new index entry and package content
-        ctx.log.info('Adding package "%s", version "%s" with filename "%s" of %d bytes',
-                     package_name, version, filename, len(content))
+        # Return iter of package names with at least one index entry - tuple() copies the dict items atomically
+        return (package_name for package_name, package_index in sorted(tuple(self._index.items())) if package_index)
+
+    def add_package(self, ctx, package_name, version, filename, content):
+
+        # Compute the digests outside of the lock
+        digest = PackageDigest()
+        digest.update(content)
         index_entry = IndexEntry(name=package_name,
                                  version=version,
                                  filename=filename,
-                                 hash=hashlib_md5_new(content).hexdigest(),
-                                 hash_name='md5',
+                                 hash=digest.hexdigest('sha256'),
+                                 hash_name='sha256',
                                  url=None,
-                                 datetime=datetime.now())
-        self._index[package_name][version] = index_entry
-        self._index_content[index_entry] = content
+                                 datetime=datetime.utcnow(),
+                                 sha256=digest.hexdigest('sha256'),
+                                 md5=digest.hexdigest('md5'),
+                                 size=digest.size)
+
+        with self._lock(package_name):
+
+            # Existing package file? If so, return False to indicate failure
+            index_entry_existing = (self._index.get(package_name) or {}).get(filename)
+            if index_entry_existing is not None:
+                ctx.log.info('Attempt to re-add package "%s", version "%s" with filename "%s"',
+                             index_entry_existing.name, index_entry_existing.version, index_entry_existing.filename)
+                return False
+
+            # Add the new index entry and package content
+            ctx.log.info('Adding package "%s", version "%s" with filename "%s" of %d bytes',
+                         package_name, version, filename, len(content))
+            self._index_content[(package_name, filename)] = content
+            self._publish(package_name, {filename: index_entry})
 
         # Return True to indicate success
         return True
 
+    def export_packages(self, ctx): # pylint: disable=unused-argument
+
+        # Generate (index_entry, content_file, content_size) tuples - content_file is None if the content isn't downloaded
+        for package_name, package_index in sorted(tuple(self._index.items())):
+            for index_entry in sorted(itervalues(package_index), key=lambda index_entry: (index_entry.version, index_entry.filename)):
+                content = self._index_content.get((package_name, index_entry.filename))
+                if content is None:
+                    yield index_entry, None, None
+                else:
+                    yield index_entry, BytesIO(content), len(content)
+
+    def import_packages(self, ctx, packages, batch_size=100):
+        counts = {'entries': 0, 'files': 0, 'skipped': 0, 'invalid': 0}
+
+        # Publish the imported entries in batches - existing entries are skipped
+        batch = {}
+        batch_count = 0
+        for index_entry, content_file in packages:
+            if index_entry.filename in (self._index.get(index_entry.name) or {}) or \
+               index_entry.filename in batch.get(index_entry.name, {}):
+                counts['skipped'] += 1
+                continue
+
+            # Verify the package file content
+            if content_file is not None:
+                digest = PackageDigest.for_index_entry(index_entry)
+                content = content_file.read()
+                digest.update(content)
+                if not digest.verify(index_entry):
+                    ctx.log.error('%s', PackageHashMismatch(index_entry))
+                    counts['invalid'] += 1
+                    continue
+                index_entry = digest.index_entry(index_entry)
+                self._index_content[(index_entry.name, index_entry.filename)] = content
+                counts['files'] += 1
+
+            batch.setdefault(index_entry.name, {})[index_entry.filename] = index_entry
+            batch_count += 1
+            if batch_count >= batch_size:
+                counts['entries'] += self._import_batch(batch)
+                batch = {}
+                batch_count = 0
+        counts['entries'] += self._import_batch(batch)
+        return counts
+
+    def _import_batch(self, batch):
+        count = 0
+        for package_name, package_index_update in sorted(batch.items()):
+            with self._lock(package_name):
+                package_index = self._index.get(package_name) or {}
+                package_index_update = {filename: index_entry for filename, index_entry in package_index_update.items()
+                                        if filename not in package_index}
+                if package_index_update:
+                    self._publish(package_name, package_index_update)
+                    count += len(package_index_update)
+        return count
+
+    def get_package_file(self, ctx, package_name, version, filename): # pylint: disable=unused-argument
+
+        # Package content is served from memory
+        return None
+
     def get_package_stream(self, ctx, package_name, version, filename):
 
         # Get the index entry - update from the upstream pypi index, if necessary
         package_index = self._index.get(package_name)
-        index_entry = package_index.get(version) if package_index is not None else None
+        index_entry = package_index.get(filename) if package_index is not None else None
         if index_entry is None:
             self._update_index(ctx, package_name)
             package_index = self._index.get(package_name)
-            index_entry = package_index.get(version) if package_index is not None else None
+            index_entry = package_index.get(filename) if package_index is not None else None
 
-        # Return None to indicate package version not found
-        if index_entry is None or index_entry.filename != filename:
+        # Return None to indicate package file not found
+        if index_entry is None or index_entry.version != version:
             return None
 
         # Download index entry content, if necessary
-        if index_entry not in self._index_content:
-            ctx.log.info('Downloading package "%s", version "%s" from "%s"',
-                         index_entry.name, index_entry.version, index_entry.url)
-            self._index_content[index_entry] = urllib_request_urlopen(index_entry.url).read()
+        content_key = (index_entry.name, index_entry.filename)
+        if content_key not in self._index_content:
+            self._single_flight(package_name, ('content',) + content_key, partial(self._download, ctx, index_entry))
 
         # Return the package content stream
+        content = self._index_content[content_key]
         def package_stream():
-            yield self._index_content[index_entry]
+            yield content
         return package_stream
+
+    def _download(self, ctx, index_entry):
+
+        # Downloaded by a previous flight?
+        content_key = (index_entry.name, index_entry.filename)
+        if content_key in self._index_content:
+            return
+
+        # Download from the package file's owner peer, if clustered, before upstream
+        peer_content = self._cluster.peer_package_content(ctx, index_entry) if self._cluster is not None else None
+        if peer_content is not None:
+            content, digest = peer_content
+        else:
+            ctx.log.info('Downloading package "%s", version "%s" with filename "%s" from "%s"',
+                         index_entry.name, index_entry.version, index_entry.filename, index_entry.url)
+            digest = PackageDigest.for_index_entry(index_entry)
+            chunks = []
+            for data in upstream_package_chunks(index_entry.url):
+                digest.update(data)
+                chunks.append(data)
+
+            # Verify the content before adding it
+            if not digest.verify(index_entry):
+                exc = PackageHashMismatch(index_entry)
+                ctx.log.error('%s', exc)
+                raise exc
+            content = b''.join(chunks)
+
+        with self._lock(index_entry.name):
+            self._index_content[content_key] = content
+            self._publish(index_entry.name, {index_entry.filename: digest.index_entry(index_entry)})
@@ -20,167 +20,715 @@
 # SOFTWARE.
 #
 
-from datetime import datetime
+from datetime import datetime, timedelta
+import threading
+import time
 
-try:
-    import gridfs
-    import pymongo
-except ImportError:
-    pass
+from .compat import iteritems, itervalues
+from .index_util import IndexEntry, DEFAULT_PIP_INDEX, PackageDigest, PackageHashMismatch, UpstreamValidators, background_context, \
+    parallel_map, pip_package_versions_conditional, upstream_package_chunks, upstream_update_errors
+from .upstream import UpstreamUnavailable, upstream_session
 
-from .compat import hashlib_md5_new, itervalues, urllib_request_urlopen
-from .index_util import IndexEntry, DEFAULT_PIP_INDEX, pip_package_versions
+# The MongoDB driver is imported on first use - see _import_mongo_driver
+ObjectId = gridfs = pymongo = None # pylint: disable=invalid-name
 
 
 DEFAULT_MONGO_URI = 'mongodb://localhost'
 
 
+def _import_mongo_driver():
+    global ObjectId, gridfs, pymongo # pylint: disable=global-statement,invalid-name
+    if pymongo is None:
+        from bson.objectid import ObjectId as bson_ObjectId
+        import gridfs as gridfs_module
+        import pymongo as pymongo_module
+        ObjectId, gridfs, pymongo = bson_ObjectId, gridfs_module, pymongo_module
+
+
 class MongoIndex(object):
-    __slots__ = ('mongo_uri', 'mongo_database', 'index_url')
+    __slots__ = ('mongo_uri', 'mongo_database', 'index_url', 'max_storage_bytes', 'eviction_policy', 'access_flush_interval', 'disk_cache',
+                 '_mongo_migrated', '_access_times', '_access_flushed', '_access_lock', '_storage_bytes', '_storage_lock', '_evicting')
 
     INDEX_COLLECTION_NAME = 'index'
     FILES_COLLECTION_NAME = 'fs'
+    GENERATION_COLLECTION_NAME = 'generation'
+    UPSTREAM_COLLECTION_NAME = 'upstream'
     STREAM_CHUNK_SIZE = 4096
 
-    def __init__(self, index_url=DEFAULT_PIP_INDEX, mongo_uri=DEFAULT_MONGO_URI, mongo_database='mrpypi'):
+    # Import reads match the gridfs chunk size
+    IMPORT_CHUNK_SIZE = 261120
+    LEGACY_INDEX_NAME = 'name_1_version_1'
+
+    # Exports read the index in pages of this many entries, so no cursor is held open for the whole export
+    EXPORT_PAGE_SIZE = 1000
+
+    # Files and chunks younger than this may belong to an upload or download in progress and are not garbage collected
+    GC_GRACE_SECONDS = 3600
+
+    # Storage quota eviction policies - evict the least-recently accessed or the largest upstream files first
+    EVICTION_POLICIES = ('access', 'size')
+
+    def __init__(self, index_url=DEFAULT_PIP_INDEX, mongo_uri=DEFAULT_MONGO_URI, mongo_database='mrpypi',
+                 max_storage_bytes=None, eviction_policy='access', access_flush_interval=60, disk_cache=None):
         self.index_url = index_url
         self.mongo_uri = mongo_uri
         self.mongo_database = mongo_database
+        self.max_storage_bytes = max_storage_bytes
+        self.eviction_policy = eviction_policy
+        self.access_flush_interval = access_flush_interval
+        self.disk_cache = disk_cache
+        self._mongo_migrated = False
+        self._access_times = {}
+        self._access_flushed = time.time()
+        self._access_lock = threading.Lock()
+        self._storage_bytes = None
+        self._storage_lock = threading.Lock()
+        self._evicting = False
+
+    def _mongo_client(self):
+        _import_mongo_driver()
+        return pymongo.MongoClient(self.mongo_uri)
 
     @staticmethod
-    def _local_filename(package_name, version):
-        return package_name + '/' + version
+    def _local_filename(package_name, version, filename):
+        return package_name + '/' + version + '/' + filename
 
     def _mongo_collection_package_index(self, mongo_client):
         mongo_package_index = mongo_client[self.mongo_database][self.INDEX_COLLECTION_NAME]
-        mongo_package_index.ensure_index([('name', pymongo.ASCENDING), ('version', pymongo.ASCENDING)], unique=True)
+        if not self._mongo_migrated:
+            self._mongo_migrate(mongo_client, mongo_package_index)
+        mongo_package_index.ensure_index([('name', pymongo.ASCENDING), ('version', pymongo.ASCENDING), ('filename', pymongo.ASCENDING)],
+                                         unique=True)
         return mongo_package_index
 
+    def _mongo_migrate(self, mongo_client, mongo_package_index):
+
+        # Index entries were once unique by (name, version) - drop the old unique index
+        if self.LEGACY_INDEX_NAME in mongo_package_index.index_information():
+            mongo_package_index.drop_index(self.LEGACY_INDEX_NAME)
+
+        # Rename gridfs files from "name/version" to "name/version/filename"
+        mongo_files = self._mongo_collection_package_files(mongo_client)
+        for legacy_file in mongo_files.find({'filename': {'$regex': '^[^/]+/[^/]+$'}}, {'filename': True}):
+            package_name, version = legacy_file['filename'].split('/')
+            package_entry = mongo_package_index.find_one({'name': package_name, 'version': version})
+            if package_entry is not None:
+                mongo_files.update({'_id': legacy_file['_id']},
+                                   {'$set': {'filename': self._local_filename(package_name, version, package_entry['filename'])}})
+
+        self._mongo_migrated = True
+
     def _mongo_gridfs_package_files(self, mongo_client):
         return gridfs.GridFS(mongo_client[self.mongo_database], collection=self.FILES_COLLECTION_NAME)
 
+    def _mongo_collection_package_files(self, mongo_client):
+        return mongo_client[self.mongo_database][self.FILES_COLLECTION_NAME + '.files']
+
+    def _mongo_collection_package_chunks(self, mongo_client):
+        return mongo_client[self.mongo_database][self.FILES_COLLECTION_NAME + '.chunks']
+
+    def _mongo_collection_upstream(self, mongo_client):
+        return mongo_client[self.mongo_database][self.UPSTREAM_COLLECTION_NAME]
+
+    def _mongo_upstream_validators(self, mongo_client, package_names):
+        mongo_upstream = self._mongo_collection_upstream(mongo_client)
+        return {x['_id']: UpstreamValidators(etag=x.get('etag'), last_modified=x.get('last_modified'))
+                for x in mongo_upstream.find({'_id': {'$in': package_names}})}
+
+    def _mongo_increment_generation(self, mongo_client):
+        mongo_generation = mongo_client[self.mongo_database][self.GENERATION_COLLECTION_NAME]
+        mongo_generation.update({'_id': self.INDEX_COLLECTION_NAME}, {'$inc': {'generation': 1}}, upsert=True)
+
+    @staticmethod
+    def _index_entry(mongo_package_entry):
+        return IndexEntry(name=mongo_package_entry['name'],
+                          version=mongo_package_entry['version'],
+                          filename=mongo_package_entry['filename'],
+                          hash=mongo_package_entry['hash'],
+                          hash_name=mongo_package_entry['hash_name'],
+                          url=mongo_package_entry['url'],
+                          datetime=mongo_package_entry['datetime'],
+                          sha256=mongo_package_entry.get('sha256'),
+                          md5=mongo_package_entry.get('md5'),
+                          size=mongo_package_entry.get('size'))
+
     def get_package_index(self, ctx, package_name, force_update=False):
 
         # Read mongo index
-        with pymongo.MongoClient(self.mongo_uri) as mongo_client:
+        with self._mongo_client() as mongo_client:
             mongo_package_index = self._mongo_collection_package_index(mongo_client)
 
             # Get the package index entries
-            package_index = {x['version']:
-                             IndexEntry(name=x['name'],
-                                        version=x['version'],
-                                        filename=x['filename'],
-                                        hash=x['hash'],
-                                        hash_name=x['hash_name'],
-                                        url=x['url'],
-                                        datetime=x['datetime'])
+            package_index = {x['filename']: self._index_entry(x)
                              for x in mongo_package_index.find({'name': package_name})}
 
-            # Index out-of-date?
+            # Index out-of-date? Refreshes of a cached index are conditional on its upstream validators.
             if not package_index or force_update:
-                ctx.log.info('Updating index for "%s"', package_name)
-
-                # For each cached pypi index
-                package_index_update = {}
-                if self.index_url is not None:
-                    try:
-                        # Get the pip index
-                        pip_packages = pip_package_versions(self.index_url, package_name)
-                        if pip_packages is not None:
-                            for pip_package in pip_packages:
-                                # New package version?
-                                if pip_package.version not in package_index:
-                                    package_index_entry = IndexEntry(name=package_name,
-                                                                     version=pip_package.version,
-                                                                     filename=pip_package.link.filename,
-                                                                     hash=pip_package.link.hash,
-                                                                     hash_name=pip_package.link.hash_name,
-                                                                     url=pip_package.link.url,
-                                                                     datetime=None)
-                                    package_index[pip_package.version] = package_index_entry
-                                    package_index_update[pip_package.version] = package_index_entry
-                    except Exception as exc: # pylint: disable=broad-except
-                        ctx.log.warning('Package versions pip exception for "%s": %s', package_name, exc)
-
-                # Insert any new package versions
-                if package_index_update:
-                    mongo_package_index.insert(x._asdict() for x in itervalues(package_index_update))
+                validators = self._mongo_upstream_validators(mongo_client, [package_name]).get(package_name) if package_index else None
+                self._mongo_update_package_index(ctx, mongo_client, package_name, package_index, validators)
 
         if not package_index:
             return None
         return itervalues(package_index)
 
+    def get_package_indexes(self, ctx, package_names, force_update=False):
+
+        # Read the mongo index entries of all packages with a single query
+        package_names = list(package_names)
+        with self._mongo_client() as mongo_client:
+            mongo_package_index = self._mongo_collection_package_index(mongo_client)
+            package_indexes = {package_name: {} for package_name in package_names}
+            for mongo_index_entry in mongo_package_index.find({'name': {'$in': sorted(package_indexes)}}):
+                package_indexes[mongo_index_entry['name']][mongo_index_entry['filename']] = self._index_entry(mongo_index_entry)
+
+            # Update out-of-date packages from the upstream pypi index in parallel
+            update_names = sorted(package_name for package_name, package_index in iteritems(package_indexes)
+                                  if not package_index or force_update)
+            validators = self._mongo_upstream_validators(mongo_client, [package_name for package_name in update_names
+                                                                        if package_indexes[package_name]]) if force_update else {}
+            update_errors = upstream_update_errors(update_names, parallel_map(
+                lambda package_name: self._mongo_update_package_index(ctx, mongo_client, package_name, package_indexes[package_name],
+                                                                      validators.get(package_name)),
+                update_names))
+
+        # Return dict of package name to iter of index entry objects - None indicates package not found and an
+        # UpstreamUnavailable exception that the package is unavailable
+        return {package_name: itervalues(package_index) if package_index else update_errors.get(package_name)
+                for package_name, package_index in iteritems(package_indexes)}
+
+    def _mongo_update_package_index(self, ctx, mongo_client, package_name, package_index, validators=None):
+        ctx.log.info('Updating index for "%s"', package_name)
+
+        # For each cached pypi index
+        package_index_update = {}
+        if self.index_url is not None:
+            try:
+                # Get the pip index - not modified since the last refresh extends the validators' freshness
+                pip_packages, validators_update = pip_package_versions_conditional(self.index_url, package_name, validators)
+                mongo_upstream = self._mongo_collection_upstream(mongo_client)
+                if pip_packages is None:
+                    ctx.log.info('Index for "%s" not modified', package_name)
+                    mongo_upstream.update({'_id': package_name}, {'$set': {'datetime': datetime.utcnow()}})
+                elif validators_update is not None:
+                    mongo_upstream.update({'_id': package_name}, {'$set': {'etag': validators_update.etag,
+                                                                           'last_modified': validators_update.last_modified,
+                                                                           'datetime': datetime.utcnow()}}, upsert=True)
+                elif validators is not None:
+                    mongo_upstream.remove({'_id': package_name})
+                if pip_packages is not None:
+                    for pip_package in pip_packages:
+                        # New package file?
+                        if pip_package.link.filename not in package_index:
+                            package_index_entry = IndexEntry(name=package_name,
+                                                             version=pip_package.version,
+                                                             filename=pip_package.link.filename,
+                                                             hash=pip_package.link.hash,
+                                                             hash_name=pip_package.link.hash_name,
+                                                             url=pip_package.link.url,
+                                                             datetime=None,
+                                                             sha256=None,
+                                                             md5=None,
+                                                             size=None)
+                            package_index[pip_package.link.filename] = package_index_entry
+                            package_index_update[pip_package.link.filename] = package_index_entry
+            except UpstreamUnavailable as exc:
+                # Serve the cached index, if any - otherwise the package is unavailable, not missing
+                if not package_index:
+                    raise
+                ctx.log.warning('Package versions unavailable for "%s": %s', package_name, exc)
+            except Exception as exc: # pylint: disable=broad-except
+                ctx.log.warning('Package versions pip exception for "%s": %s', package_name, exc)
+
+        # Insert any new package files - a new package name changes the index generation
+        if package_index_update:
+            mongo_package_index = self._mongo_collection_package_index(mongo_client)
+            mongo_package_index.insert(x._asdict() for x in itervalues(package_index_update))
+            if len(package_index) == len(package_index_update):
+                self._mongo_increment_generation(mongo_client)
+
+    def get_index_generation(self, ctx): # pylint: disable=unused-argument
+
+        # The generation changes only when a package name is added or removed
+        with self._mongo_client() as mongo_client:
+            mongo_generation = mongo_client[self.mongo_database][self.GENERATION_COLLECTION_NAME]
+            generation = mongo_generation.find_one({'_id': self.INDEX_COLLECTION_NAME})
+            return generation['generation'] if generation is not None else 0
+
+    def get_package_names(self, ctx): # pylint: disable=unused-argument
+
+        # Stream the distinct package names from an aggregation cursor - one document per name, not per file
+        with self._mongo_client() as mongo_client:
+            mongo_package_index = self._mongo_collection_package_index(mongo_client)
+            for mongo_package_name in mongo_package_index.aggregate([{'$group': {'_id': '$name'}}, {'$sort': {'_id': 1}}],
+                                                                    allowDiskUse=True, cursor={}):
+                yield mongo_package_name['_id']
+
+    def export_packages(self, ctx): # pylint: disable=unused-argument
+
+        # Generate (index_entry, content_file, content_size) tuples - content_file is None if the package file isn't stored
+        with self._mongo_client() as mongo_client:
+            mongo_package_index = self._mongo_collection_package_index(mongo_client)
+            gridfs_package_files = self._mongo_gridfs_package_files(mongo_client)
+            for mongo_entry in self._mongo_export_entries(mongo_package_index):
+                index_entry = self._index_entry(mongo_entry)
+                try:
+                    gridfs_file = gridfs_package_files.get_last_version(
+                        filename=self._local_filename(index_entry.name, index_entry.version, index_entry.filename))
+                except gridfs.NoFile:
+                    yield index_entry, None, None
+                    continue
+                try:
+                    yield index_entry, gridfs_file, gridfs_file.length
+                finally:
+                    gridfs_file.close()
+
+    def _mongo_export_entries(self, mongo_package_index):
+
+        # Read the index in (name, version, filename) order, a page at a time - each page query resumes after the last
+        # entry of the previous page
+        sort = [('name', pymongo.ASCENDING), ('version', pymongo.ASCENDING), ('filename', pymongo.ASCENDING)]
+        query = {}
+        while True:
+            mongo_entries = list(mongo_package_index.find(query).sort(sort).limit(self.EXPORT_PAGE_SIZE))
+            for mongo_entry in mongo_entries:
+                yield mongo_entry
+            if len(mongo_entries) < self.EXPORT_PAGE_SIZE:
+                break
+            name, version, filename = (mongo_entries[-1][key] for key, _ in sort)
+            query = {'$or': [
+                {'name': {'$gt': name}},
+                {'name': name, 'version': {'$gt': version}},
+                {'name': name, 'version': version, 'filename': {'$gt': filename}}
+            ]}
+
+    def import_packages(self, ctx, packages, batch_size=100):
+        counts = {'entries': 0, 'files': 0, 'skipped': 0, 'invalid': 0}
+        storage_bytes = 0
+
+        with self._mongo_client() as mongo_client:
+            gridfs_package_files = self._mongo_gridfs_package_files(mongo_client)
+            batch = []
+            for index_entry, content_file in packages:
+
+                # Stream the package file content to the gridfs, unless it's already stored
+                if content_file is not None:
+                    gridfs_filename = self._local_filename(index_entry.name, index_entry.version, index_entry.filename)
+                    if not gridfs_package_files.exists(filename=gridfs_filename):
+                        digest = PackageDigest.for_index_entry(index_entry)
+                        verified = False
+                        gridfs_file = gridfs_package_files.new_file(filename=gridfs_filename, accessed=datetime.utcnow(),
+                                                                    upstream=index_entry.url is not None)
+                        try:
+                            while True:
+                                data = content_file.read(self.IMPORT_CHUNK_SIZE)
+                                if not data:
+                                    break
+                                digest.update(data)
+                                gridfs_file.write(data)
+                            verified = digest.verify(index_entry)
+                        finally:
+                            # Only keep the file if the import completed and verified
+                            gridfs_file.close()
+                            if not verified:
+                                gridfs_package_files.delete(gridfs_file._id) # pylint: disable=protected-access
+                        if not verified:
+                            ctx.log.error('%s', PackageHashMismatch(index_entry))
+                            counts['invalid'] += 1
+                            continue
+                        index_entry = digest.index_entry(index_entry)
+                        counts['files'] += 1
+                        storage_bytes += digest.size
+
+                # Insert the index entries in batches
+                batch.append(index_entry)
+                if len(batch) >= batch_size:
+                    self._mongo_import_batch(mongo_client, batch, counts)
+                    batch = []
+            self._mongo_import_batch(mongo_client, batch, counts)
+
+            # Imported package names change the index generation
+            if counts['entries']:
+                self._mongo_increment_generation(mongo_client)
+
+        self._add_storage_bytes(ctx, storage_bytes)
+        return counts
+
+    def _mongo_import_batch(self, mongo_client, batch, counts):
+        if not batch:
+            return
+
+        # Skip the existing index entries with a single query
+        mongo_package_index = self._mongo_collection_package_index(mongo_client)
+        existing = set((mongo_entry['name'], mongo_entry['filename']) for mongo_entry in
+                       mongo_package_index.find({'name': {'$in': sorted(set(index_entry.name for index_entry in batch))}},
+                                                {'name': True, 'filename': True}))
+        mongo_entries = []
+        for index_entry in batch:
+            if (index_entry.name, index_entry.filename) in existing:
+                counts['skipped'] += 1
+            else:
+                existing.add((index_entry.name, index_entry.filename))
+                mongo_entries.append(index_entry._asdict())
+        if mongo_entries:
+            mongo_package_index.insert(mongo_entries)
+            counts['entries'] += len(mongo_entries)
+
+    def get_package_file(self, ctx, package_name, version, filename): # pylint: disable=unused-argument
+
+        # Package file in the local disk cache? Cached files are verified and immutable, so Mongo isn't queried
+        if self.disk_cache is None:
+            return None
+        gridfs_filename = self._local_filename(package_name, version, filename)
+        cached_file = self.disk_cache.get(gridfs_filename)
+        if cached_file is not None:
+            self._record_access(None, gridfs_filename)
+        return cached_file
+
     def get_package_stream(self, ctx, package_name, version, filename):
 
         # Find the package index entry
-        package_entry = next((pe for pe in self.get_package_index(ctx, package_name) if pe.version == version), None)
-        if package_entry is None or package_entry.filename != filename:
+        package_index = self.get_package_index(ctx, package_name) or ()
+        package_entry = next((pe for pe in package_index if pe.filename == filename), None)
+        if package_entry is None or package_entry.version != version:
             return None
 
+        # Package file not stored? If so, start the download before the response starts, so an unavailable or overloaded
+        # upstream fails fast.
+        gridfs_filename = self._local_filename(package_name, version, filename)
+        chunks = None
+        if package_entry.url is not None:
+            with self._mongo_client() as mongo_client:
+                stored = self._mongo_gridfs_package_files(mongo_client).exists(filename=gridfs_filename)
+            if not stored:
+                ctx.log.info('Downloading package (%s, %s, %s) from "%s"', package_name, version, filename, package_entry.url)
+                upstream_session().check_available(package_entry.url)
+                chunks = upstream_package_chunks(package_entry.url)
+
         # File stream...
         def package_stream():
 
             # Open the gridfs
-            with pymongo.MongoClient(self.mongo_uri) as mongo_client:
+            with self._mongo_client() as mongo_client:
                 gridfs_package_files = self._mongo_gridfs_package_files(mongo_client)
 
-                # Package file not exist?
-                gridfs_filename = self._local_filename(package_name, version)
-                if not gridfs_package_files.exists(filename=gridfs_filename):
+                # Package file downloading?
+                if chunks is not None:
 
-                    # Download the file
-                    assert package_entry.url, 'Attempt to add package index entry without URL!!'
-                    ctx.log.info('Downloading package (%s, %s) from "%s"', package_name, version, package_entry.url)
-                    content = urllib_request_urlopen(package_entry.url).read()
+                    # Stream each chunk to the client and the gridfs as it arrives
+                    digest = PackageDigest.for_index_entry(package_entry)
+                    verified = False
+                    gridfs_file = gridfs_package_files.new_file(filename=gridfs_filename, accessed=datetime.utcnow(), upstream=True)
+                    cache_writer = self.disk_cache.writer(gridfs_filename) if self.disk_cache is not None else None
+                    try:
+                        for data in chunks:
+                            digest.update(data)
+                            gridfs_file.write(data)
+                            if cache_writer is not None:
+                                cache_writer.write(data)
+                            yield data
+                        verified = digest.verify(package_entry)
+                    finally:
+                        # Only keep the file if the download completed and verified
+                        gridfs_file.close()
+                        if not verified:
+                            gridfs_package_files.delete(gridfs_file._id) # pylint: disable=protected-access
+                        if cache_writer is not None:
+                            if verified:
+                                cache_writer.commit(ctx)
+                            else:
+                                cache_writer.abort()
+                    if not verified:
+                        # Abort the response so the client can't mistake the content for a complete download
+                        exc = PackageHashMismatch(package_entry)
+                        ctx.log.error('%s', exc)
+                        raise exc
+
+                    # Store the computed digests with the index entry
+                    ctx.log.info('Added package (%s, %s, %s) (%d bytes)', package_name, version, filename, digest.size)
+                    mongo_package_index = self._mongo_collection_package_index(mongo_client)
+                    mongo_package_index.update({'name': package_name, 'version': version, 'filename': filename},
+                                               {'$set': {'sha256': digest.hexdigest('sha256'), 'md5': digest.hexdigest('md5'),
+                                                         'size': digest.size}})
+
+                    # Storage quota exceeded? Evict in the background, off the request path
+                    self._add_storage_bytes(ctx, digest.size)
+                    return
+
+                # Stream the file chunks - and read them through to the disk cache
+                self._record_access(mongo_client, gridfs_filename)
+                cache_writer = self.disk_cache.writer(gridfs_filename) if self.disk_cache is not None else None
+                complete = False
+                try:
+                    with gridfs_package_files.get_last_version(filename=gridfs_filename) as gridfs_file:
+                        while True:
+                            data = gridfs_file.read(self.STREAM_CHUNK_SIZE)
+                            if not data:
+                                break
+                            if cache_writer is not None:
+                                cache_writer.write(data)
+                            yield data
+                    complete = True
+                finally:
+                    if cache_writer is not None:
+                        if complete:
+                            cache_writer.commit(ctx)
+                        else:
+                            cache_writer.abort()
 
-                    # Add the file
-                    ctx.log.info('Adding package (%s, %s) (%d bytes)', package_name, version, len(content))
-                    with gridfs_package_files.new_file(filename=gridfs_filename) as gridfs_file:
-                        gridfs_file.write(content)
+        return package_stream
 
-                # Stream the file chunks
-                with gridfs_package_files.get_last_version(filename=gridfs_filename) as gridfs_file:
-                    while True:
-                        data = gridfs_file.read(self.STREAM_CHUNK_SIZE)
-                        if not data:
-                            break
-                        yield data
+    def _record_access(self, mongo_client, gridfs_filename):
+
+        # Access times are batched in memory and flushed at most once per flush interval
+        with self._access_lock:
+            self._access_times[gridfs_filename] = datetime.utcnow()
+            if time.time() - self._access_flushed < self.access_flush_interval:
+                return
+        if mongo_client is None:
+            with self._mongo_client() as mongo_client:
+                self._mongo_flush_access_times(mongo_client)
+        else:
+            self._mongo_flush_access_times(mongo_client)
+
+    def _mongo_flush_access_times(self, mongo_client):
+        with self._access_lock:
+            access_times, self._access_times = self._access_times, {}
+            self._access_flushed = time.time()
+        if access_times:
+            mongo_files = self._mongo_collection_package_files(mongo_client)
+            bulk = mongo_files.initialize_unordered_bulk_op()
+            for gridfs_filename, accessed in access_times.items():
+                bulk.find({'filename': gridfs_filename}).update({'$max': {'accessed': accessed}})
+            bulk.execute()
+
+    def _mongo_storage_bytes(self, mongo_client):
+        mongo_files = self._mongo_collection_package_files(mongo_client)
+        result = mongo_files.aggregate([{'$group': {'_id': None, 'length': {'$sum': '$length'}}}])
+        result = result.get('result', []) if isinstance(result, dict) else list(result)
+        return result[0]['length'] if result else 0
+
+    def _add_storage_bytes(self, ctx, size):
+
+        # Keep a running storage total and start a background eviction when it exceeds the quota
+        if self.max_storage_bytes is None:
+            return
+        with self._storage_lock:
+            if self._storage_bytes is not None:
+                self._storage_bytes += size
+                if self._storage_bytes <= self.max_storage_bytes:
+                    return
+            if self._evicting:
+                return
+            self._evicting = True
+        thread = threading.Thread(target=self._evict_background, args=(background_context(ctx),))
+        thread.daemon = True
+        thread.start()
+
+    def _evict_background(self, ctx):
+        try:
+            with self._mongo_client() as mongo_client:
+                self._mongo_evict(ctx, mongo_client, self.max_storage_bytes)
+        except Exception as exc: # pylint: disable=broad-except
+            ctx.log.error('Eviction failed: %s', exc)
+        finally:
+            with self._storage_lock:
+                self._evicting = False
 
-        return package_stream
+    @staticmethod
+    def _eviction_sort(eviction_policy):
+        if eviction_policy == 'size':
+            return [('length', pymongo.DESCENDING)]
+        return [('accessed', pymongo.ASCENDING), ('uploadDate', pymongo.ASCENDING)]
+
+    @staticmethod
+    def _evicted_files(mongo_files, storage_bytes, max_storage_bytes):
+        """
+        Generate the files to evict, in eviction order, until storage is under quota - uploaded files are never evicted
+        """
+
+        for mongo_file in mongo_files:
+            if storage_bytes <= max_storage_bytes:
+                break
+            if mongo_file.get('upstream'):
+                storage_bytes -= mongo_file['length']
+                yield mongo_file
+
+    def _mongo_evict(self, ctx, mongo_client, max_storage_bytes):
+
+        # The exact storage total resynchronizes the running total - other processes share the storage
+        storage_bytes = self._mongo_storage_bytes(mongo_client)
+        with self._storage_lock:
+            self._storage_bytes = storage_bytes
+
+        # Under quota?
+        if storage_bytes <= max_storage_bytes:
+            return 0
+        ctx.log.info('Storage of %d bytes exceeds quota of %d bytes - evicting by %s', storage_bytes, max_storage_bytes,
+                     self.eviction_policy)
+        self._mongo_flush_access_times(mongo_client)
+
+        # Evict upstream-sourced files (flagged in the gridfs file metadata) until under quota
+        eviction_sort = self._eviction_sort(self.eviction_policy)
+        mongo_files = self._mongo_collection_package_files(mongo_client)
+        mongo_files.ensure_index([('upstream', pymongo.ASCENDING)] + eviction_sort)
+        gridfs_package_files = self._mongo_gridfs_package_files(mongo_client)
+        evicted = 0
+        evicted_bytes = 0
+        mongo_upstream_files = mongo_files.find({'upstream': True}, {'filename': True, 'length': True, 'upstream': True}) \
+                                          .sort(eviction_sort)
+        for mongo_file in self._evicted_files(mongo_upstream_files, storage_bytes, max_storage_bytes):
+            ctx.log.info('Evicting package file "%s" (%d bytes)', mongo_file['filename'], mongo_file['length'])
+            gridfs_package_files.delete(mongo_file['_id'])
+            evicted += 1
+            evicted_bytes += mongo_file['length']
+        with self._storage_lock:
+            self._storage_bytes -= evicted_bytes
+        return evicted
+
+    @staticmethod
+    def _gc_files(mongo_files, index_filenames, gc_cutoff):
+        """
+        Generate (mongo_file, keep) for gridfs files sorted by (filename, uploadDate) - files with no index entry and
+        superseded versions of files written concurrently are not kept, unless within the grace period
+        """
+
+        mongo_file_last = None
+        for mongo_file in mongo_files:
+            if mongo_file_last is not None:
+                is_superseded = mongo_file_last['filename'] == mongo_file['filename']
+                is_orphan = is_superseded or mongo_file_last['filename'] not in index_filenames
+                yield mongo_file_last, not is_orphan or mongo_file_last['uploadDate'] >= gc_cutoff
+            mongo_file_last = mongo_file
+        if mongo_file_last is not None:
+            yield mongo_file_last, mongo_file_last['filename'] in index_filenames or mongo_file_last['uploadDate'] >= gc_cutoff
+
+    @staticmethod
+    def _gc_entries(package_entries, gridfs_filenames, local_filename, gc_cutoff):
+        """
+        Generate the uploaded index entries whose file is missing, unless within the grace period (the file may be
+        written after the gridfs files are read) - upstream entries are downloaded again on demand
+        """
+
+        for package_entry in package_entries:
+            if package_entry['url'] is None and \
+               (package_entry.get('datetime') is None or package_entry['datetime'] < gc_cutoff) and \
+               local_filename(package_entry['name'], package_entry['version'], package_entry['filename']) not in gridfs_filenames:
+                yield package_entry
+
+    def gc(self, ctx): # pylint: disable=invalid-name
+        """
+        Remove orphaned gridfs chunks and files and uploaded index entries whose file is missing, then enforce the
+        storage quota. Returns a dict of the number of items removed of each kind.
+        """
+
+        with self._mongo_client() as mongo_client:
+            mongo_package_index = self._mongo_collection_package_index(mongo_client)
+            mongo_files = self._mongo_collection_package_files(mongo_client)
+            mongo_chunks = self._mongo_collection_package_chunks(mongo_client)
+            gridfs_package_files = self._mongo_gridfs_package_files(mongo_client)
+            self._mongo_flush_access_times(mongo_client)
+
+            # Read the index's gridfs filenames, and whether each is upstream-sourced, in one pass
+            index_filenames = {}
+            for package_entry in mongo_package_index.find({}, {'_id': False, 'name': True, 'version': True, 'filename': True, 'url': True}):
+                index_filenames[self._local_filename(package_entry['name'], package_entry['version'], package_entry['filename'])] = \
+                    package_entry['url'] is not None
+
+            # Delete gridfs files with no index entry and superseded versions of files written concurrently
+            result = {'files': 0, 'chunks': 0, 'entries': 0, 'evicted': 0}
+            gc_cutoff = datetime.utcnow() - timedelta(seconds=self.GC_GRACE_SECONDS)
+            file_ids = set()
+            gridfs_filenames = set()
+            legacy_files = {}
+            mongo_files_sorted = mongo_files.find({}, {'filename': True, 'uploadDate': True, 'upstream': True}) \
+                                            .sort([('filename', pymongo.ASCENDING), ('uploadDate', pymongo.ASCENDING)])
+            for mongo_file, keep in self._gc_files(mongo_files_sorted, index_filenames, gc_cutoff):
+                if keep:
+                    file_ids.add(mongo_file['_id'])
+                    gridfs_filenames.add(mongo_file['filename'])
+                    if 'upstream' not in mongo_file and mongo_file['filename'] in index_filenames:
+                        legacy_files[mongo_file['_id']] = index_filenames[mongo_file['filename']]
+                else:
+                    ctx.log.info('Deleting orphaned package file "%s"', mongo_file['filename'])
+                    gridfs_package_files.delete(mongo_file['_id'])
+                    result['files'] += 1
+
+            # Flag files stored before the upstream flag was added to the gridfs file metadata
+            if legacy_files:
+                bulk = mongo_files.initialize_unordered_bulk_op()
+                for file_id, upstream in legacy_files.items():
+                    bulk.find({'_id': file_id}).update({'$set': {'upstream': upstream}})
+                bulk.execute()
+
+            # Delete chunks with no gridfs file
+            orphaned_file_ids = set()
+            for mongo_chunk in mongo_chunks.find({'files_id': {'$lt': ObjectId.from_datetime(gc_cutoff)}}, {'files_id': True}):
+                if mongo_chunk['files_id'] not in file_ids:
+                    orphaned_file_ids.add(mongo_chunk['files_id'])
+            if orphaned_file_ids:
+                ctx.log.info('Deleting orphaned chunks of %d package files', len(orphaned_file_ids))
+                result['chunks'] = mongo_chunks.remove({'files_id': {'$in': list(orphaned_file_ids)}})['n']
+
+            # Delete uploaded index entries whose file is missing
+            for package_entry in self._gc_entries(mongo_package_index.find({'url': None}), gridfs_filenames, self._local_filename,
+                                                gc_cutoff):
+                ctx.log.info('Deleting orphaned package index (%s, %s, %s)',
+                             package_entry['name'], package_entry['version'], package_entry['filename'])
+                mongo_package_index.remove({'_id': package_entry['_id']})
+                result['entries'] += 1
+            if result['entries']:
+                # Package names may have been removed
+                self._mongo_increment_generation(mongo_client)
+
+            # Enforce the storage quota
+            if self.max_storage_bytes is not None:
+                result['evicted'] = self._mongo_evict(ctx, mongo_client, self.max_storage_bytes)
+
+        return result
 
     def add_package(self, ctx, package_name, version, filename, content):
 
         # Index exist?
-        package_index = self.get_package_index(ctx, package_name) or ()
-        package_exists = next((pe for pe in package_index if pe.version == version), None)
+        package_index = list(self.get_package_index(ctx, package_name) or ())
+        package_exists = next((pe for pe in package_index if pe.filename == filename), None)
         if package_exists is not None:
-            ctx.log.error('Attempt to add package index (%s, %s) that already exists!', package_name, version)
+            ctx.log.error('Attempt to add package index (%s, %s, %s) that already exists!', package_name, version, filename)
             return False
 
         # Open the gridfs
-        with pymongo.MongoClient(self.mongo_uri) as mongo_client:
+        with self._mongo_client() as mongo_client:
             mongo_package_index = self._mongo_collection_package_index(mongo_client)
             gridfs_package_files = self._mongo_gridfs_package_files(mongo_client)
 
             # File exist?
-            gridfs_filename = self._local_filename(package_name, version)
+            gridfs_filename = self._local_filename(package_name, version, filename)
             if gridfs_package_files.exists(filename=gridfs_filename):
-                ctx.log.error('Attempt to add package file (%s, %s) that already exists!', package_name, version)
+                ctx.log.error('Attempt to add package file (%s, %s, %s) that already exists!', package_name, version, filename)
                 return False
 
+            # Add the file, computing the digests as each chunk is written
+            ctx.log.info('Adding package file (%s, %s, %s) (%d bytes)', package_name, version, filename, len(content))
+            digest = PackageDigest()
+            with gridfs_package_files.new_file(filename=gridfs_filename, upstream=False) as gridfs_file:
+                for offset in range(0, len(content), self.STREAM_CHUNK_SIZE):
+                    data = content[offset:offset + self.STREAM_CHUNK_SIZE]
+                    digest.update(data)
+                    gridfs_file.write(data)
+
             # Add the index
-            ctx.log.info('Adding package index (%s, %s)', package_name, version)
+            ctx.log.info('Adding package index (%s, %s, %s)', package_name, version, filename)
             mongo_package_index.insert(IndexEntry(name=package_name,
                                                   version=version,
                                                   filename=filename,
-                                                  hash=hashlib_md5_new(content).hexdigest(),
-                                                  hash_name='md5',
+                                                  hash=digest.hexdigest('sha256'),
+                                                  hash_name='sha256',
                                                   url=None,
-                                                  datetime=datetime.now())._asdict())
-
-            # Add the file
-            ctx.log.info('Adding package file (%s, %s) (%d bytes)', package_name, version, len(content))
-            with gridfs_package_files.new_file(filename=gridfs_filename) as gridfs_file:
-                gridfs_file.write(content)
-
-            return True
+                                                  datetime=datetime.utcnow(),
+                                                  sha256=digest.hexdigest('sha256'),
+                                                  md5=digest.hexdigest('md5'),
+                                                  size=digest.size)._asdict())
+            if not package_index:
+                self._mongo_increment_generation(mongo_client)
+
+        self._add_storage_bytes(ctx, digest.size)
+        return True
@@ -21,24 +21,72 @@
 #
 
 import cgi
+from functools import partial
+import hmac
+import json
 import logging
+import posixpath
+from xml.sax.saxutils import escape, quoteattr
 
 import chisel
 
+from .archive import export_archive
+from .compat import iteritems, itervalues
+from .index_util import SDIST_EXTS, PackageHashMismatch, canonical_package_name, index_entry_hash, package_filename_matches
+from .page_cache import PageCache, accept_content_type
+from .profiler import RequestProfiler
+from .upstream import UpstreamUnavailable
+
 
 class MrPyPi(chisel.Application):
-    __slots__ = ('index')
+    __slots__ = ('index', 'page_cache', 'profiler', 'prefetcher', 'export_token')
+
+    # Admin request header (X-MrPyPi-Export-Token) that authorizes index archive exports when it matches the export token
+    EXPORT_TOKEN_ENVIRON = 'HTTP_X_MRPYPI_EXPORT_TOKEN'
 
-    def __init__(self, index):
+    def __init__(self, index, page_cache=None, profiler=None, prefetcher=None, export_token=None):
         chisel.Application.__init__(self)
         self.log_level = logging.INFO
         self.index = index
+        self.page_cache = page_cache if page_cache is not None else PageCache()
+        self.profiler = profiler if profiler is not None else RequestProfiler.from_environ()
+        self.prefetcher = prefetcher
+        self.export_token = export_token
 
         # Add requests
         self.add_request(chisel.DocAction())
+        self.add_request(pypi_root_index)
         self.add_request(pypi_index)
+        self.add_request(pypi_index_batch)
         self.add_request(pypi_download)
         self.add_request(pypi_upload)
+        self.add_request(pypi_export)
+
+    def __call__(self, environ, start_response):
+
+        # Profile the request?
+        if self.profiler is None or not self.profiler.is_profiled(environ):
+            return chisel.Application.__call__(self, environ, start_response)
+        return self.profiler.profile(partial(chisel.Application.__call__, self), environ, start_response, self._request_tags)
+
+    def _request_tags(self, environ):
+
+        # Identify the action from the matched URL arguments
+        ctx = environ.get(chisel.Application.ENVIRON_CTX)
+        url_args = (ctx.url_args if ctx is not None else None) or {}
+        if 'filename' in url_args:
+            action = 'pypi_download'
+        elif 'package_name' in url_args:
+            action = 'pypi_index'
+        elif environ.get('PATH_INFO', '').rstrip('/') == '/simple-batch':
+            action = 'pypi_index_batch'
+        elif environ.get('PATH_INFO', '').rstrip('/') == '/export':
+            action = 'pypi_export'
+        elif environ.get('PATH_INFO', '').rstrip('/') == '/simple':
+            action = 'pypi_upload' if environ.get('REQUEST_METHOD') == 'POST' else 'pypi_root_index'
+        else:
+            action = 'other'
+        return (action, url_args.get('package_name', ''), self.index.__class__.__name__)
 
 
 def normalize_package_name(package_name):
@@ -51,6 +99,52 @@ def normalize_filename(filename):
     return filename.strip()
 
 
+# Number of package links rendered per root index response chunk
+ROOT_INDEX_CHUNK_SIZE = 1000
+
+
+@chisel.action(urls=[('GET', '/simple'),
+                     ('GET', '/simple/')],
+               wsgi_response=True,
+               spec='''\
+# pypi project index page
+action pypi_root_index
+''')
+def pypi_root_index(ctx, dummy_req):
+
+    def render_chunks():
+        return _root_index_chunks(ctx.app.index.get_package_names(ctx))
+
+    # The index generation is the page version - the cached page is reused until a package name is added or removed
+    return ctx.app.page_cache.stream_response(ctx, ('html',), ctx.app.index.get_index_generation(ctx), render_chunks, 'text/html')
+
+
+def _root_index_chunks(package_names):
+
+    # Render the project index incrementally - one response chunk per batch of package links
+    yield b'''\
+<!doctype html>
+<html lang="en">
+  <head>
+    <title>Simple index</title>
+    <meta name="api-version" value="2">
+  </head>
+  <body>
+    <h1>Simple index</h1>'''
+    links = []
+    for package_name in package_names:
+        package_url = '../simple/{0}/'.format(package_name)
+        links.append('\n    <a href={0}>{1}</a><br>'.format(quoteattr(package_url), escape(package_name)))
+        if len(links) >= ROOT_INDEX_CHUNK_SIZE:
+            yield ''.join(links).encode('utf-8')
+            del links[:]
+    if links:
+        yield ''.join(links).encode('utf-8')
+    yield b'''
+  </body>
+</html>'''
+
+
 @chisel.action(urls=[('GET', '/simple/{package_name}'),
                      ('GET', '/simple/{package_name}/')],
                wsgi_response=True,
@@ -65,29 +159,173 @@ def pypi_index(ctx, req):
 
     # Get the package index
     package_name = req.get('package_name')
-    package_index = ctx.app.index.get_package_index(
-        ctx,
-        normalize_package_name(package_name),
-        force_update=req.get('force_update', False))
+    try:
+        package_index = ctx.app.index.get_package_index(
+            ctx,
+            normalize_package_name(package_name),
+            force_update=req.get('force_update', False))
+    except UpstreamUnavailable as exc:
+        return _upstream_unavailable_response(ctx, exc)
     if package_index is None:
         return ctx.response_text('404 Not Found', 'Not Found')
 
-    # Build the package index HTML
+    # The index entries are the page version - the page and its compressed variants are rebuilt only when they change
+    package_index = tuple(sorted(package_index, key=lambda package_entry: (package_entry.version, package_entry.filename)))
+
+    # Negotiate the HTML or PEP 691 JSON response
+    content_type = accept_content_type(ctx.environ.get('HTTP_ACCEPT'), PACKAGE_INDEX_CONTENT_TYPES)
+    if content_type == PACKAGE_INDEX_JSON_CONTENT_TYPE:
+        render = partial(_package_index_json, canonical_package_name(package_name), package_index)
+    else:
+        render = partial(_package_index_html, package_name, package_index)
+    return ctx.app.page_cache.response(ctx, (content_type, package_name), package_index, render, content_type,
+                                       vary='Accept, Accept-Encoding')
+
+
+def _upstream_unavailable_response(ctx, exc):
+
+    # Service unavailable (rather than not found) so that pip retries instead of giving up on the package
+    ctx.log.warning('Upstream unavailable: %s', exc)
+    ctx.start_response('503 Service Unavailable', [('Content-Type', 'text/plain'),
+                                                   ('Retry-After', str(int(exc.retry_after) + 1))])
+    return [b'Service Unavailable']
+
+
+# Package index content types, in server preference order
+PACKAGE_INDEX_JSON_CONTENT_TYPE = 'application/vnd.pypi.simple.v1+json'
+PACKAGE_INDEX_CONTENT_TYPES = (
+    'text/html',
+    'application/vnd.pypi.simple.v1+html',
+    PACKAGE_INDEX_JSON_CONTENT_TYPE
+)
+
+
+def _package_url(package_entry, root='../../'):
+    return '{0}download/{1}/{2}/{3}'.format(root, package_entry.name, package_entry.version, package_entry.filename)
+
+
+def _package_index_html(package_name, package_index):
     root = chisel.Element('html', lang='en')
     head = root.add_child('head')
     head.add_child('title', inline=True).add_child('Links for {0}'.format(package_name), text=True)
     head.add_child('meta', closed=False, _name='api-version', value='2')
     body = root.add_child('body')
     body.add_child('h1', inline=True).add_child('Links for {0}'.format(package_name), text=True)
-    for package_entry in sorted(package_index, key=lambda package_entry: package_entry.version):
-        package_hash = '' if package_entry.hash is None else ('#' + package_entry.hash_name + '=' + package_entry.hash)
-        package_url = '../../download/{0}/{1}/{2}{3}'.format(
-            package_entry.name, package_entry.version, package_entry.filename, package_hash)
-        body.add_child('a', inline=True, href=package_url, rel='internal') \
+    for package_entry in package_index:
+        package_hash_name, package_hash = index_entry_hash(package_entry)
+        package_hash = '' if package_hash is None else ('#' + package_hash_name + '=' + package_hash)
+        body.add_child('a', inline=True, href=_package_url(package_entry) + package_hash, rel='internal') \
             .add_child(package_entry.filename, text=True)
         body.add_child('br', closed=False, indent=False)
+    return root.serialize().encode('utf-8')
+
+
+# PEP 691 JSON API version - version 1.1 (PEP 700) adds the project's versions and each file's size and upload time
+PACKAGE_INDEX_JSON_API_VERSION = '1.1'
+
+
+def _package_index_json(package_name, package_index):
+    package_index_json = _package_index_json_object(package_name, package_index)
+    package_index_json['meta'] = {'api-version': PACKAGE_INDEX_JSON_API_VERSION}
+    return json.dumps(package_index_json, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def _package_index_json_object(package_name, package_index, root='../../'):
+    files = []
+    versions = []
+    for package_entry in package_index:
+        hashes = {}
+        if package_entry.hash is not None:
+            hashes[package_entry.hash_name] = package_entry.hash
+        if package_entry.sha256 is not None:
+            hashes['sha256'] = package_entry.sha256
+        if package_entry.md5 is not None:
+            hashes['md5'] = package_entry.md5
+        package_file = {
+            'filename': package_entry.filename,
+            'url': _package_url(package_entry, root),
+            'hashes': hashes
+        }
+
+        # The size of upstream package files is unknown until they're downloaded
+        if package_entry.size is not None:
+            package_file['size'] = package_entry.size
+        if package_entry.datetime is not None:
+            package_file['upload-time'] = package_entry.datetime.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        files.append(package_file)
+        if package_entry.version not in versions:
+            versions.append(package_entry.version)
+    return {
+        'name': package_name,
+        'versions': versions,
+        'files': files
+    }
+
 
-    return ctx.response_text('200 OK', root.serialize(), content_type='text/html')
+# Maximum number of packages of a batch index request
+INDEX_BATCH_MAX_PACKAGES = 1000
+
+
+@chisel.action(urls=[('POST', '/simple-batch')],
+               wsgi_response=True,
+               spec='''\
+# pypi package index entries of a list of packages, as PEP 691 JSON project objects keyed by the requested names -
+# packages not found are null and the requested names of packages whose upstream is unavailable are listed as
+# "unavailable" (with null projects)
+action pypi_index_batch
+    input
+        string[] package_names
+        optional bool force_update
+''')
+def pypi_index_batch(ctx, req):
+
+    # Get the package indexes in bulk
+    package_names = req['package_names']
+    if len(package_names) > INDEX_BATCH_MAX_PACKAGES:
+        return ctx.response_text('400 Bad Request', 'Too many packages (maximum {0})'.format(INDEX_BATCH_MAX_PACKAGES))
+    try:
+        package_indexes = ctx.app.index.get_package_indexes(
+            ctx,
+            set(normalize_package_name(package_name) for package_name in package_names),
+            force_update=req.get('force_update', False))
+    except UpstreamUnavailable as exc:
+        return _upstream_unavailable_response(ctx, exc)
+
+    # Every package unavailable? Otherwise, serve the available packages.
+    unavailable = {package_name: package_index for package_name, package_index in iteritems(package_indexes)
+                   if isinstance(package_index, UpstreamUnavailable)}
+    if unavailable and len(unavailable) == len(package_indexes):
+        return _upstream_unavailable_response(ctx, next(itervalues(unavailable)))
+    for exc in itervalues(unavailable):
+        ctx.log.warning('Upstream unavailable: %s', exc)
+
+    # Render the PEP 691 JSON project objects - download URLs are relative to the batch URL
+    package_indexes = {package_name: sorted(package_index, key=lambda package_entry: (package_entry.version, package_entry.filename))
+                       for package_name, package_index in iteritems(package_indexes)
+                       if package_index is not None and package_name not in unavailable}
+    projects = {}
+    for package_name in package_names:
+        package_index = package_indexes.get(normalize_package_name(package_name))
+        if package_index is not None:
+            package_index = _package_index_json_object(canonical_package_name(package_name), package_index, root='')
+        projects[package_name] = package_index
+    batch_json = {
+        'meta': {'api-version': PACKAGE_INDEX_JSON_API_VERSION},
+        'projects': projects
+    }
+    if unavailable:
+        batch_json['unavailable'] = sorted(package_name for package_name in package_names
+                                           if normalize_package_name(package_name) in unavailable)
+    content = json.dumps(batch_json, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    ctx.start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(content)))])
+    return [content]
+
+
+# Accepted upload filetypes and their filename extensions
+UPLOAD_FILETYPE_EXTS = {
+    'sdist': SDIST_EXTS,
+    'bdist_wheel': ('.whl',),
+}
 
 
 @chisel.request(urls=[('POST', '/simple'),
@@ -97,24 +335,26 @@ def pypi_upload(environ, dummy_start_response):
     ctx = environ[chisel.Application.ENVIRON_CTX]
 
     # Decode the multipart post
-    ctype, pdict = cgi.parse_header(environ.get('CONTENT_TYPE', ''))
-
-    # Ensure boundary is bytes for Python3
-    boundary = pdict.get('boundary')
-    if boundary is not None:
-        pdict['boundary'] = boundary.encode('ascii')
-
+    ctype, dummy_pdict = cgi.parse_header(environ.get('CONTENT_TYPE', ''))
     if ctype != 'multipart/form-data':
         return ctx.response_text('400 Bad Request', '')
-    parts = cgi.parse_multipart(environ['wsgi.input'], pdict)
+    parts = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ)
+
+    def get_field(key):
+        field = parts[key] if key in parts else None
+        if field is None or isinstance(field, list):
+            return None
+        return field
 
     def get_part(key, strip=True):
-        values = parts.get(key)
-        if values is None or not isinstance(values, list) or len(values) != 1:
+        field = get_field(key)
+        if field is None:
             return None
-        value = values[0]
+        value = field.value
         if strip:
-            value = value.strip().decode('utf-8')
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
+            value = value.strip()
         if len(value) <= 0:
             return None
         return value
@@ -128,12 +368,21 @@ def pypi_upload(environ, dummy_start_response):
         package = get_part('name')
         version = get_part('version')
         content = get_part('content', strip=False)
-        filetype_ext = {'sdist': '.tar.gz'}.get(filetype)
-        if filetype_ext is None or package is None or version is None or content is None:
+        filetype_exts = UPLOAD_FILETYPE_EXTS.get(filetype)
+        if filetype_exts is None or package is None or version is None or content is None:
+            return ctx.response_text('400 Bad Request', '')
+
+        # Use the uploaded filename - sdists may fall back to the conventional filename
+        filename = get_field('content').filename
+        if filename:
+            filename = posixpath.basename(filename.replace('\\', '/'))
+        elif filetype == 'sdist':
+            filename = package + '-' + version + filetype_exts[0]
+        if not filename or not filename.endswith(filetype_exts) or \
+           not package_filename_matches(normalize_filename(filename), package, normalize_version(version)):
             return ctx.response_text('400 Bad Request', '')
 
         # Add the package to the index
-        filename = package + '-' + version + filetype_ext
         result = ctx.app.index.add_package(
             ctx,
             normalize_package_name(package),
@@ -157,16 +406,84 @@ action pypi_download
         string filename
 ''')
 def pypi_download(ctx, req):
+    package_name = normalize_package_name(req['package_name'])
+    version = normalize_version(req['version'])
+    filename = normalize_filename(req['filename'])
+
+    # Serve the package file from the local disk cache, if cached
+    cached_file = ctx.app.index.get_package_file(ctx, package_name, version, filename)
+    if cached_file is not None:
+        response = _cached_file_response(ctx, cached_file)
+        if response is not None:
+            return response
 
     # Get the package stream generator
-    package_stream = ctx.app.index.get_package_stream(
-        ctx,
-        normalize_package_name(req['package_name']),
-        normalize_version(req['version']),
-        normalize_filename(req['filename']))
+    try:
+        package_stream = ctx.app.index.get_package_stream(ctx, package_name, version, filename)
+    except UpstreamUnavailable as exc:
+        return _upstream_unavailable_response(ctx, exc)
+    except PackageHashMismatch:
+        return ctx.response_text('502 Bad Gateway', 'Bad Gateway')
     if package_stream is None:
         return ctx.response_text('404 Not Found', 'Not Found')
 
-    # Stream the package
+    # Stream the package - and prefetch its dependencies once the download completes
     ctx.start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+    if ctx.app.prefetcher is not None:
+        return ctx.app.prefetcher.prefetch_after(ctx, package_stream(), package_name, version, filename)
     return package_stream()
+
+
+@chisel.action(urls=[('GET', '/export')],
+               wsgi_response=True,
+               spec='''\
+# index archive of every index entry and package file, for seeding another node with "--import" - only served if the
+# application has an export token, to requests with the export token header
+action pypi_export
+''')
+def pypi_export(ctx, dummy_req):
+
+    # Exports disabled or not authorized?
+    if ctx.app.export_token is None:
+        return ctx.response_text('404 Not Found', 'Not Found')
+    if not hmac.compare_digest(ctx.environ.get(MrPyPi.EXPORT_TOKEN_ENVIRON, ''), ctx.app.export_token):
+        return ctx.response_text('403 Forbidden', 'Forbidden')
+
+    ctx.start_response('200 OK', [('Content-Type', 'application/x-tar')])
+    return export_archive(ctx, ctx.app.index)
+
+
+# Block size of cached package file responses without a WSGI file wrapper
+CACHED_FILE_BLOCK_SIZE = 65536
+
+
+def _cached_file_response(ctx, cached_file):
+
+    # Offload the file to the front-end server?
+    if cached_file.offload_header is not None:
+        ctx.start_response('200 OK', [('Content-Type', 'application/octet-stream'),
+                                      (cached_file.offload_header, cached_file.offload_value)])
+        return []
+
+    # Open the file - evicted since it was found? If so, return None to stream the package
+    try:
+        cached_stream = open(cached_file.path, 'rb')
+    except IOError:
+        return None
+
+    # Stream the file with the server's file wrapper, if any
+    ctx.start_response('200 OK', [('Content-Type', 'application/octet-stream'),
+                                  ('Content-Length', str(cached_file.size))])
+    file_wrapper = ctx.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        return file_wrapper(cached_stream, CACHED_FILE_BLOCK_SIZE)
+    return _file_blocks(cached_stream)
+
+
+def _file_blocks(file_):
+    with file_:
+        while True:
+            data = file_.read(CACHED_FILE_BLOCK_SIZE)
+            if not data:
+                break
+            yield data
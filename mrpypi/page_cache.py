@@ -0,0 +1,258 @@
+#
+# Copyright (C) 2014-2015 Craig Hobbs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+from collections import OrderedDict
+import threading
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class _GzipCompressor(object):
+    __slots__ = ('_compressor',)
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class _BrotliCompressor(object):
+    __slots__ = ('_compressor',)
+
+    def __init__(self):
+        self._compressor = brotli.Compressor()
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+# Supported content encodings' incremental compressors, in server preference order
+CONTENT_ENCODINGS = OrderedDict()
+if brotli is not None:
+    CONTENT_ENCODINGS['br'] = _BrotliCompressor
+CONTENT_ENCODINGS['gzip'] = _GzipCompressor
+
+
+def compress_chunks(encoding, chunks):
+    """
+    Generate the compressed chunks of a content chunk iterable
+    """
+
+    compressor = CONTENT_ENCODINGS[encoding]()
+    for chunk in chunks:
+        chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def _accept_q_values(accept_header):
+
+    # Parse the acceptable values and their q-values
+    accepted = {}
+    for accept_part in (accept_header or '').split(','):
+        accept_params = accept_part.strip().split(';')
+        accept_value = accept_params[0].strip().lower()
+        accept_q = 1.0
+        for accept_param in accept_params[1:]:
+            param_name, _, param_value = accept_param.partition('=')
+            if param_name.strip().lower() == 'q':
+                try:
+                    accept_q = float(param_value)
+                except ValueError:
+                    accept_q = 0.0
+        if accept_value:
+            accepted[accept_value] = accept_q
+    return accepted
+
+
+def accept_encoding(accept_encoding_header, encodings=CONTENT_ENCODINGS):
+    """
+    Negotiate a content encoding from an Accept-Encoding header - returns None for identity
+    """
+
+    # Choose the acceptable encoding with the highest q-value, breaking ties by server preference
+    accepted = _accept_q_values(accept_encoding_header)
+    best_encoding, best_q = None, 0.0
+    for encoding in encodings:
+        encoding_q = accepted.get(encoding, accepted.get('*', 0.0))
+        if encoding_q > best_q:
+            best_encoding, best_q = encoding, encoding_q
+    return best_encoding
+
+
+def accept_content_type(accept_header, content_types):
+    """
+    Negotiate a content type from an Accept header - the first content type is the default
+    """
+
+    # Choose the acceptable content type with the highest q-value, breaking ties by server preference
+    accepted = _accept_q_values(accept_header)
+    best_content_type, best_q = content_types[0], 0.0
+    for content_type in content_types:
+        content_type_q = accepted.get(content_type)
+        if content_type_q is None:
+            content_type_q = accepted.get(content_type.split('/')[0] + '/*')
+        if content_type_q is None:
+            content_type_q = accepted.get('*/*', 0.0)
+        if content_type_q > best_q:
+            best_content_type, best_q = content_type, content_type_q
+    return best_content_type
+
+
+class CachedPage(object):
+    """
+    A rendered page's content chunks and its compressed variants, each built at most once
+    """
+
+    __slots__ = ('version', 'content_type', 'compress', '_encoded')
+
+    def __init__(self, version, chunks, content_type, compress=True):
+        self.version = version
+        self.content_type = content_type
+        self.compress = compress
+        self._encoded = {None: chunks}
+
+    def encoded(self, encoding):
+        """
+        Return the (encoding, chunks) tuple for the negotiated encoding - encoding is None for identity
+        """
+
+        if encoding is None or not self.compress:
+            return None, self._encoded[None]
+        chunks = self._encoded.get(encoding)
+        if chunks is None:
+            chunks = self._encoded[encoding] = list(compress_chunks(encoding, self._encoded[None]))
+        return encoding, chunks
+
+    def set_encoded(self, encoding, chunks):
+        self._encoded[encoding] = chunks
+
+
+class PageCache(object):
+    """
+    LRU cache of rendered pages, each validated against the version of the data it was rendered from
+    """
+
+    __slots__ = ('_pages', '_lock', 'max_pages', 'min_compress_size')
+
+    def __init__(self, max_pages=1000, min_compress_size=1024):
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_pages = max_pages
+        self.min_compress_size = min_compress_size
+
+    def _get(self, key, version):
+        with self._lock:
+            page = self._pages.pop(key, None)
+            if page is None or page.version != version:
+                return None
+            self._pages[key] = page
+            return page
+
+    def _set(self, key, page):
+        with self._lock:
+            self._pages.pop(key, None)
+            self._pages[key] = page
+            while len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+
+    def get(self, key, version, render, content_type):
+        """
+        Get the cached page for the key, calling render() if the cached page is missing or out-of-date
+        """
+
+        page = self._get(key, version)
+        if page is None:
+            content = render()
+            page = CachedPage(version, [content], content_type, compress=len(content) >= self.min_compress_size)
+            self._set(key, page)
+        return page
+
+    @staticmethod
+    def _start_response(ctx, content_type, encoding, content_length=None, vary='Accept-Encoding'):
+        headers = [
+            ('Content-Type', content_type),
+            ('Vary', vary)
+        ]
+        if content_length is not None:
+            headers.append(('Content-Length', str(content_length)))
+        if encoding is not None:
+            headers.append(('Content-Encoding', encoding))
+        ctx.start_response('200 OK', headers)
+
+    def response(self, ctx, key, version, render, content_type, vary='Accept-Encoding'):
+        """
+        Start the response for the cached page using the request's negotiated content encoding
+        """
+
+        page = self.get(key, version, render, content_type)
+        encoding, chunks = page.encoded(accept_encoding(ctx.environ.get('HTTP_ACCEPT_ENCODING')))
+        self._start_response(ctx, page.content_type, encoding, sum(len(chunk) for chunk in chunks), vary=vary)
+        return chunks
+
+    def stream_response(self, ctx, key, version, render_chunks, content_type):
+        """
+        Start the response for a page rendered incrementally by the render_chunks() generator. On a cache miss, the
+        chunks (compressed as they are rendered, if negotiated) are streamed to the client and cached once complete.
+        """
+
+        encoding = accept_encoding(ctx.environ.get('HTTP_ACCEPT_ENCODING'))
+        page = self._get(key, version)
+        if page is not None:
+            encoding, chunks = page.encoded(encoding)
+            self._start_response(ctx, page.content_type, encoding, sum(len(chunk) for chunk in chunks))
+            return chunks
+
+        self._start_response(ctx, content_type, encoding)
+        return self._stream_and_cache(key, version, render_chunks, content_type, encoding)
+
+    def _stream_and_cache(self, key, version, render_chunks, content_type, encoding):
+        identity_chunks = []
+        encoded_chunks = []
+
+        def tee_identity_chunks():
+            for chunk in render_chunks():
+                identity_chunks.append(chunk)
+                yield chunk
+
+        for chunk in (tee_identity_chunks() if encoding is None else compress_chunks(encoding, tee_identity_chunks())):
+            if encoding is not None:
+                encoded_chunks.append(chunk)
+            yield chunk
+
+        # The page is only cached once it has been rendered completely
+        page = CachedPage(version, identity_chunks, content_type)
+        if encoding is not None:
+            page.set_encoded(encoding, encoded_chunks)
+        self._set(key, page)
@@ -0,0 +1,276 @@
+#
+# Copyright (C) 2014-2015 Craig Hobbs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+from email.parser import HeaderParser
+from io import BytesIO
+import re
+import tarfile
+import threading
+import time
+import zipfile
+
+from .compat import queue_Full, queue_Queue
+from .index_util import SDIST_EXTS, WHEEL_EXT, background_context, canonical_package_name
+
+
+class DependencyPrefetcher(object):
+    """
+    Speculative dependency prefetch - after a package file is downloaded, its requirements are read from the archive's
+    metadata and the index and a package file of each requirement are warmed in the background, so pip's requests
+    for the dependencies that follow are local hits.
+
+    Work is queued on a bounded queue (full queues drop work) and done by a fixed number of worker threads. Dependencies
+    are followed to the maximum depth and each dependency is prefetched at most once per refresh interval.
+    """
+
+    __slots__ = ('index', 'workers', 'max_depth', 'max_archive_bytes', 'refresh_seconds', '_queue', '_prefetched',
+                 '_prefetched_lock', '_started', '_started_lock', '_ctx')
+
+    # Maximum number of prefetched package names remembered
+    MAX_PREFETCHED = 10000
+
+    def __init__(self, index, workers=2, max_depth=1, max_queue=100, max_archive_bytes=50 * 1024 * 1024, refresh_seconds=3600):
+        self.index = index
+        self.workers = workers
+        self.max_depth = max_depth
+        self.max_archive_bytes = max_archive_bytes
+        self.refresh_seconds = refresh_seconds
+        self._queue = queue_Queue(max_queue)
+        self._prefetched = {}
+        self._prefetched_lock = threading.Lock()
+        self._started = False
+        self._started_lock = threading.Lock()
+        self._ctx = None
+
+    def prefetch_after(self, ctx, package_chunks, package_name, version, filename):
+        """
+        Generate the package file chunks, then prefetch the package's dependencies once the download completes
+        """
+
+        try:
+            for data in package_chunks:
+                yield data
+        finally:
+            package_chunks_close = getattr(package_chunks, 'close', None)
+            if package_chunks_close is not None:
+                package_chunks_close()
+
+        # The prefetch outlives the request - queue it with the prefetcher's background context
+        if self._ctx is None:
+            self._ctx = background_context(ctx)
+        self._enqueue(self._ctx, ('archive', package_name, version, filename, 0))
+
+    def join(self):
+        """
+        Wait until all queued work is done
+        """
+
+        self._queue.join()
+
+    def _enqueue(self, ctx, item):
+        self._start()
+        try:
+            self._queue.put_nowait((ctx, item))
+        except queue_Full:
+            ctx.log.info('Prefetch queue full - dropped %r', item)
+
+    def _start(self):
+        with self._started_lock:
+            if self._started:
+                return
+            self._started = True
+        for dummy_worker in range(self.workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+    def _worker(self):
+        while True:
+            ctx, item = self._queue.get()
+            try:
+                if item[0] == 'archive':
+                    self._prefetch_archive(ctx, *item[1:])
+                else:
+                    self._prefetch_dependency(ctx, *item[1:])
+            except Exception as exc: # pylint: disable=broad-except
+                ctx.log.warning('Prefetch of %r failed: %s', item, exc)
+            finally:
+                self._queue.task_done()
+
+    def _prefetch_archive(self, ctx, package_name, version, filename, depth):
+
+        # Dependencies beyond the maximum depth aren't prefetched
+        if depth >= self.max_depth:
+            return
+
+        # Read the package file - it's local, having just been downloaded or prefetched
+        package_stream = self.index.get_package_stream(ctx, package_name, version, filename)
+        if package_stream is None:
+            return
+        chunks = []
+        size = 0
+        for data in package_stream():
+            size += len(data)
+            if size > self.max_archive_bytes:
+                return
+            chunks.append(data)
+
+        # Queue each requirement not recently prefetched
+        now = time.time()
+        for requirement_name, specifier in package_requirements(filename, b''.join(chunks)):
+            dependency_name = canonical_package_name(requirement_name)
+            with self._prefetched_lock:
+                prefetched = self._prefetched.get(dependency_name)
+                if prefetched is not None and now - prefetched < self.refresh_seconds:
+                    continue
+                if len(self._prefetched) >= self.MAX_PREFETCHED:
+                    self._prefetched.clear()
+                self._prefetched[dependency_name] = now
+            self._enqueue(ctx, ('dependency', dependency_name, specifier, depth + 1))
+
+    def _prefetch_dependency(self, ctx, package_name, specifier, depth):
+
+        # Warm the package index
+        package_index = self.index.get_package_index(ctx, package_name)
+        if package_index is None:
+            return
+
+        # Warm the package file pip is most likely to choose
+        index_entry = prefetch_index_entry(package_index, specifier)
+        if index_entry is None:
+            return
+        ctx.log.info('Prefetching package "%s", version "%s" with filename "%s"', package_name, index_entry.version, index_entry.filename)
+        package_stream = self.index.get_package_stream(ctx, package_name, index_entry.version, index_entry.filename)
+        if package_stream is None:
+            return
+        for dummy_data in package_stream():
+            pass
+
+        # Follow the dependency's dependencies
+        self._enqueue(ctx, ('archive', package_name, index_entry.version, index_entry.filename, depth))
+
+
+def prefetch_index_entry(package_index, specifier):
+    """
+    Return the index entry to prefetch for a requirement - a platform-independent wheel, otherwise a source
+    distribution, of the latest version that satisfies the requirement's version specifier
+    """
+
+    from pip._vendor.packaging.specifiers import InvalidSpecifier, SpecifierSet
+    from pip._vendor.packaging.version import parse as parse_version
+
+    # Group the prefetchable package files by version
+    version_entries = {}
+    for index_entry in package_index:
+        if index_entry.filename.endswith('-none-any' + WHEEL_EXT):
+            rank = 0
+        elif index_entry.filename.endswith(SDIST_EXTS):
+            rank = 1
+        else:
+            continue
+        version_entries.setdefault(index_entry.version, []).append((rank, index_entry.filename, index_entry))
+    if not version_entries:
+        return None
+
+    # The latest version satisfying the specifier
+    try:
+        versions = list(SpecifierSet(specifier).filter(version_entries))
+    except InvalidSpecifier:
+        versions = list(version_entries)
+    if not versions:
+        return None
+    return min(version_entries[max(versions, key=parse_version)])[2]
+
+
+def package_requirements(filename, content):
+    """
+    Return the (name, version specifier) tuples of the unconditional requirements in a package file's metadata -
+    wheel METADATA, or source distribution PKG-INFO and egg-info requires.txt. Requirements of extras are skipped.
+    """
+
+    try:
+        if filename.endswith(WHEEL_EXT):
+            with zipfile.ZipFile(BytesIO(content)) as archive:
+                metadata = _archive_member(archive.namelist(), _WHEEL_METADATA_RE, archive.read)
+                return _metadata_requirements(metadata) if metadata is not None else []
+        if filename.endswith('.zip'):
+            with zipfile.ZipFile(BytesIO(content)) as archive:
+                return _sdist_requirements(archive.namelist(), archive.read)
+        if filename.endswith(SDIST_EXTS):
+            with tarfile.open(fileobj=BytesIO(content), mode='r:*') as archive:
+                return _sdist_requirements(archive.getnames(), lambda name: archive.extractfile(name).read())
+    except (tarfile.TarError, zipfile.BadZipfile, KeyError, IOError, EOFError):
+        pass
+    return []
+
+_WHEEL_METADATA_RE = re.compile(r'^[^/]+\.dist-info/METADATA$')
+_SDIST_PKG_INFO_RE = re.compile(r'^[^/]+/PKG-INFO$')
+_SDIST_REQUIRES_RE = re.compile(r'^[^/]+/(?:src/)?[^/]+\.egg-info/requires\.txt$')
+
+
+def _archive_member(names, name_re, read):
+    name = next((name for name in names if name_re.match(name)), None)
+    return read(name).decode('utf-8', 'replace') if name is not None else None
+
+
+def _sdist_requirements(names, read):
+
+    # Metadata 2.1+ PKG-INFO has the requirements - otherwise use setuptools' requires.txt
+    pkg_info = _archive_member(names, _SDIST_PKG_INFO_RE, read)
+    requirements = _metadata_requirements(pkg_info) if pkg_info is not None else []
+    if requirements:
+        return requirements
+    requires_txt = _archive_member(names, _SDIST_REQUIRES_RE, read)
+    return _requires_txt_requirements(requires_txt) if requires_txt is not None else []
+
+
+def _metadata_requirements(metadata):
+    requirements = []
+    for requirement in HeaderParser().parsestr(metadata).get_all('Requires-Dist') or ():
+        requirement = _parse_requirement(requirement)
+        if requirement is not None:
+            requirements.append(requirement)
+    return requirements
+
+
+def _requires_txt_requirements(requires_txt):
+
+    # Only the requirements before the first "[extra]" or "[:marker]" section are unconditional
+    requirements = []
+    for line in requires_txt.splitlines():
+        line = line.strip()
+        if line.startswith('['):
+            break
+        requirement = _parse_requirement(line) if line and not line.startswith('#') else None
+        if requirement is not None:
+            requirements.append(requirement)
+    return requirements
+
+
+def _parse_requirement(requirement):
+    match = _REQUIREMENT_RE.match(requirement)
+    if match is None or (match.group('marker') and 'extra' in match.group('marker')):
+        return None
+    return match.group('name'), match.group('specifier').replace(' ', '')
+
+_REQUIREMENT_RE = re.compile(r'^\s*(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?'
+                             r'\s*\(?(?P<specifier>[^;()]*)\)?\s*(?:;(?P<marker>.*))?$')
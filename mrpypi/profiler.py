@@ -0,0 +1,114 @@
+#
+# Copyright (C) 2014-2015 Craig Hobbs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import cProfile
+import itertools
+import os
+import random
+import re
+import time
+
+
+class RequestProfiler(object):
+    """
+    Per-request cProfile hook - requests are profiled if they carry the admin profile header with the configured token,
+    or at random with the sample rate. Each profile is written to the profile directory as a pstats file named with the
+    request's tags.
+    """
+
+    __slots__ = ('profile_dir', 'sample_rate', 'token', '_counter')
+
+    # Admin request header (X-MrPyPi-Profile) that triggers profiling when it matches the token
+    HEADER_ENVIRON = 'HTTP_X_MRPYPI_PROFILE'
+
+    # Environment variables that enable profiling for the process
+    ENV_PROFILE_DIR = 'MRPYPI_PROFILE_DIR'
+    ENV_SAMPLE_RATE = 'MRPYPI_PROFILE_RATE'
+    ENV_TOKEN = 'MRPYPI_PROFILE_TOKEN'
+
+    def __init__(self, profile_dir, sample_rate=0.0, token=None):
+        self.profile_dir = profile_dir
+        self.sample_rate = sample_rate
+        self.token = token
+        self._counter = itertools.count()
+
+    @classmethod
+    def from_environ(cls, environ=None):
+        """
+        Create the profiler configured by environment variables - returns None if profiling isn't enabled
+        """
+
+        if environ is None:
+            environ = os.environ
+        profile_dir = environ.get(cls.ENV_PROFILE_DIR)
+        if not profile_dir:
+            return None
+        return cls(profile_dir, sample_rate=float(environ.get(cls.ENV_SAMPLE_RATE, '0')), token=environ.get(cls.ENV_TOKEN) or None)
+
+    def is_profiled(self, environ):
+        if self.token is not None and environ.get(self.HEADER_ENVIRON) == self.token:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def profile(self, application, environ, start_response, request_tags):
+        """
+        Call the WSGI application with profiling, including the iteration of its response. The profile is written once
+        the response is complete, tagged with request_tags(environ).
+        """
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            response = application(environ, start_response)
+        finally:
+            profile.disable()
+        return self._profile_response(profile, response, environ, request_tags)
+
+    def _profile_response(self, profile, response, environ, request_tags):
+        try:
+            response_iter = iter(response)
+            while True:
+                profile.enable()
+                try:
+                    chunk = next(response_iter)
+                except StopIteration:
+                    break
+                finally:
+                    profile.disable()
+                yield chunk
+        finally:
+            response_close = getattr(response, 'close', None)
+            if response_close is not None:
+                response_close()
+            self._dump(profile, request_tags(environ))
+
+    def _dump(self, profile, tags):
+        try:
+            os.makedirs(self.profile_dir)
+        except OSError:
+            if not os.path.isdir(self.profile_dir):
+                raise
+        profile_name = '-'.join([str(int(time.time() * 1000)), str(os.getpid()), str(next(self._counter))] +
+                                [_PROFILE_NAME_RE.sub('_', str(tag)) for tag in tags])
+        profile.dump_stats(os.path.join(self.profile_dir, profile_name + '.prof'))
+
+_PROFILE_NAME_RE = re.compile(r'[^A-Za-z0-9_.]+')
@@ -0,0 +1,446 @@
+#
+# Copyright (C) 2014-2015 Craig Hobbs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+from contextlib import contextmanager
+from datetime import datetime
+import os
+import tempfile
+import threading
+
+from .compat import iteritems, itervalues
+from .disk_cache import CachedFile
+from .index_util import IndexEntry, DEFAULT_PIP_INDEX, PackageDigest, PackageHashMismatch, UpstreamValidators, parallel_map, \
+    pip_package_versions_conditional, upstream_package_chunks, upstream_update_errors
+from .upstream import UpstreamUnavailable, upstream_session
+
+
+_SCHEMA = '''\
+CREATE TABLE IF NOT EXISTS package_index (
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    hash TEXT,
+    hash_name TEXT,
+    url TEXT,
+    datetime TEXT,
+    sha256 TEXT,
+    md5 TEXT,
+    size INTEGER,
+    PRIMARY KEY (name, version, filename)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS package_upstream (
+    name TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    datetime TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS generation (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    generation INTEGER NOT NULL
+);
+'''
+
+_COLUMNS = 'name, version, filename, hash, hash_name, url, datetime, sha256, md5, size'
+
+_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+class SQLiteIndex(object):
+    """
+    SQLite package index, shared by the processes of a host (pre-forked workers, for example). The database is in WAL
+    mode so readers never block and writes are serialized by SQLite's write lock. Index entries are keyed by
+    (name, version, filename), so lookups are primary key point queries. Package file content is kept in a
+    content-addressed directory of files named by their SHA-256.
+    """
+
+    __slots__ = ('database_path', 'blob_dir', 'index_url', '_local')
+
+    # Seconds to wait for another process's write lock
+    BUSY_TIMEOUT = 30.0
+
+    STREAM_CHUNK_SIZE = 65536
+
+    # Maximum variables of a statement - SQLite's default limit is 999
+    MAX_VARIABLES = 500
+
+    def __init__(self, database_path, blob_dir=None, index_url=DEFAULT_PIP_INDEX):
+        self.database_path = database_path
+        self.blob_dir = blob_dir if blob_dir is not None else database_path + '-blobs'
+        self.index_url = index_url
+        self._local = threading.local()
+
+    def _connection(self):
+
+        # Each thread of each process has its own connection - sqlite3 connections can't be shared by threads or forks
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            import sqlite3
+            connection = sqlite3.connect(self.database_path, timeout=self.BUSY_TIMEOUT, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(_SCHEMA)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def _write(self):
+
+        # Write transactions take the database write lock up front
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    @staticmethod
+    def _index_entry(row):
+        return IndexEntry(name=row[0],
+                          version=row[1],
+                          filename=row[2],
+                          hash=row[3],
+                          hash_name=row[4],
+                          url=row[5],
+                          datetime=datetime.strptime(row[6], _DATETIME_FORMAT) if row[6] is not None else None,
+                          sha256=row[7],
+                          md5=row[8],
+                          size=row[9])
+
+    @staticmethod
+    def _row(index_entry):
+        return index_entry._replace(datetime=index_entry.datetime.strftime(_DATETIME_FORMAT)
+                                    if index_entry.datetime is not None else None)
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256[:2], sha256)
+
+    def _blob_writer(self):
+        try:
+            os.makedirs(self.blob_dir)
+        except OSError:
+            if not os.path.isdir(self.blob_dir):
+                raise
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.blob_dir, prefix='.tmp-')
+        return os.fdopen(file_descriptor, 'wb'), temp_path
+
+    def _blob_commit(self, temp_path, sha256):
+
+        # Content-addressed - an existing blob has the same content
+        blob_path = self._blob_path(sha256)
+        if os.path.exists(blob_path):
+            os.remove(temp_path)
+            return
+        try:
+            os.makedirs(os.path.dirname(blob_path))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(blob_path)):
+                raise
+        os.rename(temp_path, blob_path)
+
+    def _insert_entries(self, index_entries):
+
+        # Insert the new index entries - a new package name changes the index generation
+        with self._write() as connection:
+            package_names = set(index_entry.name for index_entry in index_entries)
+            new_names = [package_name for package_name in package_names if connection.execute(
+                'SELECT 1 FROM package_index WHERE name = ? LIMIT 1', (package_name,)).fetchone() is None]
+            total_changes = connection.total_changes
+            connection.executemany('INSERT OR IGNORE INTO package_index ({0}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(_COLUMNS),
+                                   [self._row(index_entry) for index_entry in index_entries])
+            inserted = connection.total_changes - total_changes
+            if inserted and any(connection.execute('SELECT 1 FROM package_index WHERE name = ? LIMIT 1', (package_name,)).fetchone()
+                                for package_name in new_names):
+                connection.execute('INSERT OR IGNORE INTO generation (id, generation) VALUES (0, 0)')
+                connection.execute('UPDATE generation SET generation = generation + 1 WHERE id = 0')
+        return inserted
+
+    def _select_package_index(self, package_name):
+        return {row[2]: self._index_entry(row) for row in self._connection().execute(
+            'SELECT {0} FROM package_index WHERE name = ?'.format(_COLUMNS), (package_name,))}
+
+    def _select_index_entry(self, package_name, version, filename):
+        row = self._connection().execute('SELECT {0} FROM package_index WHERE name = ? AND version = ? AND filename = ?'.format(_COLUMNS),
+                                         (package_name, version, filename)).fetchone()
+        return self._index_entry(row) if row is not None else None
+
+    def get_package_index(self, ctx, package_name, force_update=False):
+
+        # Index out-of-date?
+        package_index = self._select_package_index(package_name)
+        if not package_index or force_update:
+            self._update_package_index(ctx, package_name, package_index)
+
+        if not package_index:
+            return None
+        return itervalues(package_index)
+
+    def get_package_indexes(self, ctx, package_names, force_update=False):
+
+        # Read the index entries of all packages with one query per batch of names
+        package_names = list(package_names)
+        package_indexes = {package_name: {} for package_name in package_names}
+        unique_names = sorted(package_indexes)
+        for ix_names in range(0, len(unique_names), self.MAX_VARIABLES):
+            batch_names = unique_names[ix_names:ix_names + self.MAX_VARIABLES]
+            for row in self._connection().execute('SELECT {0} FROM package_index WHERE name IN ({1})'.format(
+                    _COLUMNS, ', '.join('?' * len(batch_names))), batch_names):
+                package_indexes[row[0]][row[2]] = self._index_entry(row)
+
+        # Update out-of-date packages from the upstream pypi index in parallel
+        update_names = sorted(package_name for package_name, package_index in iteritems(package_indexes)
+                              if not package_index or force_update)
+        update_errors = upstream_update_errors(update_names, parallel_map(
+            lambda package_name: self._update_package_index(ctx, package_name, package_indexes[package_name]), update_names))
+
+        # Return dict of package name to iter of index entry objects - None indicates package not found and an
+        # UpstreamUnavailable exception that the package is unavailable
+        return {package_name: itervalues(package_index) if package_index else update_errors.get(package_name)
+                for package_name, package_index in iteritems(package_indexes)}
+
+    def _update_package_index(self, ctx, package_name, package_index):
+
+        # Upstream pypi index disabled?
+        if self.index_url is None:
+            return
+        ctx.log.info('Updating index for "%s"', package_name)
+        validators = None
+        if package_index:
+            row = self._connection().execute('SELECT etag, last_modified FROM package_upstream WHERE name = ?', (package_name,)).fetchone()
+            validators = UpstreamValidators(etag=row[0], last_modified=row[1]) if row is not None else None
+        try:
+            pip_packages, validators_update = pip_package_versions_conditional(self.index_url, package_name, validators)
+        except UpstreamUnavailable as exc:
+            # Serve the cached index, if any - otherwise the package is unavailable, not missing
+            if not package_index:
+                raise
+            ctx.log.warning('Package versions unavailable for "%s": %s', package_name, exc)
+            return
+        except Exception as exc: # pylint: disable=broad-except
+            ctx.log.warning('Package versions pip exception for "%s": %s', package_name, exc)
+            return
+
+        # Upstream index page not modified since the last refresh? If so, extend the validators' freshness.
+        now = datetime.utcnow().strftime(_DATETIME_FORMAT)
+        if pip_packages is None:
+            ctx.log.info('Index for "%s" not modified', package_name)
+            with self._write() as connection:
+                connection.execute('UPDATE package_upstream SET datetime = ? WHERE name = ?', (now, package_name))
+            return
+        if validators_update is not None:
+            with self._write() as connection:
+                connection.execute('INSERT OR REPLACE INTO package_upstream (name, etag, last_modified, datetime) VALUES (?, ?, ?, ?)',
+                                   (package_name, validators_update.etag, validators_update.last_modified, now))
+        elif validators is not None:
+            with self._write() as connection:
+                connection.execute('DELETE FROM package_upstream WHERE name = ?', (package_name,))
+
+        # Insert any new package files
+        package_index_update = []
+        for pip_package in pip_packages:
+            if pip_package.link.filename not in package_index:
+                index_entry = IndexEntry(name=package_name,
+                                         version=pip_package.version,
+                                         filename=pip_package.link.filename,
+                                         hash=pip_package.link.hash,
+                                         hash_name=pip_package.link.hash_name,
+                                         url=pip_package.link.url,
+                                         datetime=None,
+                                         sha256=None,
+                                         md5=None,
+                                         size=None)
+                package_index[index_entry.filename] = index_entry
+                package_index_update.append(index_entry)
+        if package_index_update:
+            self._insert_entries(package_index_update)
+
+    def get_index_generation(self, ctx): # pylint: disable=unused-argument
+
+        # The generation changes only when a package name is added or removed
+        row = self._connection().execute('SELECT generation FROM generation WHERE id = 0').fetchone()
+        return row[0] if row is not None else 0
+
+    def get_package_names(self, ctx): # pylint: disable=unused-argument
+
+        # Stream the distinct package names in primary key order
+        for row in self._connection().execute('SELECT DISTINCT name FROM package_index ORDER BY name'):
+            yield row[0]
+
+    def add_package(self, ctx, package_name, version, filename, content):
+
+        # Existing package file? If so, return False to indicate failure
+        if self._select_index_entry(package_name, version, filename) is not None:
+            ctx.log.info('Attempt to re-add package "%s", version "%s" with filename "%s"', package_name, version, filename)
+            return False
+
+        # Write the content-addressed package file, then add the index entry
+        digest = PackageDigest()
+        digest.update(content)
+        blob_file, temp_path = self._blob_writer()
+        with blob_file:
+            blob_file.write(content)
+        self._blob_commit(temp_path, digest.hexdigest('sha256'))
+        index_entry = IndexEntry(name=package_name,
+                                 version=version,
+                                 filename=filename,
+                                 hash=digest.hexdigest('sha256'),
+                                 hash_name='sha256',
+                                 url=None,
+                                 datetime=datetime.utcnow(),
+                                 sha256=digest.hexdigest('sha256'),
+                                 md5=digest.hexdigest('md5'),
+                                 size=digest.size)
+        if not self._insert_entries([index_entry]):
+            ctx.log.info('Attempt to re-add package "%s", version "%s" with filename "%s"', package_name, version, filename)
+            return False
+        ctx.log.info('Adding package "%s", version "%s" with filename "%s" of %d bytes', package_name, version, filename, len(content))
+        return True
+
+    def get_package_file(self, ctx, package_name, version, filename): # pylint: disable=unused-argument
+
+        # Package file content is a file in the blob directory
+        index_entry = self._select_index_entry(package_name, version, filename)
+        if index_entry is None or index_entry.sha256 is None:
+            return None
+        blob_path = self._blob_path(index_entry.sha256)
+        try:
+            return CachedFile(blob_path, os.stat(blob_path).st_size, None, None)
+        except OSError:
+            return None
+
+    def get_package_stream(self, ctx, package_name, version, filename):
+
+        # Find the package index entry - update from the upstream pypi index, if necessary
+        index_entry = self._select_index_entry(package_name, version, filename)
+        if index_entry is None:
+            package_index = self.get_package_index(ctx, package_name) or ()
+            index_entry = next((pe for pe in package_index if pe.filename == filename), None)
+            if index_entry is None or index_entry.version != version:
+                return None
+
+        # Stored package file?
+        blob_path = self._blob_path(index_entry.sha256) if index_entry.sha256 is not None else None
+        if blob_path is not None and os.path.exists(blob_path):
+            def package_stream_blob():
+                with open(blob_path, 'rb') as blob_file:
+                    while True:
+                        data = blob_file.read(self.STREAM_CHUNK_SIZE)
+                        if not data:
+                            break
+                        yield data
+            return package_stream_blob
+        if index_entry.url is None:
+            return None
+
+        # Start the download before the response starts, so an unavailable or overloaded upstream fails fast
+        ctx.log.info('Downloading package (%s, %s, %s) from "%s"', package_name, version, filename, index_entry.url)
+        upstream_session().check_available(index_entry.url)
+        chunks = upstream_package_chunks(index_entry.url)
+
+        # Stream each chunk to the client and the blob directory as it arrives
+        def package_stream():
+            digest = PackageDigest.for_index_entry(index_entry)
+            verified = False
+            blob_file, temp_path = self._blob_writer()
+            try:
+                with blob_file:
+                    for data in chunks:
+                        digest.update(data)
+                        blob_file.write(data)
+                        yield data
+                verified = digest.verify(index_entry)
+            finally:
+                # Only keep the file if the download completed and verified
+                if not verified:
+                    os.remove(temp_path)
+            if not verified:
+                # Abort the response so the client can't mistake the content for a complete download
+                exc = PackageHashMismatch(index_entry)
+                ctx.log.error('%s', exc)
+                raise exc
+
+            # Store the computed digests with the index entry
+            self._blob_commit(temp_path, digest.hexdigest('sha256'))
+            with self._write() as connection:
+                connection.execute('UPDATE package_index SET sha256 = ?, md5 = ?, size = ? WHERE name = ? AND version = ? AND filename = ?',
+                                   (digest.hexdigest('sha256'), digest.hexdigest('md5'), digest.size, package_name, version, filename))
+            ctx.log.info('Added package (%s, %s, %s) (%d bytes)', package_name, version, filename, digest.size)
+
+        return package_stream
+
+    def export_packages(self, ctx): # pylint: disable=unused-argument
+
+        # Generate (index_entry, content_file, content_size) tuples from a single query - content_file is None if the
+        # package file isn't stored
+        for row in self._connection().execute('SELECT {0} FROM package_index ORDER BY name, version, filename'.format(_COLUMNS)):
+            index_entry = self._index_entry(row)
+            try:
+                blob_file = open(self._blob_path(index_entry.sha256), 'rb') if index_entry.sha256 is not None else None
+            except IOError:
+                blob_file = None
+            if blob_file is None:
+                yield index_entry, None, None
+                continue
+            with blob_file:
+                yield index_entry, blob_file, os.fstat(blob_file.fileno()).st_size
+
+    def import_packages(self, ctx, packages, batch_size=100):
+        counts = {'entries': 0, 'files': 0, 'skipped': 0, 'invalid': 0}
+
+        batch = []
+        for index_entry, content_file in packages:
+
+            # Write the package file content to the blob directory, unless it's already stored
+            if content_file is not None and (index_entry.sha256 is None or not os.path.exists(self._blob_path(index_entry.sha256))):
+                digest = PackageDigest.for_index_entry(index_entry)
+                blob_file, temp_path = self._blob_writer()
+                with blob_file:
+                    while True:
+                        data = content_file.read(self.STREAM_CHUNK_SIZE)
+                        if not data:
+                            break
+                        digest.update(data)
+                        blob_file.write(data)
+                if not digest.verify(index_entry):
+                    os.remove(temp_path)
+                    ctx.log.error('%s', PackageHashMismatch(index_entry))
+                    counts['invalid'] += 1
+                    continue
+                self._blob_commit(temp_path, digest.hexdigest('sha256'))
+                index_entry = digest.index_entry(index_entry)
+                counts['files'] += 1
+
+            # Insert the index entries in batches - one write transaction per batch
+            batch.append(index_entry)
+            if len(batch) >= batch_size:
+                self._import_batch(batch, counts)
+                batch = []
+        self._import_batch(batch, counts)
+        return counts
+
+    def _import_batch(self, batch, counts):
+        if batch:
+            inserted = self._insert_entries(batch)
+            counts['entries'] += inserted
+            counts['skipped'] += len(batch) - inserted
@@ -0,0 +1,237 @@
+#
+# Copyright (C) 2014-2015 Craig Hobbs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+from itertools import groupby
+import json
+import os
+import re
+import shutil
+
+from .compat import hashlib_new
+from .index_util import PackageDigest, canonical_package_name
+from .mrpypi import _package_index_html, _root_index_chunks
+
+
+# The manifest of an exported tree - its export number, index generation and package index fingerprints
+MIRROR_MANIFEST = '.mrpypi-mirror.json'
+
+MIRROR_CHUNK_SIZE = 65536
+
+
+def export_static_mirror(ctx, index, mirror_path, download_upstream=True):
+    """
+    Export the index as a static mirror - a directory tree of the URLs MrPyPi serves (simple/index.html,
+    simple/<package>/index.html and download/<package>/<version>/<filename>) for a static file server or CDN. Package
+    pages are written under the package's normalized name, with a link from the index's package name if it differs.
+
+    mirror_path is a symbolic link to the current tree and each export atomically replaces it with a new tree built
+    alongside. Only the pages of packages whose index changed since the last export are rewritten, the root page only if
+    the index generation changed, and everything else is hard-linked from the previous tree. Package files the index
+    doesn't store are downloaded from upstream - or, if download_upstream is False, left off the package pages. Returns
+    the export counts.
+    """
+
+    # Read the previous export's manifest
+    tree_previous = os.path.realpath(mirror_path) if os.path.islink(mirror_path) else None
+    if tree_previous is None and os.path.lexists(mirror_path):
+        raise ValueError('Static mirror path "{0}" is not a symbolic link'.format(mirror_path))
+    manifest_previous = {'export': 0, 'generation': None, 'packages': {}}
+    if tree_previous is not None:
+        try:
+            with open(os.path.join(tree_previous, MIRROR_MANIFEST)) as manifest_file:
+                manifest_previous = json.load(manifest_file)
+        except (IOError, ValueError):
+            ctx.log.warning('Static mirror manifest of "%s" is missing or invalid - rewriting every page', tree_previous)
+
+    # Build the new tree alongside the previous tree
+    export = manifest_previous['export'] + 1
+    while os.path.realpath(_tree_path(mirror_path, export)) == tree_previous:
+        export += 1
+    tree = _tree_path(mirror_path, export)
+    if os.path.exists(tree):
+        shutil.rmtree(tree)
+    os.makedirs(tree)
+    manifest = {'export': export, 'generation': index.get_index_generation(ctx), 'packages': {}}
+    counts = {'packages': 0, 'updated': 0, 'unchanged': 0, 'files': 0, 'missing': 0}
+
+    # Export each package from a single scan of the index - stored package files are copied as they're read. Package
+    # files downloaded from upstream are fetched after the scan, since downloads write to the index.
+    package_names = []
+    page_names = set()
+    package_downloads = []
+    for package_name, package_exports in groupby(index.export_packages(ctx), key=lambda package_export: package_export[0].name):
+        package_names.append(package_name)
+        index_entries = []
+        downloads = []
+        for index_entry, content_file, dummy_content_size in package_exports:
+            if _export_package_file(tree, tree_previous, index_entry, content_file, counts):
+                index_entries.append(index_entry)
+            elif download_upstream and index_entry.url is not None:
+                downloads.append(len(index_entries))
+                index_entries.append(index_entry)
+            else:
+                counts['missing'] += 1
+                index_entries.append(None)
+        if downloads:
+            package_downloads.append((package_name, index_entries, downloads))
+        else:
+            _export_package_page(ctx, tree, tree_previous, manifest, manifest_previous, page_names, package_name, index_entries, counts)
+
+    # Download the package files from upstream, then export their package pages
+    for package_name, index_entries, downloads in package_downloads:
+        for ix_entry in downloads:
+            index_entries[ix_entry] = _download_package_file(ctx, index, tree, index_entries[ix_entry], counts)
+        _export_package_page(ctx, tree, tree_previous, manifest, manifest_previous, page_names, package_name, index_entries, counts)
+
+    # The root page changes only when a package name is added or removed
+    root_path = os.path.join('simple', 'index.html')
+    if manifest['generation'] != manifest_previous['generation'] or not _link_previous(tree, tree_previous, root_path):
+        _write_chunks(os.path.join(tree, root_path), _root_index_chunks(package_names))
+    _write_chunks(os.path.join(tree, MIRROR_MANIFEST), [json.dumps(manifest, sort_keys=True).encode('utf-8')])
+
+    # Atomically replace the mirror symbolic link
+    link_temp = mirror_path + '.link'
+    if os.path.lexists(link_temp):
+        os.remove(link_temp)
+    os.symlink(os.path.basename(tree), link_temp)
+    os.rename(link_temp, mirror_path)
+
+    # Delete the trees before the previous tree - the previous tree may still be serving in-flight requests
+    mirror_dir, mirror_name = os.path.split(os.path.abspath(mirror_path))
+    tree_re = re.compile(r'^' + re.escape(mirror_name) + r'\.\d+$')
+    for tree_name in os.listdir(mirror_dir):
+        tree_old = os.path.realpath(os.path.join(mirror_dir, tree_name))
+        if tree_re.match(tree_name) and tree_old not in (os.path.realpath(tree), tree_previous):
+            shutil.rmtree(tree_old)
+
+    return counts
+
+
+def _tree_path(mirror_path, export):
+    return '{0}.{1}'.format(mirror_path, export)
+
+
+def _package_fingerprint(index_entries):
+    fingerprint = hashlib_new('sha256')
+    for index_entry in sorted(index_entries, key=lambda index_entry: (index_entry.version, index_entry.filename)):
+        index_entry_json = [index_entry.name, index_entry.version, index_entry.filename, index_entry.hash, index_entry.hash_name,
+                            index_entry.sha256, index_entry.md5]
+        fingerprint.update(json.dumps(index_entry_json).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        if not os.path.isdir(os.path.dirname(path)):
+            raise
+
+
+def _link_previous(tree, tree_previous, path):
+
+    # Hard-link the previous tree's file, if any - returns True if linked
+    if tree_previous is None or not os.path.isfile(os.path.join(tree_previous, path)):
+        return False
+    _makedirs(os.path.join(tree, path))
+    os.link(os.path.join(tree_previous, path), os.path.join(tree, path))
+    return True
+
+
+def _write_chunks(path, chunks):
+    _makedirs(path)
+    with open(path, 'wb') as file_:
+        for chunk in chunks:
+            file_.write(chunk)
+
+
+def _export_package_page(ctx, tree, tree_previous, manifest, manifest_previous, page_names, package_name, index_entries, counts):
+
+    # Package index changed? Packages with missing files (None entries) are rewritten by every export until they're complete.
+    fingerprint = _package_fingerprint(index_entries) if None not in index_entries else None
+    manifest['packages'][package_name] = fingerprint
+    counts['packages'] += 1
+
+    # The page is written under the normalized package name - unless another of the index's package names normalizes to
+    # the same name
+    page_name = canonical_package_name(package_name)
+    if page_name in page_names:
+        ctx.log.warning('Static mirror package "%s" has the same normalized name as another package', package_name)
+        page_name = package_name
+    page_names.add(page_name)
+    page_path = os.path.join('simple', page_name, 'index.html')
+    if fingerprint is not None and fingerprint == manifest_previous['packages'].get(package_name) and \
+       _link_previous(tree, tree_previous, page_path):
+        counts['unchanged'] += 1
+    else:
+        index_entries_exported = sorted((index_entry for index_entry in index_entries if index_entry is not None),
+                                        key=lambda index_entry: (index_entry.version, index_entry.filename))
+        _write_chunks(os.path.join(tree, page_path), [_package_index_html(package_name, index_entries_exported)])
+        counts['updated'] += 1
+
+    # Link the index's package name to the normalized name's page
+    if page_name != package_name and not os.path.lexists(os.path.join(tree, 'simple', package_name)):
+        os.symlink(page_name, os.path.join(tree, 'simple', package_name))
+
+
+def _export_package_file(tree, tree_previous, index_entry, content_file, counts):
+
+    # Package files are immutable - link the previously-exported file, if any. Returns True if the package file is
+    # exported.
+    download_path = os.path.join('download', index_entry.name, index_entry.version, index_entry.filename)
+    if _link_previous(tree, tree_previous, download_path):
+        return True
+
+    # Copy the stored package file content
+    if content_file is not None:
+        _write_chunks(os.path.join(tree, download_path), iter(lambda: content_file.read(MIRROR_CHUNK_SIZE), b''))
+        counts['files'] += 1
+        return True
+    return False
+
+
+def _download_package_file(ctx, index, tree, index_entry, counts):
+
+    # Download the package file from upstream - the index stores the downloaded file's digests with its entry. Returns
+    # the exported index entry, or None if the package file is missing.
+    download_path = os.path.join('download', index_entry.name, index_entry.version, index_entry.filename)
+    try:
+        package_stream = index.get_package_stream(ctx, index_entry.name, index_entry.version, index_entry.filename)
+        if package_stream is not None:
+            digest = PackageDigest()
+            _write_chunks(os.path.join(tree, download_path), _digest_chunks(digest, package_stream()))
+            counts['files'] += 1
+            return digest.index_entry(index_entry)
+    except Exception as exc: # pylint: disable=broad-except
+        ctx.log.warning('Static mirror download of (%s, %s, %s) failed: %s', index_entry.name, index_entry.version,
+                        index_entry.filename, exc)
+        if os.path.exists(os.path.join(tree, download_path)):
+            os.remove(os.path.join(tree, download_path))
+
+    counts['missing'] += 1
+    return None
+
+
+def _digest_chunks(digest, chunks):
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
@@ -20,11 +20,48 @@
 # SOFTWARE.
 #
 
+from datetime import datetime
+import hashlib
+import io
+import json
+import os
+import pstats
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
+import zlib
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import urlopen
+except ImportError: # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer # pylint: disable=import-error
+    from SocketServer import ThreadingMixIn # pylint: disable=import-error
+    from urllib2 import urlopen # pylint: disable=import-error
 
 from chisel import Application, Context
 
-from mrpypi import MrPyPi, MemoryIndex
+from mrpypi import ClusterPeers, DependencyPrefetcher, DiskCache, MrPyPi, MemoryIndex, MongoIndex, SQLiteIndex
+from mrpypi.archive import export_archive, import_archive
+from mrpypi.cluster import HashRing
+from mrpypi.index_util import IndexEntry, PackageDigest, PackageHashMismatch, background_context, package_filename_matches, \
+    parallel_map, pip_package_versions, upstream_package_chunks
+from mrpypi.load_test import ReplayRequest, UpstreamStandIn, application_sender, parse_request_log, replay_requests
+from mrpypi.page_cache import accept_content_type, accept_encoding
+from mrpypi.prefetch import package_requirements, prefetch_index_entry
+from mrpypi.profiler import RequestProfiler
+from mrpypi.static_mirror import export_static_mirror
+from mrpypi.upstream import UpstreamAdmission, UpstreamOverloaded, UpstreamSession, UpstreamUnavailable, configure_upstream_admission, \
+    upstream_session
 
 
 class TestMrpypi(unittest.TestCase):
@@ -54,12 +91,53 @@ class TestMrpypi(unittest.TestCase):
   </head>
   <body>
     <h1>Links for package1</h1>
-    <a href="../../download/package1/1.0.0/package1-1.0.0.tar.gz#md5=5f832e6e6b2107ba3b0463fc171623d7" rel="internal">package1-1.0.0.tar.gz</a><br>
-    <a href="../../download/package1/1.0.1/package1-1.0.1.tar.gz#md5=7ff99f5a955518cece354b9a0e94007d" rel="internal">package1-1.0.1.tar.gz</a><br>
+    <a href="../../download/package1/1.0.0/package1-1.0.0.tar.gz#sha256=027c27fc8cb60a5f44e5914e26899d1ddab529e52fc57e8e930041d7998e2fac" rel="internal">package1-1.0.0.tar.gz</a><br>
+    <a href="../../download/package1/1.0.1/package1-1.0.1.tar.gz#sha256=ccfa0969bd944ef581ccd5b66d27f3f90d7365146c9494172a426c0aa3da712b" rel="internal">package1-1.0.1.tar.gz</a><br>
   </body>
 </html>'''
         self.assertEqual(content, expected_content)
 
+    def test_root_index(self):
+
+        ctx = Context(Application(), {}, None, {})
+        index = self._test_index()
+        app = MrPyPi(index)
+        expected_content = b'''\
+<!doctype html>
+<html lang="en">
+  <head>
+    <title>Simple index</title>
+    <meta name="api-version" value="2">
+  </head>
+  <body>
+    <h1>Simple index</h1>
+    <a href="../simple/package1/">package1</a><br>
+    <a href="../simple/package2/">package2</a><br>
+  </body>
+</html>'''
+        for _ in range(2):
+            status, headers, content = app.request('GET', '/simple/')
+            self.assertEqual(status, '200 OK')
+            self.assertTrue(('Content-Type', 'text/html') in headers)
+            self.assertEqual(content, expected_content)
+
+        # New files of existing packages don't change the package names or the generation
+        generation = index.get_index_generation(ctx)
+        index.add_package(ctx, 'package1', '1.0.2', 'package1-1.0.2.tar.gz', b'package1-1.0.2')
+        self.assertEqual(index.get_index_generation(ctx), generation)
+
+        # The cached listing is invalidated when a package name is added
+        index.add_package(ctx, 'package0', '1.0.0', 'package0-1.0.0.tar.gz', b'package0-1.0.0')
+        self.assertNotEqual(index.get_index_generation(ctx), generation)
+        status, headers, content = app.request('GET', '/simple', environ={'HTTP_ACCEPT_ENCODING': 'gzip'})
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(('Content-Type', 'text/html') in headers)
+        self.assertTrue(('Content-Encoding', 'gzip') in headers)
+        self.assertEqual(zlib.decompress(content, 16 + zlib.MAX_WBITS), expected_content.replace(
+            b'    <a href="../simple/package1/">',
+            b'    <a href="../simple/package0/">package0</a><br>\n    <a href="../simple/package1/">'
+        ))
+
     def test_index_unverified(self):
 
         app = MrPyPi(self._test_index())
@@ -75,12 +153,122 @@ class TestMrpypi(unittest.TestCase):
   </head>
   <body>
     <h1>Links for package2</h1>
-    <a href="../../download/package2/1.0.0/package2-1.0.0.tar.gz#md5=e5bb63cbaf57f917dec872455807ea9a" rel="internal">package2-1.0.0.tar.gz</a><br>
-    <a href="../../download/package2/1.0.1/package2-1.0.1.tar.gz#md5=5196a17e0ebf66da9ac16f09a836d60f" rel="internal">package2-1.0.1.tar.gz</a><br>
+    <a href="../../download/package2/1.0.0/package2-1.0.0.tar.gz#sha256=a30cdc13e51df06900621704a6cba5a720b85e1acff4b681fd4260457b68eeed" rel="internal">package2-1.0.0.tar.gz</a><br>
+    <a href="../../download/package2/1.0.1/package2-1.0.1.tar.gz#sha256=d54ee908a17b9a0223f8637a40fd1a29a5b83fc7550e788f10fc11b37ec0ba32" rel="internal">package2-1.0.1.tar.gz</a><br>
   </body>
 </html>'''
         self.assertEqual(content, expected_content)
 
+    def test_index_json(self):
+
+        ctx = Context(Application(), {}, None, {})
+        index = self._test_index()
+        app = MrPyPi(index)
+        status, headers, content = app.request('GET', '/simple/package1/', environ={
+            'HTTP_ACCEPT': 'application/vnd.pypi.simple.v1+json, application/vnd.pypi.simple.v1+html;q=0.2, text/html;q=0.01'
+        })
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(('Content-Type', 'application/vnd.pypi.simple.v1+json') in headers)
+        self.assertTrue(('Vary', 'Accept, Accept-Encoding') in headers)
+        content = json.loads(content.decode('utf-8'))
+        for package_file in content['files']:
+            self.assertTrue(re.match(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{6}Z$', package_file.pop('upload-time')))
+        self.assertEqual(content, {
+            'meta': {'api-version': '1.1'},
+            'name': 'package1',
+            'versions': ['1.0.0', '1.0.1'],
+            'files': [
+                {
+                    'filename': 'package1-1.0.0.tar.gz',
+                    'url': '../../download/package1/1.0.0/package1-1.0.0.tar.gz',
+                    'hashes': {
+                        'sha256': '027c27fc8cb60a5f44e5914e26899d1ddab529e52fc57e8e930041d7998e2fac',
+                        'md5': '5f832e6e6b2107ba3b0463fc171623d7'
+                    },
+                    'size': 14
+                },
+                {
+                    'filename': 'package1-1.0.1.tar.gz',
+                    'url': '../../download/package1/1.0.1/package1-1.0.1.tar.gz',
+                    'hashes': {
+                        'sha256': 'ccfa0969bd944ef581ccd5b66d27f3f90d7365146c9494172a426c0aa3da712b',
+                        'md5': '7ff99f5a955518cece354b9a0e94007d'
+                    },
+                    'size': 14
+                }
+            ]
+        })
+
+        # The cached JSON is invalidated when the package index changes
+        index.add_package(ctx, 'package1', '1.0.2', 'package1-1.0.2.tar.gz', b'package1-1.0.2')
+        status, headers, content = app.request('GET', '/simple/package1/', environ={'HTTP_ACCEPT': 'application/vnd.pypi.simple.v1+json'})
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(('Content-Type', 'application/vnd.pypi.simple.v1+json') in headers)
+        self.assertEqual([package_file['filename'] for package_file in json.loads(content.decode('utf-8'))['files']],
+                         ['package1-1.0.0.tar.gz', 'package1-1.0.1.tar.gz', 'package1-1.0.2.tar.gz'])
+
+        # The JSON name is PEP 503 normalized
+        index.add_package(ctx, 'foo_bar', '1.0.0', 'foo_bar-1.0.0.tar.gz', b'foo_bar-1.0.0')
+        status, headers, content = app.request('GET', '/simple/Foo_Bar/', environ={'HTTP_ACCEPT': 'application/vnd.pypi.simple.v1+json'})
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(json.loads(content.decode('utf-8'))['name'], 'foo-bar')
+
+        # HTML is still the default
+        status, headers, content = app.request('GET', '/simple/package1/', environ={'HTTP_ACCEPT': '*/*'})
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(('Content-Type', 'text/html') in headers)
+
+    def test_accept_content_type(self):
+
+        content_types = ('text/html', 'application/vnd.pypi.simple.v1+html', 'application/vnd.pypi.simple.v1+json')
+        self.assertEqual(accept_content_type(None, content_types), 'text/html')
+        self.assertEqual(accept_content_type('application/xml', content_types), 'text/html')
+        self.assertEqual(accept_content_type('application/vnd.pypi.simple.v1+json', content_types),
+                         'application/vnd.pypi.simple.v1+json')
+        self.assertEqual(accept_content_type('application/*', content_types), 'application/vnd.pypi.simple.v1+html')
+        self.assertEqual(accept_content_type('text/html;q=0.5, application/vnd.pypi.simple.v1+json', content_types),
+                         'application/vnd.pypi.simple.v1+json')
+
+    def test_index_gzip(self):
+
+        ctx = Context(Application(), {}, None, {})
+        index = self._test_index()
+        for version in range(100):
+            index.add_package(ctx, 'package1', '2.0.' + str(version), 'package1-2.0.{0}.tar.gz'.format(version), b'package1')
+        app = MrPyPi(index)
+        status, headers, content = app.request('GET', '/simple/package1')
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(('Content-Type', 'text/html') in headers)
+        self.assertFalse(any(header[0] == 'Content-Encoding' for header in headers))
+
+        status, headers, content_gzip = app.request('GET', '/simple/package1', environ={'HTTP_ACCEPT_ENCODING': 'gzip, deflate'})
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(('Content-Type', 'text/html') in headers)
+        self.assertTrue(('Content-Encoding', 'gzip') in headers)
+        self.assertTrue(('Vary', 'Accept, Accept-Encoding') in headers)
+        self.assertTrue(len(content_gzip) < len(content))
+        self.assertEqual(zlib.decompress(content_gzip, 16 + zlib.MAX_WBITS), content)
+
+        # The compressed page is rebuilt when the package index changes
+        index.add_package(ctx, 'package1', '3.0.0', 'package1-3.0.0.tar.gz', b'package1')
+        status, headers, content_gzip = app.request('GET', '/simple/package1', environ={'HTTP_ACCEPT_ENCODING': 'gzip'})
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(('Content-Encoding', 'gzip') in headers)
+        self.assertTrue(b'package1-3.0.0.tar.gz' in zlib.decompress(content_gzip, 16 + zlib.MAX_WBITS))
+
+    def test_accept_encoding(self):
+
+        encodings = ('br', 'gzip')
+        self.assertEqual(accept_encoding(None, encodings), None)
+        self.assertEqual(accept_encoding('', encodings), None)
+        self.assertEqual(accept_encoding('identity', encodings), None)
+        self.assertEqual(accept_encoding('gzip', encodings), 'gzip')
+        self.assertEqual(accept_encoding('gzip, br', encodings), 'br')
+        self.assertEqual(accept_encoding('gzip;q=1.0, br;q=0.5', encodings), 'gzip')
+        self.assertEqual(accept_encoding('gzip;q=0, deflate', encodings), None)
+        self.assertEqual(accept_encoding('*', encodings), 'br')
+        self.assertEqual(accept_encoding('*;q=0.5, br;q=0', encodings), 'gzip')
+
     def test_index_not_found(self):
 
         app = MrPyPi(self._test_index())
@@ -97,6 +285,1356 @@ class TestMrpypi(unittest.TestCase):
         self.assertTrue(('Content-Type', 'application/octet-stream') in headers)
         self.assertEqual(content, b'package1-1.0.1')
 
+    @staticmethod
+    def _test_upstream_index(content, hash_, hash_name='md5'):
+        temp_dir = tempfile.mkdtemp()
+        upstream_path = os.path.join(temp_dir, 'package4-1.0.0.tar.gz')
+        with open(upstream_path, 'wb') as upstream_file:
+            upstream_file.write(content)
+        index = MemoryIndex(index_url=None)
+        index._index['package4'] = { # pylint: disable=protected-access
+            'package4-1.0.0.tar.gz': IndexEntry(name='package4', version='1.0.0', filename='package4-1.0.0.tar.gz',
+                                hash=hash_, hash_name=hash_name, url='file://' + upstream_path,
+                                datetime=None, sha256=None, md5=None, size=None)
+        }
+        return index, temp_dir
+
+    def test_download_upstream(self):
+
+        content = b'package4-1.0.0' * 10000
+        index, temp_dir = self._test_upstream_index(content, hashlib.md5(content).hexdigest())
+        try:
+            app = MrPyPi(index)
+            generation = index.get_index_generation(None)
+            status, headers, content_download = app.request('GET', '/download/package4/1.0.0/package4-1.0.0.tar.gz')
+            self.assertEqual(status, '200 OK')
+            self.assertTrue(('Content-Type', 'application/octet-stream') in headers)
+            self.assertEqual(content_download, content)
+
+            # Package names are unchanged, so the root index generation is too
+            self.assertEqual(index.get_index_generation(None), generation)
+
+            # The index now advertises the computed SHA-256
+            status, headers, content_index = app.request('GET', '/simple/package4')
+            self.assertEqual(status, '200 OK')
+            self.assertTrue(('#sha256=' + hashlib.sha256(content).hexdigest()).encode('utf-8') in content_index)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_download_upstream_hash_mismatch(self):
+
+        index, temp_dir = self._test_upstream_index(b'package4-1.0.0', hashlib.md5(b'corrupted').hexdigest())
+        try:
+            app = MrPyPi(index)
+            status, headers, content = app.request('GET', '/download/package4/1.0.0/package4-1.0.0.tar.gz')
+            self.assertEqual(status, '502 Bad Gateway')
+            self.assertTrue(('Content-Type', 'text/plain') in headers)
+            self.assertEqual(content, b'Bad Gateway')
+
+            # The corrupt content isn't cached
+            with self.assertRaises(PackageHashMismatch):
+                index.get_package_stream(Context(Application(), {}, None, {}), 'package4', '1.0.0', 'package4-1.0.0.tar.gz')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @staticmethod
+    def _test_upstream_server(statuses, content, content_type='application/octet-stream', delay=0, routes=None, etag=False,
+                              ranges=False):
+        requests = []
+
+        # Respond with each status in turn, then 200 OK with the content - or the (content type, content) of the path's route.
+        # With etag, responses have the ETag of their content and matching conditional requests are 304 Not Modified. With
+        # ranges, byte range requests are 206 Partial Content - unless ranges is "ignore", which responds with all content.
+        class UpstreamHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self): # pylint: disable=invalid-name
+                requests.append((self.path, self.client_address))
+                time.sleep(delay)
+                status = statuses.pop(0) if statuses else 200
+                body_type, body = content_type, content
+                if routes is not None:
+                    body_type, body = routes.get(self.path.rstrip('/'), (content_type, None))
+                    status = status if body is not None else 404
+                body_etag = '"{0}"'.format(hashlib.md5(body).hexdigest()) if etag and body is not None else None
+                if status == 200 and body_etag is not None and self.headers.get('If-None-Match') == body_etag:
+                    status = 304
+                content_range = None
+                range_match = re.match(r'^bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+                if status == 200 and ranges is True and range_match is not None:
+                    status = 206
+                    content_range = 'bytes {0}-{1}/{2}'.format(range_match.group(1), range_match.group(2), len(body))
+                    body = body[int(range_match.group(1)):int(range_match.group(2)) + 1]
+                body = body if status in (200, 206) else b''
+                self.send_response(status)
+                self.send_header('Content-Type', body_type)
+                if body_etag is not None:
+                    self.send_header('ETag', body_etag)
+                if ranges:
+                    self.send_header('Accept-Ranges', 'bytes')
+                if content_range is not None:
+                    self.send_header('Content-Range', content_range)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args): # pylint: disable=arguments-differ
+                pass
+
+        # Keep-alive connections are handled on their own threads so shutdown isn't blocked
+        class UpstreamServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # Clients close responses early (for example, the first response of a ranged download)
+                pass
+
+        server = UpstreamServer(('127.0.0.1', 0), UpstreamHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server, 'http://127.0.0.1:{0}'.format(server.server_port), requests
+
+    def test_index_conditional_refresh(self):
+
+        ctx = Context(Application(), {}, None, {})
+        index_html = b'''\
+<html><body>
+<a href="package5-1.0.0.tar.gz#md5=5f832e6e6b2107ba3b0463fc171623d7">package5-1.0.0.tar.gz</a>
+</body></html>'''
+        index_html_modified = index_html.replace(b'</body>', b'''\
+<a href="package5-1.0.1.tar.gz#md5=7ff99f5a955518cece354b9a0e94007d">package5-1.0.1.tar.gz</a>
+</body>''')
+        routes = {}
+        server, url, requests = self._test_upstream_server([], None, routes=routes, etag=True)
+        temp_dir = tempfile.mkdtemp()
+        try:
+            for index in (MemoryIndex(index_url=url + '/simple'), SQLiteIndex(os.path.join(temp_dir, 'index.db'), index_url=url + '/simple')):
+                routes['/simple/package5'] = ('text/html', index_html)
+                del requests[:]
+
+                # The index page is requested once
+                self.assertEqual([pe.filename for pe in index.get_package_index(ctx, 'package5')], ['package5-1.0.0.tar.gz'])
+                self.assertEqual(len(requests), 1)
+
+                # Refreshes are conditional - the unmodified index is unchanged
+                self.assertEqual([pe.filename for pe in index.get_package_index(ctx, 'package5', force_update=True)],
+                                 ['package5-1.0.0.tar.gz'])
+                self.assertEqual(len(requests), 2)
+
+                # A modified index page is parsed
+                routes['/simple/package5'] = ('text/html', index_html_modified)
+                self.assertEqual(sorted(pe.filename for pe in index.get_package_indexes(ctx, ['package5'], force_update=True)['package5']),
+                                 ['package5-1.0.0.tar.gz', 'package5-1.0.1.tar.gz'])
+                self.assertEqual(sorted(pe.filename for pe in index.get_package_index(ctx, 'package5', force_update=True)),
+                                 ['package5-1.0.0.tar.gz', 'package5-1.0.1.tar.gz'])
+                self.assertEqual(len(requests), 4)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(temp_dir)
+
+    def test_upstream_ranged_download(self):
+
+        content = b''.join(hashlib.sha256(str(ix).encode('utf-8')).digest() for ix in range(5000))
+        ranged_tests = ((True, 1000, 4), ('ignore', 1000, 4), (False, 1000, 1), (True, len(content) + 1, 1))
+        for ranges, ranged_min_size, request_count in ranged_tests:
+            server, url, requests = self._test_upstream_server([], content, ranges=ranges, delay=0.05)
+            try:
+                chunks = upstream_package_chunks(url + '/package4-1.0.0.tar.gz', chunk_size=4096, session=UpstreamSession(),
+                                                 ranged_min_size=ranged_min_size, ranged_segments=4)
+                self.assertEqual(b''.join(chunks), content)
+                self.assertEqual(len(requests), request_count)
+                if request_count > 1:
+                    self.assertTrue(len(set(address for dummy_path, address in requests)) >= 2)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+        # Each segment takes an admission slot - fewer segments are downloaded if slots aren't free
+        admission_previous = configure_upstream_admission(UpstreamAdmission(max_concurrent=2))
+        server, url, requests = self._test_upstream_server([], content, ranges=True)
+        try:
+            chunks = upstream_package_chunks(url + '/package4-1.0.0.tar.gz', chunk_size=4096, session=UpstreamSession(),
+                                             ranged_min_size=1000, ranged_segments=4)
+            self.assertEqual(b''.join(chunks), content)
+            self.assertEqual(len(requests), 2)
+        finally:
+            configure_upstream_admission(admission_previous)
+            server.shutdown()
+            server.server_close()
+
+        # A failed segment fails the download
+        server, url, requests = self._test_upstream_server([200, 404, 404, 404], content, ranges=True)
+        try:
+            chunks = upstream_package_chunks(url + '/package4-1.0.0.tar.gz', chunk_size=4096, session=UpstreamSession(),
+                                             ranged_min_size=1000, ranged_segments=4)
+            with self.assertRaises(IOError):
+                b''.join(chunks)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # A download closed early stops its segment downloads
+        server, url, requests = self._test_upstream_server([], content, ranges=True, delay=0.05)
+        try:
+            chunks = upstream_package_chunks(url + '/package4-1.0.0.tar.gz', chunk_size=4096, session=UpstreamSession(),
+                                             ranged_min_size=1000, ranged_segments=4)
+            self.assertEqual(next(chunks), content[:4096])
+            chunks.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_upstream_session_retry(self):
+
+        server, url, requests = self._test_upstream_server([503, 502], b'package4-1.0.0')
+        try:
+            session = UpstreamSession(backoff=0.001)
+            response = session.get(url + '/package4-1.0.0.tar.gz')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, b'package4-1.0.0')
+            self.assertEqual(len(requests), 3)
+
+            # The connection is kept alive between requests
+            response = session.get(url + '/package4-1.0.1.tar.gz')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(requests), 4)
+            self.assertEqual(requests[2][1], requests[3][1])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_upstream_session_circuit_breaker(self):
+
+        server, url, requests = self._test_upstream_server([503] * 4, b'package4-1.0.0')
+        try:
+            session = UpstreamSession(retries=1, backoff=0.001, failure_threshold=4, reset_timeout=0.2)
+            self.assertEqual(session.get(url + '/package4-1.0.0.tar.gz').status_code, 503)
+            self.assertEqual(session.get(url + '/package4-1.0.0.tar.gz').status_code, 503)
+            self.assertEqual(len(requests), 4)
+
+            # The open circuit fails fast without contacting upstream
+            with self.assertRaises(UpstreamUnavailable):
+                session.get(url + '/package4-1.0.0.tar.gz')
+            with self.assertRaises(UpstreamUnavailable):
+                session.check_available(url + '/package4-1.0.0.tar.gz')
+            self.assertEqual(len(requests), 4)
+
+            # A trial request after the reset timeout closes the circuit
+            time.sleep(0.25)
+            self.assertEqual(session.get(url + '/package4-1.0.0.tar.gz').status_code, 200)
+            self.assertEqual(len(requests), 5)
+            session.check_available(url + '/package4-1.0.0.tar.gz')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_download_upstream_unavailable(self):
+
+        server, url, dummy_requests = self._test_upstream_server([], b'package4-1.0.0')
+        server.shutdown()
+        server.server_close()
+        session = upstream_session()
+        for dummy_failure in range(session.failure_threshold):
+            session._record_result(url[len('http://'):], False) # pylint: disable=protected-access
+
+        index = MemoryIndex(index_url=None)
+        index._index['package4'] = { # pylint: disable=protected-access
+            'package4-1.0.0.tar.gz': IndexEntry(name='package4', version='1.0.0', filename='package4-1.0.0.tar.gz',
+                                                hash=None, hash_name=None, url=url + '/package4-1.0.0.tar.gz',
+                                                datetime=None, sha256=None, md5=None, size=None)
+        }
+        app = MrPyPi(index)
+        status, headers, content = app.request('GET', '/download/package4/1.0.0/package4-1.0.0.tar.gz')
+        self.assertEqual(status, '503 Service Unavailable')
+        self.assertTrue(('Content-Type', 'text/plain') in headers)
+        self.assertTrue(any(header == 'Retry-After' for header, dummy_value in headers))
+        self.assertEqual(content, b'Service Unavailable')
+
+    def test_index_upstream_unavailable(self):
+
+        server, url, dummy_requests = self._test_upstream_server([], b'')
+        server.shutdown()
+        server.server_close()
+        session = upstream_session()
+        for dummy_failure in range(session.failure_threshold):
+            session._record_result(url[len('http://'):], False) # pylint: disable=protected-access
+
+        # Uncached packages are unavailable, not missing
+        index = MemoryIndex(index_url=url + '/simple')
+        ctx = Context(Application(), {}, None, {})
+        index.add_package(ctx, 'package1', '1.0.0', 'package1-1.0.0.tar.gz', b'package1-1.0.0')
+        app = MrPyPi(index)
+        status, headers, content = app.request('GET', '/simple/package2')
+        self.assertEqual(status, '503 Service Unavailable')
+        self.assertTrue(any(header == 'Retry-After' for header, dummy_value in headers))
+        self.assertEqual(content, b'Service Unavailable')
+
+        # Cached packages are served from the cache
+        status, dummy_headers, content = app.request('GET', '/simple/package1', query_string='force_update=true')
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(b'package1-1.0.0.tar.gz' in content)
+
+    def test_index_batch(self):
+
+        index_html = b'''\
+<html><body>
+<a href="package5-1.0.0.tar.gz#md5=5f832e6e6b2107ba3b0463fc171623d7">package5-1.0.0.tar.gz</a>
+<a href="package6-1.0.0.tar.gz#md5=7ff99f5a955518cece354b9a0e94007d">package6-1.0.0.tar.gz</a>
+</body></html>'''
+        server, url, requests = self._test_upstream_server([], index_html, content_type='text/html', delay=0.2)
+        try:
+            index = MemoryIndex(index_url=url + '/simple')
+            ctx = Context(Application(), {}, None, {})
+            index.add_package(ctx, 'package1', '1.0.0', 'package1-1.0.0.tar.gz', b'package1-1.0.0')
+            app = MrPyPi(index)
+            status, headers, content = app.request('POST', '/simple-batch', wsgi_input=json.dumps({
+                'package_names': ['Package1', 'package5', 'package6', 'package7']
+            }).encode('utf-8'))
+            self.assertEqual(status, '200 OK')
+            self.assertTrue(('Content-Type', 'application/json') in headers)
+            content = json.loads(content.decode('utf-8'))
+            self.assertTrue(re.match(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{6}Z$',
+                                     content['projects']['Package1']['files'][0].pop('upload-time')))
+            self.assertEqual(content, {
+                'meta': {'api-version': '1.1'},
+                'projects': {
+                    'Package1': {
+                        'name': 'package1',
+                        'versions': ['1.0.0'],
+                        'files': [
+                            {
+                                'filename': 'package1-1.0.0.tar.gz',
+                                'url': 'download/package1/1.0.0/package1-1.0.0.tar.gz',
+                                'hashes': {
+                                    'sha256': '027c27fc8cb60a5f44e5914e26899d1ddab529e52fc57e8e930041d7998e2fac',
+                                    'md5': '5f832e6e6b2107ba3b0463fc171623d7'
+                                },
+                                'size': 14
+                            }
+                        ]
+                    },
+                    'package5': {
+                        'name': 'package5',
+                        'versions': ['1.0.0'],
+                        'files': [
+                            {
+                                'filename': 'package5-1.0.0.tar.gz',
+                                'url': 'download/package5/1.0.0/package5-1.0.0.tar.gz',
+                                'hashes': {'md5': '5f832e6e6b2107ba3b0463fc171623d7'}
+                            }
+                        ]
+                    },
+                    'package6': {
+                        'name': 'package6',
+                        'versions': ['1.0.0'],
+                        'files': [
+                            {
+                                'filename': 'package6-1.0.0.tar.gz',
+                                'url': 'download/package6/1.0.0/package6-1.0.0.tar.gz',
+                                'hashes': {'md5': '7ff99f5a955518cece354b9a0e94007d'}
+                            }
+                        ]
+                    },
+                    'package7': None
+                }
+            })
+
+            # The missing packages were refreshed in parallel (on separate upstream connections), the indexed package not at all
+            self.assertEqual(sorted(set(path.rstrip('/') for path, dummy_address in requests)),
+                             ['/simple/package5', '/simple/package6', '/simple/package7'])
+            self.assertTrue(len(set(address for dummy_path, address in requests)) >= 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_parallel_map(self):
+
+        # Each item's result or exception is returned in item order
+        def function(item):
+            if item == 2:
+                raise ValueError(item)
+            return item * 10
+        results = parallel_map(function, range(4))
+        self.assertEqual([result for result, dummy_exc in results], [0, 10, None, 30])
+        self.assertEqual([type(exc) for dummy_result, exc in results], [type(None), type(None), ValueError, type(None)])
+        self.assertEqual(parallel_map(function, [2])[0][0], None)
+        self.assertEqual(parallel_map(function, []), [])
+
+    def test_background_context(self):
+
+        # Background work logs to the process's stderr, not the request's error stream
+        ctx = Context(Application(), {'wsgi.errors': io.StringIO()}, None, {})
+        ctx_background = background_context(ctx)
+        self.assertIs(ctx_background.app, ctx.app)
+        self.assertIs(ctx_background.environ['wsgi.errors'], sys.stderr)
+
+    def test_index_batch_too_many(self):
+
+        app = MrPyPi(self._test_index())
+        status, dummy_headers, dummy_content = app.request('POST', '/simple-batch', wsgi_input=json.dumps({
+            'package_names': ['package{0}'.format(ix) for ix in range(1001)]
+        }).encode('utf-8'))
+        self.assertEqual(status, '400 Bad Request')
+
+    def test_hash_ring(self):
+
+        keys = ['package{0}/1.0.0/package{0}-1.0.0.tar.gz'.format(ix) for ix in range(10000)]
+        nodes = ['http://node{0}:8000'.format(ix) for ix in range(4)]
+        ring = HashRing(nodes)
+        owners = {key: ring.node(key) for key in keys}
+
+        # Keys are spread evenly
+        for node in nodes:
+            self.assertTrue(0.15 < sum(1 for owner in owners.values() if owner == node) / float(len(keys)) < 0.35)
+
+        # Adding a node only moves keys to the new node - about a fifth of them
+        ring_added = HashRing(nodes + ['http://node4:8000'])
+        moved = [key for key in keys if ring_added.node(key) != owners[key]]
+        self.assertTrue(all(ring_added.node(key) == 'http://node4:8000' for key in moved))
+        self.assertTrue(0.1 < len(moved) / float(len(keys)) < 0.3)
+
+        # Removing a node only moves the removed node's keys
+        ring_removed = HashRing(nodes[1:])
+        self.assertTrue(all(ring_removed.node(key) == owners[key] for key in keys if owners[key] != nodes[0]))
+        self.assertEqual(HashRing([]).node(keys[0]), None)
+
+    def test_cluster_peer_not_forwarded(self):
+
+        index_entry = IndexEntry('package1', '1.0.0', 'package1-1.0.0.tar.gz', None, None, None, None, None, None, None)
+        peers = ['http://127.0.0.1:1', 'http://127.0.0.1:2']
+        for node_url in peers:
+            cluster = ClusterPeers(node_url, [peer for peer in peers if peer != node_url])
+            ctx = Context(Application(), {}, None, {})
+            if cluster.owner('package1', '1.0.0', 'package1-1.0.0.tar.gz') == node_url:
+                # The owner downloads from upstream
+                self.assertEqual(cluster.peer_package_content(ctx, index_entry), None)
+            else:
+                # Peer requests are never forwarded - and an unavailable owner falls back to upstream
+                peer_ctx = Context(Application(), {ClusterPeers.PEER_HEADER_ENVIRON: 'http://127.0.0.1:3'}, None, {})
+                self.assertEqual(cluster.peer_package_content(peer_ctx, index_entry), None)
+                self.assertEqual(cluster.peer_package_content(ctx, index_entry), None)
+
+    @staticmethod
+    def _test_subprocess_env():
+
+        # Python subprocesses import mrpypi from this source tree
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))] +
+                                            ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+        return env
+
+    def test_cluster_processes(self):
+
+        # Upstream index and package file
+        package_url = '/simple/package8/package8-1.0.0.tar.gz'
+        index_html = '<html><body><a href="package8-1.0.0.tar.gz#sha256={0}">package8-1.0.0.tar.gz</a></body></html>'.format(
+            hashlib.sha256(b'package8-1.0.0').hexdigest()).encode('utf-8')
+        server, url, requests = self._test_upstream_server([], None, routes={
+            '/simple/package8': ('text/html', index_html),
+            package_url: ('application/octet-stream', b'package8-1.0.0')
+        })
+
+        # Start a cluster of three nodes
+        ports = []
+        for dummy_node in range(3):
+            port_socket = socket.socket()
+            port_socket.bind(('127.0.0.1', 0))
+            ports.append(port_socket.getsockname()[1])
+            port_socket.close()
+        node_urls = ['http://127.0.0.1:{0}'.format(port) for port in ports]
+        env = self._test_subprocess_env()
+        with open(os.devnull, 'w') as devnull:
+            processes = [subprocess.Popen([sys.executable, '-m', 'mrpypi', '-p', str(port), '--index', url + '/simple',
+                                           '--cluster-node', node_url] +
+                                          sum((['--cluster-peer', peer_url] for peer_url in node_urls if peer_url != node_url), []),
+                                          env=env, stdout=devnull, stderr=devnull)
+                         for port, node_url in zip(ports, node_urls)]
+        try:
+            for port in ports:
+                for dummy_attempt in range(300):
+                    try:
+                        socket.create_connection(('127.0.0.1', port)).close()
+                        break
+                    except socket.error:
+                        time.sleep(0.1)
+
+            # Download the package file from both nodes that don't own it
+            owner = HashRing(node_urls).node('package8/1.0.0/package8-1.0.0.tar.gz')
+            for node_url in node_urls:
+                if node_url != owner:
+                    response = urlopen(node_url + '/download/package8/1.0.0/package8-1.0.0.tar.gz')
+                    self.assertEqual(response.read(), b'package8-1.0.0')
+                    response.close()
+
+            # The cluster downloaded the package file from upstream once - by the owner
+            self.assertEqual(sum(1 for path, dummy_address in requests if path == package_url), 1)
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+            server.shutdown()
+            server.server_close()
+
+    def test_disk_cache(self):
+
+        ctx = Context(Application(), {}, None, {})
+        temp_dir = tempfile.mkdtemp()
+        try:
+            disk_cache = DiskCache(temp_dir, max_bytes=250)
+            self.assertEqual(disk_cache.get('package1/1.0.0/package1-1.0.0.tar.gz'), None)
+
+            # Aborted files aren't cached
+            cache_writer = disk_cache.writer('package1/1.0.0/package1-1.0.0.tar.gz')
+            cache_writer.write(b'package1')
+            cache_writer.abort()
+            self.assertEqual(disk_cache.get('package1/1.0.0/package1-1.0.0.tar.gz'), None)
+
+            # Committed files are cached
+            for ix in range(3):
+                cache_writer = disk_cache.writer('package1/1.0.{0}/package1-1.0.{0}.tar.gz'.format(ix))
+                cache_writer.write(b'x' * 100)
+                cache_writer.commit(ctx)
+                cached_file = disk_cache.get('package1/1.0.{0}/package1-1.0.{0}.tar.gz'.format(ix))
+                os.utime(cached_file.path, (ix, ix))
+            self.assertEqual(cached_file.size, 100)
+            self.assertEqual((cached_file.offload_header, cached_file.offload_value), (None, None))
+            with open(cached_file.path, 'rb') as cached_stream:
+                self.assertEqual(cached_stream.read(), b'x' * 100)
+
+            # Over quota - the least-recently used file is evicted (no temporary files remain)
+            disk_cache._evict(ctx) # pylint: disable=protected-access
+            self.assertEqual(disk_cache.get('package1/1.0.0/package1-1.0.0.tar.gz'), None)
+            self.assertNotEqual(disk_cache.get('package1/1.0.1/package1-1.0.1.tar.gz'), None)
+            self.assertNotEqual(disk_cache.get('package1/1.0.2/package1-1.0.2.tar.gz'), None)
+            self.assertEqual(sum(len(filenames) for dummy_dirpath, dummy_dirnames, filenames in os.walk(temp_dir)), 2)
+
+            # Offload headers
+            cached_file = DiskCache(temp_dir, accel_redirect='/cache/').get('package1/1.0.1/package1-1.0.1.tar.gz')
+            self.assertEqual(cached_file.offload_header, 'X-Accel-Redirect')
+            self.assertTrue(cached_file.offload_value.startswith('/cache/'))
+            self.assertTrue(cached_file.path.endswith(os.path.join(*cached_file.offload_value[len('/cache/'):].split('/'))))
+            cached_file = DiskCache(temp_dir, sendfile=True).get('package1/1.0.1/package1-1.0.1.tar.gz')
+            self.assertEqual((cached_file.offload_header, cached_file.offload_value), ('X-Sendfile', cached_file.path))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_download_disk_cache(self):
+
+        class DiskCacheIndex(MemoryIndex):
+            __slots__ = ('disk_cache',)
+
+            def get_package_file(self, ctx, package_name, version, filename):
+                return self.disk_cache.get('/'.join((package_name, version, filename)))
+
+        ctx = Context(Application(), {}, None, {})
+        temp_dir = tempfile.mkdtemp()
+        try:
+            index = DiskCacheIndex()
+            index.add_package(ctx, 'package1', '1.0.0', 'package1-1.0.0.tar.gz', b'package1-1.0.0')
+            index.add_package(ctx, 'package1', '1.0.1', 'package1-1.0.1.tar.gz', b'package1-1.0.1')
+            index.disk_cache = DiskCache(temp_dir)
+            cache_writer = index.disk_cache.writer('package1/1.0.0/package1-1.0.0.tar.gz')
+            cache_writer.write(b'cached package1-1.0.0')
+            cache_writer.commit(ctx)
+            app = MrPyPi(index)
+
+            # Cached file streamed by the application
+            status, headers, content = app.request('GET', '/download/package1/1.0.0/package1-1.0.0.tar.gz')
+            self.assertEqual(status, '200 OK')
+            self.assertTrue(('Content-Length', '21') in headers)
+            self.assertEqual(content, b'cached package1-1.0.0')
+
+            # Cached file streamed by the server's file wrapper
+            wrapped = []
+            def file_wrapper(file_, block_size):
+                wrapped.append(block_size)
+                with file_:
+                    return [file_.read()]
+            status, headers, content = app.request('GET', '/download/package1/1.0.0/package1-1.0.0.tar.gz',
+                                                   environ={'wsgi.file_wrapper': file_wrapper})
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(content, b'cached package1-1.0.0')
+            self.assertEqual(len(wrapped), 1)
+
+            # Cached file offloaded to the front-end server
+            index.disk_cache = DiskCache(temp_dir, accel_redirect='/cache')
+            status, headers, content = app.request('GET', '/download/package1/1.0.0/package1-1.0.0.tar.gz')
+            self.assertEqual(status, '200 OK')
+            self.assertTrue(any(header == 'X-Accel-Redirect' and value.startswith('/cache/') for header, value in headers))
+            self.assertEqual(content, b'')
+
+            # Uncached file streamed from the index
+            status, headers, content = app.request('GET', '/download/package1/1.0.1/package1-1.0.1.tar.gz')
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(content, b'package1-1.0.1')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'requires python -X importtime')
+    def test_import_time(self):
+
+        # Import mrpypi in a fresh interpreter - chisel is imported first so only mrpypi's own imports are measured
+        output = subprocess.check_output([sys.executable, '-X', 'importtime', '-c', 'import chisel; import mrpypi'],
+                                         stderr=subprocess.STDOUT, env=self._test_subprocess_env()).decode('utf-8')
+        import_times = {}
+        for line in output.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                dummy_self_us, cumulative_us, module_name = line[len('import time:'):].split('|')
+                if cumulative_us.strip().isdigit():
+                    import_times[module_name.strip()] = int(cumulative_us) / 1e6
+
+        # pip and the MongoDB driver are imported on first use
+        self.assertTrue('mrpypi.mrpypi' in import_times)
+        self.assertEqual([module_name for module_name in import_times
+                          if module_name.split('.')[0] in ('pip', 'pymongo', 'gridfs', 'bson')], [])
+
+    @staticmethod
+    def _test_archive(filename, members):
+        archive_bytes = io.BytesIO()
+        if filename.endswith(('.whl', '.zip')):
+            with zipfile.ZipFile(archive_bytes, 'w') as archive:
+                for name, content in members:
+                    archive.writestr(name, content)
+        else:
+            with tarfile.open(fileobj=archive_bytes, mode='w:gz') as archive:
+                for name, content in members:
+                    tar_info = tarfile.TarInfo(name)
+                    tar_info.size = len(content)
+                    archive.addfile(tar_info, io.BytesIO(content))
+        return archive_bytes.getvalue()
+
+    def test_package_requirements(self):
+
+        # Wheel METADATA
+        metadata = b'''\
+Metadata-Version: 2.1
+Name: package1
+Version: 1.0.0
+Requires-Dist: package2 (>=1.0)
+Requires-Dist: Package_3[extra1]>=2.0,<3; python_version >= "3"
+Requires-Dist: package4; extra == "test"
+
+Description
+'''
+        content = self._test_archive('package1-1.0.0-py3-none-any.whl', [
+            ('package1/__init__.py', b''),
+            ('package1-1.0.0.dist-info/METADATA', metadata)
+        ])
+        self.assertEqual(package_requirements('package1-1.0.0-py3-none-any.whl', content),
+                         [('package2', '>=1.0'), ('Package_3', '>=2.0,<3')])
+
+        # Source distribution PKG-INFO without requirements - requires.txt
+        content = self._test_archive('package1-1.0.0.tar.gz', [
+            ('package1-1.0.0/PKG-INFO', b'Metadata-Version: 1.1\nName: package1\nVersion: 1.0.0\n'),
+            ('package1-1.0.0/package1.egg-info/requires.txt', b'package2>=1.0\npackage5\n\n[test]\npackage4\n')
+        ])
+        self.assertEqual(package_requirements('package1-1.0.0.tar.gz', content), [('package2', '>=1.0'), ('package5', '')])
+
+        # Source distribution PKG-INFO with requirements
+        content = self._test_archive('package1-1.0.0.zip', [
+            ('package1-1.0.0/PKG-INFO', metadata),
+            ('package1-1.0.0/package1.egg-info/requires.txt', b'package5\n')
+        ])
+        self.assertEqual(package_requirements('package1-1.0.0.zip', content), [('package2', '>=1.0'), ('Package_3', '>=2.0,<3')])
+
+        # Invalid archives have no requirements
+        self.assertEqual(package_requirements('package1-1.0.0.tar.gz', b'package1-1.0.0'), [])
+        self.assertEqual(package_requirements('package1-1.0.0-py3-none-any.whl', b'package1-1.0.0'), [])
+
+    def test_prefetch_index_entry(self):
+
+        package_index = [IndexEntry('package2', version, filename, None, None, None, None, None, None, None) for version, filename in (
+            ('1.0.0', 'package2-1.0.0.tar.gz'),
+            ('1.5.0', 'package2-1.5.0.tar.gz'),
+            ('1.5.0', 'package2-1.5.0-py2.py3-none-any.whl'),
+            ('1.6.0', 'package2-1.6.0-cp39-cp39-win_amd64.whl'),
+            ('2.0.0rc1', 'package2-2.0.0rc1.tar.gz'),
+            ('10.0.0', 'package2-10.0.0.tar.gz')
+        )]
+        self.assertEqual(prefetch_index_entry(package_index, '').filename, 'package2-10.0.0.tar.gz')
+        self.assertEqual(prefetch_index_entry(package_index, '<2').filename, 'package2-1.5.0-py2.py3-none-any.whl')
+        self.assertEqual(prefetch_index_entry(package_index, '<1.5').filename, 'package2-1.0.0.tar.gz')
+        self.assertEqual(prefetch_index_entry(package_index, '>=2.0.0rc1,<3').filename, 'package2-2.0.0rc1.tar.gz')
+        self.assertEqual(prefetch_index_entry(package_index, '>20'), None)
+        self.assertEqual(prefetch_index_entry(package_index, 'bad'), prefetch_index_entry(package_index, ''))
+
+    def test_download_prefetch(self):
+
+        index_html = b'''\
+<html><body>
+<a href="package9-1.0.0.tar.gz">package9-1.0.0.tar.gz</a>
+<a href="package9-1.5.0-py2.py3-none-any.whl">package9-1.5.0-py2.py3-none-any.whl</a>
+<a href="package9-2.0.0.tar.gz">package9-2.0.0.tar.gz</a>
+</body></html>'''
+        server, url, requests = self._test_upstream_server([], None, routes={
+            '/simple/package9': ('text/html', index_html),
+            '/simple/package9/package9-1.5.0-py2.py3-none-any.whl': ('application/octet-stream', b'package9-1.5.0')
+        })
+        try:
+            ctx = Context(Application(), {}, None, {})
+            index = MemoryIndex(index_url=url + '/simple')
+            index.add_package(ctx, 'package1', '1.0.0', 'package1-1.0.0.tar.gz', self._test_archive('package1-1.0.0.tar.gz', [
+                ('package1-1.0.0/PKG-INFO', b'Metadata-Version: 1.1\nName: package1\nVersion: 1.0.0\n'),
+                ('package1-1.0.0/package1.egg-info/requires.txt', b'Package9>=1.0,<2\n\n[test]\npackage10\n')
+            ]))
+            prefetcher = DependencyPrefetcher(index)
+            app = MrPyPi(index, prefetcher=prefetcher)
+
+            # Download the package - the dependency's index and package file are prefetched
+            status, dummy_headers, dummy_content = app.request('GET', '/download/package1/1.0.0/package1-1.0.0.tar.gz')
+            self.assertEqual(status, '200 OK')
+            prefetcher.join()
+            self.assertEqual(sorted(set(path for path, dummy_address in requests)),
+                             ['/simple/package9/', '/simple/package9/package9-1.5.0-py2.py3-none-any.whl'])
+
+            # The dependency's download is a local hit
+            del requests[:]
+            status, dummy_headers, content = app.request('GET', '/download/package9/1.5.0/package9-1.5.0-py2.py3-none-any.whl')
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(content, b'package9-1.5.0')
+            prefetcher.join()
+            self.assertEqual(requests, [])
+
+            # The dependency isn't prefetched again
+            status, dummy_headers, dummy_content = app.request('GET', '/download/package1/1.0.0/package1-1.0.0.tar.gz')
+            prefetcher.join()
+            self.assertEqual(requests, [])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_export_import(self):
+
+        ctx = Context(Application(), {}, None, {})
+        index = MemoryIndex(index_url=None)
+        index.add_package(ctx, 'package1', '1.0.0', 'package1-1.0.0.tar.gz', b'content of package1 1.0.0')
+        index.add_package(ctx, 'package1', '1.0.1', 'package1-1.0.1.tar.gz', b'content of package1 1.0.1')
+        index.add_package(ctx, 'package2', '1.0.0', 'package2-1.0.0-py3-none-any.whl', b'content of package2 1.0.0')
+        upstream_entry = IndexEntry('package3', '1.0.0', 'package3-1.0.0.tar.gz', 'abc', 'md5',
+                                    'http://127.0.0.1:1/package3-1.0.0.tar.gz', None, None, None, None)
+        with index._lock('package3'): # pylint: disable=protected-access
+            index._publish('package3', {upstream_entry.filename: upstream_entry}) # pylint: disable=protected-access
+
+        # Exports are disabled without an export token - and only served to requests with the token
+        status, dummy_headers, dummy_content = MrPyPi(index).request('GET', '/export')
+        self.assertEqual(status, '404 Not Found')
+        app = MrPyPi(index, export_token='token')
+        for environ in (None, {'HTTP_X_MRPYPI_EXPORT_TOKEN': 'wrong'}):
+            status, dummy_headers, content = app.request('GET', '/export', environ=environ)
+            self.assertEqual(status, '403 Forbidden')
+            self.assertEqual(content, b'Forbidden')
+
+        # Export the index archive - a tar stream
+        status, headers, archive = app.request('GET', '/export', environ={'HTTP_X_MRPYPI_EXPORT_TOKEN': 'token'})
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(('Content-Type', 'application/x-tar') in headers)
+        self.assertEqual(tarfile.open(fileobj=io.BytesIO(archive)).getnames(), [
+            'package1/1.0.0/package1-1.0.0.tar.gz.json',
+            'package1/1.0.0/package1-1.0.0.tar.gz',
+            'package1/1.0.1/package1-1.0.1.tar.gz.json',
+            'package1/1.0.1/package1-1.0.1.tar.gz',
+            'package2/1.0.0/package2-1.0.0-py3-none-any.whl.json',
+            'package2/1.0.0/package2-1.0.0-py3-none-any.whl',
+            'package3/1.0.0/package3-1.0.0.tar.gz.json'
+        ])
+
+        # An interrupted import...
+        index_import = MemoryIndex(index_url=None)
+        with self.assertRaises(tarfile.TarError):
+            import_archive(ctx, index_import, io.BytesIO(archive[:3000]), batch_size=1)
+        self.assertEqual(list(index_import.get_package_names(ctx)), ['package1'])
+
+        # ... is resumed by importing again
+        self.assertEqual(import_archive(ctx, index_import, io.BytesIO(archive), batch_size=2),
+                         {'entries': 3, 'files': 2, 'skipped': 1, 'invalid': 0})
+        self.assertEqual(import_archive(ctx, index_import, io.BytesIO(archive)),
+                         {'entries': 0, 'files': 0, 'skipped': 4, 'invalid': 0})
+        self.assertEqual(list(index_import.get_package_names(ctx)), ['package1', 'package2', 'package3'])
+        for package_name in ('package1', 'package2', 'package3'):
+            self.assertEqual(sorted(index_import.get_package_index(ctx, package_name)),
+                             sorted(index.get_package_index(ctx, package_name)))
+        package_stream = index_import.get_package_stream(ctx, 'package2', '1.0.0', 'package2-1.0.0-py3-none-any.whl')
+        self.assertEqual(b''.join(package_stream()), b'content of package2 1.0.0')
+
+        # Package files that don't match their hash aren't imported
+        index_import = MemoryIndex(index_url=None)
+        archive = archive.replace(b'content of package1 1.0.1', b'content of package1 X.X.X')
+        self.assertEqual(import_archive(ctx, index_import, io.BytesIO(archive)),
+                         {'entries': 3, 'files': 2, 'skipped': 0, 'invalid': 1})
+        self.assertEqual([index_entry.filename for index_entry in index_import.get_package_index(ctx, 'package1')],
+                         ['package1-1.0.0.tar.gz'])
+
+    def test_sqlite_index(self):
+
+        ctx = Context(Application(), {}, None, {})
+        temp_dir = tempfile.mkdtemp()
+        try:
+            database_path = os.path.join(temp_dir, 'index.db')
+            index = SQLiteIndex(database_path, index_url=None)
+            self.assertEqual(index.get_index_generation(ctx), 0)
+            self.assertTrue(index.add_package(ctx, 'package1', '1.0.0', 'package1-1.0.0.tar.gz', b'content of package1 1.0.0'))
+            self.assertTrue(index.add_package(ctx, 'package1', '1.0.1', 'package1-1.0.1.tar.gz', b'content of package1 1.0.1'))
+            self.assertFalse(index.add_package(ctx, 'package1', '1.0.1', 'package1-1.0.1.tar.gz', b'content of package1 X.X.X'))
+            self.assertTrue(index.add_package(ctx, 'package2', '1.0.0', 'package2-1.0.0.tar.gz', b'content of package1 1.0.0'))
+            self.assertEqual(index.get_index_generation(ctx), 2)
+
+            # Package files are content-addressed
+            sha256 = hashlib.sha256(b'content of package1 1.0.0').hexdigest()
+            self.assertEqual(sorted(os.listdir(os.path.join(temp_dir, 'index.db-blobs', sha256[:2]))), [sha256])
+
+            # Another index (process) shares the database
+            index_other = SQLiteIndex(database_path, index_url=None)
+            self.assertEqual(list(index_other.get_package_names(ctx)), ['package1', 'package2'])
+            self.assertEqual(sorted(index_entry.version for index_entry in index_other.get_package_index(ctx, 'package1')),
+                             ['1.0.0', '1.0.1'])
+            self.assertIsNone(index_other.get_package_index(ctx, 'package3'))
+            package_indexes = index_other.get_package_indexes(ctx, ['package2', 'package3'])
+            self.assertEqual([index_entry.filename for index_entry in package_indexes['package2']], ['package2-1.0.0.tar.gz'])
+            self.assertIsNone(package_indexes['package3'])
+            cached_file = index_other.get_package_file(ctx, 'package1', '1.0.0', 'package1-1.0.0.tar.gz')
+            self.assertEqual(cached_file.size, len(b'content of package1 1.0.0'))
+            self.assertIsNone(index_other.get_package_file(ctx, 'package1', '1.0.2', 'package1-1.0.2.tar.gz'))
+
+            # Index pages and downloads
+            app = MrPyPi(index_other)
+            status, _, content = app.request('GET', '/simple/package1/')
+            self.assertEqual(status, '200 OK')
+            self.assertTrue(b'package1-1.0.1.tar.gz#sha256=' in content)
+            status, _, content = app.request('GET', '/download/package1/1.0.1/package1-1.0.1.tar.gz')
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(content, b'content of package1 1.0.1')
+            status, _, content = app.request('GET', '/download/package1/1.0.2/package1-1.0.2.tar.gz')
+            self.assertEqual(status, '404 Not Found')
+
+            # Export to a memory index and back again
+            index_memory = MemoryIndex(index_url=None)
+            self.assertEqual(import_archive(ctx, index_memory, io.BytesIO(b''.join(export_archive(ctx, index_other)))),
+                             {'entries': 3, 'files': 3, 'skipped': 0, 'invalid': 0})
+            index_import = SQLiteIndex(os.path.join(temp_dir, 'import.db'), index_url=None)
+            archive = b''.join(export_archive(ctx, index_memory))
+            self.assertEqual(import_archive(ctx, index_import, io.BytesIO(archive), batch_size=2),
+                             {'entries': 3, 'files': 2, 'skipped': 0, 'invalid': 0})
+            self.assertEqual(import_archive(ctx, index_import, io.BytesIO(archive)),
+                             {'entries': 0, 'files': 0, 'skipped': 3, 'invalid': 0})
+            self.assertEqual(index_import.get_index_generation(ctx), 2)
+            self.assertEqual(sorted(index_import.get_package_index(ctx, 'package1')), sorted(index.get_package_index(ctx, 'package1')))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_sqlite_index_upstream(self):
+
+        ctx = Context(Application(), {}, None, {})
+        content = b'package4-1.0.0' * 10000
+        index_memory, temp_dir = self._test_upstream_index(content, hashlib.md5(content).hexdigest())
+        try:
+            index = SQLiteIndex(os.path.join(temp_dir, 'index.db'), index_url=None)
+            upstream_entry, = index_memory.get_package_index(ctx, 'package4')
+            upstream_entry_bad = upstream_entry._replace(version='1.0.1', filename='package4-1.0.1.tar.gz', hash='0' * 32)
+            index._insert_entries([upstream_entry, upstream_entry_bad]) # pylint: disable=protected-access
+
+            # The package file is downloaded and stored once
+            self.assertIsNone(index.get_package_file(ctx, 'package4', '1.0.0', 'package4-1.0.0.tar.gz'))
+            app = MrPyPi(index)
+            status, _, content_download = app.request('GET', '/download/package4/1.0.0/package4-1.0.0.tar.gz')
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(content_download, content)
+            index_entry = next(pe for pe in index.get_package_index(ctx, 'package4') if pe.version == '1.0.0')
+            self.assertEqual(index_entry.sha256, hashlib.sha256(content).hexdigest())
+            self.assertEqual(index_entry.size, len(content))
+            self.assertEqual(index.get_package_file(ctx, 'package4', '1.0.0', 'package4-1.0.0.tar.gz').size, len(content))
+
+            # Downloads that don't match their hash aren't stored
+            with self.assertRaises(PackageHashMismatch):
+                b''.join(index.get_package_stream(ctx, 'package4', '1.0.1', 'package4-1.0.1.tar.gz')())
+            self.assertEqual(os.listdir(os.path.join(temp_dir, 'index.db-blobs')), [index_entry.sha256[:2]])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_load_test_parse(self):
+
+        self.assertEqual(parse_request_log([
+            '127.0.0.1 - - [10/Oct/2000:13:55:37 -0700] "GET /simple/package1/ HTTP/1.1" 200 2326 "-" "pip/7.1.2"',
+            '127.0.0.1 - - [10/Oct/2000 20:55:36] "GET /download/package1/1.0.0/package1-1.0.0.tar.gz HTTP/1.1" 200 -',
+            '{"time": 971211338.5, "method": "head", "path": "/simple/"}',
+            '127.0.0.1 - - [10/Oct/2000:13:55:37 -0700] "POST /simple/ HTTP/1.1" 200 -',
+            '{"time": 971211338.5}',
+            'not a log line',
+            ''
+        ]), [
+            ReplayRequest(971211336.0, 'GET', '/download/package1/1.0.0/package1-1.0.0.tar.gz'),
+            ReplayRequest(971211337.0, 'GET', '/simple/package1/'),
+            ReplayRequest(971211338.5, 'HEAD', '/simple/')
+        ])
+
+    def test_load_test_replay(self):
+
+        requests = [
+            ReplayRequest(0.0, 'GET', '/simple/package1/'),
+            ReplayRequest(0.0, 'GET', '/simple/package2/'),
+            ReplayRequest(0.1, 'GET', '/download/package1/1.0.1/package1-1.0.1.tar.gz'),
+            ReplayRequest(0.1, 'GET', '/download/package2/1.0.0/package2-1.0.0-py3-none-any.whl'),
+            ReplayRequest(0.2, 'GET', '/download/package2/1.0.0/package2-1.0.0-py3-none-any.whl'),
+            ReplayRequest(0.2, 'GET', '/download/package2/2.0.0/package2-2.0.0-py3-none-any.whl'),
+            ReplayRequest(0.2, 'GET', '/simple/')
+        ]
+        # The upstream stand-in serves each downloaded package file
+        stand_in = UpstreamStandIn.for_requests(requests, file_size=1000).start()
+        try:
+            application = MrPyPi(MemoryIndex(index_url=stand_in.index_url))
+            report = replay_requests(requests, application_sender(application), speedup=2.0, concurrency=4)
+            self.assertTrue(report.elapsed >= 0.1)
+            summary = report.summary()
+            self.assertEqual(sorted(summary), ['pypi_download', 'pypi_index', 'pypi_root_index', 'total'])
+            self.assertEqual(summary['pypi_index']['statuses'], {200: 2})
+            self.assertEqual(summary['pypi_download']['statuses'], {200: 4})
+            self.assertEqual(summary['pypi_download']['bytes'], 4000)
+            self.assertEqual(summary['total']['requests'], 7)
+            self.assertEqual(summary['total']['errors'], 0)
+            self.assertTrue(summary['total']['p50'] <= summary['total']['p99'] <= summary['total']['max'])
+            self.assertTrue('pypi_download' in report.format())
+
+            # Failed requests are errors
+            def send_error(method, path):
+                if path.startswith('/download/'):
+                    raise IOError('connection reset')
+                return application_sender(application)(method, path)
+            summary = replay_requests(requests, send_error, speedup=None).summary()
+            self.assertEqual(summary['pypi_download']['error_rate'], 1.0)
+            self.assertEqual(summary['pypi_index']['errors'], 0)
+        finally:
+            stand_in.stop()
+
+    def test_static_mirror(self):
+
+        ctx = Context(Application(), {}, None, {})
+        content = b'package4-1.0.0' * 1000
+        index, temp_dir = self._test_upstream_index(content, hashlib.md5(content).hexdigest())
+        try:
+            index.add_package(ctx, 'package1', '1.0.0', 'package1-1.0.0.tar.gz', b'content of package1 1.0.0')
+            index.add_package(ctx, 'package2', '1.0.0', 'package2-1.0.0-py3-none-any.whl', b'content of package2 1.0.0')
+            app = MrPyPi(index)
+            mirror_path = os.path.join(temp_dir, 'mirror')
+
+            # Package files not stored by the index are left off the package pages
+            self.assertEqual(export_static_mirror(ctx, index, mirror_path, download_upstream=False),
+                             {'packages': 3, 'updated': 3, 'unchanged': 0, 'files': 2, 'missing': 1})
+            self.assertEqual(os.readlink(mirror_path), 'mirror.1')
+            with open(os.path.join(mirror_path, 'simple', 'package4', 'index.html'), 'rb') as page_file:
+                self.assertTrue(b'package4-1.0.0.tar.gz' not in page_file.read())
+
+            # The tree has the pages and package files MrPyPi serves
+            self.assertEqual(export_static_mirror(ctx, index, mirror_path),
+                             {'packages': 3, 'updated': 1, 'unchanged': 2, 'files': 1, 'missing': 0})
+            self.assertEqual(os.readlink(mirror_path), 'mirror.2')
+            for url_path in ('/simple/', '/simple/package1/', '/simple/package4/',
+                             '/download/package2/1.0.0/package2-1.0.0-py3-none-any.whl',
+                             '/download/package4/1.0.0/package4-1.0.0.tar.gz'):
+                file_path = os.path.join(mirror_path, *url_path.strip('/').split('/'))
+                if url_path.endswith('/'):
+                    file_path = os.path.join(file_path, 'index.html')
+                with open(file_path, 'rb') as mirror_file:
+                    self.assertEqual(mirror_file.read(), app.request('GET', url_path)[2])
+
+            # Unchanged packages are linked from the previous tree - older trees are deleted
+            index.add_package(ctx, 'package1', '1.0.1', 'package1-1.0.1.tar.gz', b'content of package1 1.0.1')
+            self.assertEqual(export_static_mirror(ctx, index, mirror_path),
+                             {'packages': 3, 'updated': 1, 'unchanged': 2, 'files': 1, 'missing': 0})
+            self.assertEqual(sorted(name for name in os.listdir(temp_dir) if name.startswith('mirror')), ['mirror', 'mirror.2', 'mirror.3'])
+            for page_path in (('simple', 'index.html'), ('simple', 'package2', 'index.html'),
+                              ('download', 'package1', '1.0.0', 'package1-1.0.0.tar.gz')):
+                self.assertEqual(os.stat(os.path.join(temp_dir, 'mirror.2', *page_path)).st_ino,
+                                 os.stat(os.path.join(temp_dir, 'mirror.3', *page_path)).st_ino)
+            with open(os.path.join(mirror_path, 'simple', 'package1', 'index.html'), 'rb') as page_file:
+                self.assertEqual(page_file.read(), app.request('GET', '/simple/package1/')[2])
+
+            # A new package name rewrites the root page
+            index.add_package(ctx, 'package3', '1.0.0', 'package3-1.0.0.tar.gz', b'content of package3 1.0.0')
+            self.assertEqual(export_static_mirror(ctx, index, mirror_path),
+                             {'packages': 4, 'updated': 1, 'unchanged': 3, 'files': 1, 'missing': 0})
+            with open(os.path.join(mirror_path, 'simple', 'index.html'), 'rb') as page_file:
+                self.assertEqual(page_file.read(), app.request('GET', '/simple/')[2])
+
+            # Package pages are written under the normalized name and linked from the index's name
+            index.add_package(ctx, 'package_5', '1.0.0', 'package_5-1.0.0.tar.gz', b'content of package_5 1.0.0')
+            self.assertEqual(export_static_mirror(ctx, index, mirror_path),
+                             {'packages': 5, 'updated': 1, 'unchanged': 4, 'files': 1, 'missing': 0})
+            for page_name in ('package-5', 'package_5'):
+                with open(os.path.join(mirror_path, 'simple', page_name, 'index.html'), 'rb') as page_file:
+                    self.assertEqual(page_file.read(), app.request('GET', '/simple/package_5/')[2])
+
+            # The mirror path must be a symbolic link
+            with self.assertRaises(ValueError):
+                export_static_mirror(ctx, index, os.path.join(temp_dir, 'mirror.4'))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_upstream_admission(self):
+
+        admission = UpstreamAdmission(max_concurrent=1, max_queue=1, deadline=0.2)
+        admission.acquire()
+        admission.check()
+
+        # Waiters time out at the deadline - and overflow the queue while waiting
+        results = []
+        def acquire():
+            try:
+                admission.acquire()
+                results.append('acquired')
+            except UpstreamOverloaded as exc:
+                results.append(exc.retry_after)
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        while not admission._waiting: # pylint: disable=protected-access
+            time.sleep(0.001)
+        with self.assertRaises(UpstreamOverloaded):
+            admission.check()
+        with self.assertRaises(UpstreamOverloaded):
+            admission.acquire()
+        thread.join()
+        self.assertEqual(results, [0.2])
+        admission.check()
+
+        # Released slots are given to waiters
+        del results[:]
+        admission.deadline = 5
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        while not admission._waiting: # pylint: disable=protected-access
+            time.sleep(0.001)
+        admission.release()
+        thread.join()
+        self.assertEqual(results, ['acquired'])
+        admission.release()
+        with admission:
+            pass
+
+    def test_upstream_overloaded(self):
+
+        # All upstream work is rejected
+        admission = UpstreamAdmission(max_concurrent=1, max_queue=0)
+        admission.acquire()
+        admission_previous = configure_upstream_admission(admission)
+        try:
+            ctx = Context(Application(), {}, None, {})
+            index = MemoryIndex(index_url='http://127.0.0.1:1/simple')
+            index.add_package(ctx, 'package1', '1.0.0', 'package1-1.0.0.tar.gz', b'package1-1.0.0')
+            app = MrPyPi(index)
+
+            # Uncached packages are shed
+            status, headers, content = app.request('GET', '/simple/package2')
+            self.assertEqual(status, '503 Service Unavailable')
+            self.assertTrue(('Retry-After', '6') in headers)
+            self.assertEqual(content, b'Service Unavailable')
+
+            # Cached packages are served stale - and local package files as usual
+            status, dummy_headers, content = app.request('GET', '/simple/package1', query_string='force_update=true')
+            self.assertEqual(status, '200 OK')
+            self.assertTrue(b'package1-1.0.0.tar.gz' in content)
+            status, dummy_headers, content = app.request('GET', '/download/package1/1.0.0/package1-1.0.0.tar.gz')
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(content, b'package1-1.0.0')
+
+            # Batches serve the cached packages and list the unavailable packages - unless every package is unavailable
+            status, dummy_headers, content = app.request('POST', '/simple-batch', wsgi_input=json.dumps({
+                'package_names': ['package1', 'Package2']
+            }).encode('utf-8'))
+            self.assertEqual(status, '200 OK')
+            content_json = json.loads(content.decode('utf-8'))
+            self.assertEqual(content_json['unavailable'], ['Package2'])
+            self.assertEqual(sorted(content_json['projects']), ['Package2', 'package1'])
+            self.assertEqual(content_json['projects']['package1']['files'][0]['filename'], 'package1-1.0.0.tar.gz')
+            self.assertIsNone(content_json['projects']['Package2'])
+            status, headers, content = app.request('POST', '/simple-batch', wsgi_input=json.dumps({
+                'package_names': ['package2', 'package3']
+            }).encode('utf-8'))
+            self.assertEqual(status, '503 Service Unavailable')
+            self.assertTrue(('Retry-After', '6') in headers)
+        finally:
+            configure_upstream_admission(admission_previous)
+            admission.release()
+
+    def test_upstream_download_admission(self):
+
+        ctx = Context(Application(), {}, None, {})
+        content = b'package4-1.0.0' * 10000
+        index_memory, temp_dir = self._test_upstream_index(content, hashlib.md5(content).hexdigest())
+        admission = UpstreamAdmission(max_concurrent=1, max_queue=0)
+        admission_previous = configure_upstream_admission(admission)
+        try:
+            upstream_entry, = index_memory.get_package_index(ctx, 'package4')
+
+            # The admission slot is released once upstream is read, before the content is consumed
+            chunks = upstream_package_chunks(upstream_entry.url)
+            while admission._active: # pylint: disable=protected-access
+                time.sleep(0.01)
+            chunks_other = upstream_package_chunks(upstream_entry.url)
+            self.assertEqual(b''.join(chunks), content)
+            self.assertEqual(b''.join(chunks_other), content)
+
+            # Overloaded downloads are shed before the response starts
+            index = SQLiteIndex(os.path.join(temp_dir, 'index.db'), index_url=None)
+            index._insert_entries([upstream_entry]) # pylint: disable=protected-access
+            app = MrPyPi(index)
+            admission.acquire()
+            try:
+                status, headers, content_download = app.request('GET', '/download/package4/1.0.0/package4-1.0.0.tar.gz')
+            finally:
+                admission.release()
+            self.assertEqual(status, '503 Service Unavailable')
+            self.assertTrue(('Retry-After', '6') in headers)
+            self.assertEqual(content_download, b'Service Unavailable')
+            status, dummy_headers, content_download = app.request('GET', '/download/package4/1.0.0/package4-1.0.0.tar.gz')
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(content_download, content)
+        finally:
+            configure_upstream_admission(admission_previous)
+            shutil.rmtree(temp_dir)
+
+    def test_mongo_evicted_files(self):
+
+        # Files are evicted in the given (policy) order until under quota, skipping uploaded files
+        mongo_files = [
+            {'_id': 1, 'length': 100, 'upstream': True},
+            {'_id': 2, 'length': 500, 'upstream': False},
+            {'_id': 3, 'length': 200},
+            {'_id': 4, 'length': 300, 'upstream': True},
+            {'_id': 5, 'length': 400, 'upstream': True}
+        ]
+        evicted_files = MongoIndex._evicted_files # pylint: disable=protected-access
+        self.assertEqual([x['_id'] for x in evicted_files(mongo_files, 1500, 1000)], [1, 4, 5])
+        self.assertEqual([x['_id'] for x in evicted_files(mongo_files, 1350, 1000)], [1, 4])
+        self.assertEqual([x['_id'] for x in evicted_files(mongo_files, 1000, 1000)], [])
+        self.assertEqual([x['_id'] for x in evicted_files(mongo_files, 9000, 1000)], [1, 4, 5])
+
+    def test_mongo_gc_files(self):
+
+        gc_cutoff = datetime(2020, 1, 1)
+        old, new = datetime(2019, 1, 1), datetime(2021, 1, 1)
+        mongo_files = [
+            {'_id': 1, 'filename': 'a/1.0/a-1.0.tar.gz', 'uploadDate': old},
+            {'_id': 2, 'filename': 'b/1.0/b-1.0.tar.gz', 'uploadDate': old},
+            {'_id': 3, 'filename': 'b/1.0/b-1.0.tar.gz', 'uploadDate': old},
+            {'_id': 4, 'filename': 'b/1.0/b-1.0.tar.gz', 'uploadDate': old},
+            {'_id': 5, 'filename': 'c/1.0/c-1.0.tar.gz', 'uploadDate': old},
+            {'_id': 6, 'filename': 'c/1.0/c-1.0.tar.gz', 'uploadDate': new},
+            {'_id': 7, 'filename': 'd/1.0/d-1.0.tar.gz', 'uploadDate': new},
+            {'_id': 8, 'filename': 'e/1.0/e-1.0.tar.gz', 'uploadDate': old}
+        ]
+        index_filenames = {'a/1.0/a-1.0.tar.gz': True, 'b/1.0/b-1.0.tar.gz': False, 'c/1.0/c-1.0.tar.gz': True}
+
+        # Orphans and all but the newest file of each filename are collected, unless within the grace period
+        gc_files = MongoIndex._gc_files # pylint: disable=protected-access
+        self.assertEqual([(x['_id'], keep) for x, keep in gc_files(mongo_files, index_filenames, gc_cutoff)], [
+            (1, True),
+            (2, False),
+            (3, False),
+            (4, True),
+            (5, False),
+            (6, True),
+            (7, True),
+            (8, False)
+        ])
+        self.assertEqual(list(gc_files([], index_filenames, gc_cutoff)), [])
+
+    def test_mongo_gc_entries(self):
+
+        # Entries added within the grace period are kept - their file may not be written yet
+        gc_cutoff = datetime(2016, 1, 1)
+        package_entries = [
+            {'name': 'a', 'version': '1.0', 'filename': 'a-1.0.tar.gz', 'url': None, 'datetime': datetime(2015, 1, 1)},
+            {'name': 'b', 'version': '1.0', 'filename': 'b-1.0.tar.gz', 'url': None, 'datetime': datetime(2015, 1, 1)},
+            {'name': 'c', 'version': '1.0', 'filename': 'c-1.0.tar.gz', 'url': 'https://example.com/c-1.0.tar.gz', 'datetime': None},
+            {'name': 'd', 'version': '1.0', 'filename': 'd-1.0.tar.gz', 'url': None, 'datetime': datetime(2016, 1, 2)},
+            {'name': 'e', 'version': '1.0', 'filename': 'e-1.0.tar.gz', 'url': None, 'datetime': None}
+        ]
+        gridfs_filenames = set(['a/1.0/a-1.0.tar.gz'])
+        self.assertEqual([x['name'] for x in MongoIndex._gc_entries( # pylint: disable=protected-access
+            package_entries, gridfs_filenames, MongoIndex._local_filename, gc_cutoff)], ['b', 'e']) # pylint: disable=protected-access
+
+    def test_mongo_record_access(self):
+
+        class MockBulk(object):
+            def __init__(self, updates):
+                self.updates = updates
+                self.selector = None
+
+            def find(self, selector):
+                self.selector = selector
+                return self
+
+            def update(self, update):
+                self.updates.append((self.selector, update))
+
+            def execute(self):
+                pass
+
+        class MockFiles(object):
+            def __init__(self):
+                self.updates = []
+
+            def initialize_unordered_bulk_op(self):
+                return MockBulk(self.updates)
+
+        mongo_files = MockFiles()
+        mongo_client = {'mrpypi': {'fs.files': mongo_files}}
+
+        # Accesses are batched until the flush interval passes
+        index = MongoIndex(access_flush_interval=3600)
+        index._record_access(mongo_client, 'a/1.0/a-1.0.tar.gz') # pylint: disable=protected-access
+        index._record_access(mongo_client, 'b/1.0/b-1.0.tar.gz') # pylint: disable=protected-access
+        index._record_access(mongo_client, 'a/1.0/a-1.0.tar.gz') # pylint: disable=protected-access
+        self.assertEqual(mongo_files.updates, [])
+
+        # The batch is flushed as one bulk update - the latest access time of each file wins
+        index._access_flushed -= 3600 # pylint: disable=protected-access
+        index._record_access(mongo_client, 'c/1.0/c-1.0.tar.gz') # pylint: disable=protected-access
+        self.assertEqual(sorted(selector['filename'] for selector, dummy_update in mongo_files.updates),
+                         ['a/1.0/a-1.0.tar.gz', 'b/1.0/b-1.0.tar.gz', 'c/1.0/c-1.0.tar.gz'])
+        for dummy_selector, update in mongo_files.updates:
+            self.assertEqual(list(update), ['$max'])
+            self.assertTrue(isinstance(update['$max']['accessed'], datetime))
+
+        # The next batch waits for the next interval
+        index._record_access(mongo_client, 'a/1.0/a-1.0.tar.gz') # pylint: disable=protected-access
+        self.assertEqual(len(mongo_files.updates), 3)
+        index._mongo_flush_access_times(mongo_client) # pylint: disable=protected-access
+        self.assertEqual(len(mongo_files.updates), 4)
+        index._mongo_flush_access_times(mongo_client) # pylint: disable=protected-access
+        self.assertEqual(len(mongo_files.updates), 4)
+
+    def test_memory_index_concurrency(self):
+
+        package_content = b'package5-1.0.0' * 1000
+        file_server, file_url, file_requests = self._test_upstream_server([], package_content, delay=0.2)
+        index_html = '<html><body><a href="{0}/package5-1.0.0.tar.gz">package5-1.0.0.tar.gz</a></body></html>'.format(file_url)
+        index_server, index_url, index_requests = self._test_upstream_server([], index_html.encode('utf-8'), content_type='text/html',
+                                                                             delay=0.1)
+        try:
+            ctx = Context(Application(), {}, None, {})
+            index = MemoryIndex(index_url=index_url + '/simple')
+            index.add_package(ctx, 'package1', '1.0.0', 'package1-1.0.0.tar.gz', b'package1-1.0.0')
+            errors = []
+
+            def reader():
+                for _ in range(200):
+                    package_index = list(index.get_package_index(ctx, 'package1'))
+                    if not package_index or 'package1' not in index.get_package_names(ctx):
+                        errors.append('missing package1')
+
+            def uploader(thread_index):
+                for upload_index in range(50):
+                    version = '2.{0}.{1}'.format(thread_index, upload_index)
+                    if not index.add_package(ctx, 'package1', version, 'package1-{0}.tar.gz'.format(version), version.encode('utf-8')):
+                        errors.append('upload failed')
+                    if index.add_package(ctx, 'package1', version, 'package1-{0}.tar.gz'.format(version), b''):
+                        errors.append('re-upload succeeded')
+
+            def downloader():
+                package_stream = index.get_package_stream(ctx, 'package5', '1.0.0', 'package5-1.0.0.tar.gz')
+                if package_stream is None or b''.join(package_stream()) != package_content:
+                    errors.append('bad download')
+
+            def refresher():
+                if not list(index.get_package_index(ctx, 'package5', force_update=True)):
+                    errors.append('bad refresh')
+
+            threads = [threading.Thread(target=reader) for _ in range(4)] + \
+                      [threading.Thread(target=uploader, args=(thread_index,)) for thread_index in range(4)] + \
+                      [threading.Thread(target=downloader) for _ in range(8)] + \
+                      [threading.Thread(target=refresher) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+
+            # Every upload is present, and concurrent misses of the same file were downloaded once
+            self.assertEqual(len(list(index.get_package_index(ctx, 'package1'))), 201)
+            self.assertEqual(len(file_requests), 1)
+            self.assertTrue(len(index_requests) < 12)
+            self.assertEqual(list(index.get_package_names(ctx)), ['package1', 'package5'])
+            self.assertEqual(index.get_index_generation(ctx), 2)
+        finally:
+            for server in (file_server, index_server):
+                server.shutdown()
+                server.server_close()
+
+    def test_memory_index_concurrent_packages(self):
+
+        # Downloads of different packages don't wait on each other
+        file_server, file_url, file_requests = self._test_upstream_server([], b'content', delay=0.3)
+        try:
+            ctx = Context(Application(), {}, None, {})
+            index = MemoryIndex(index_url=None)
+            for package_index in range(4):
+                package_name = 'package{0}'.format(package_index)
+                index._index[package_name] = { # pylint: disable=protected-access
+                    package_name + '-1.0.0.tar.gz': IndexEntry(name=package_name, version='1.0.0', filename=package_name + '-1.0.0.tar.gz',
+                                                               hash=None, hash_name=None, url=file_url + '/' + package_name,
+                                                               datetime=None, sha256=None, md5=None, size=None)
+                }
+            threads = [threading.Thread(target=index.get_package_stream,
+                                        args=(ctx, package_name, '1.0.0', package_name + '-1.0.0.tar.gz'))
+                       for package_name in ('package0', 'package1', 'package2', 'package3')]
+            start_time = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertTrue(time.time() - start_time < 1.0)
+            self.assertEqual(len(file_requests), 4)
+        finally:
+            file_server.shutdown()
+            file_server.server_close()
+
+    def test_profiler(self):
+
+        profile_dir = tempfile.mkdtemp()
+        try:
+            # Profile every request
+            app = MrPyPi(self._test_index(), profiler=RequestProfiler(profile_dir, sample_rate=1.0))
+            status, dummy_headers, dummy_content = app.request('GET', '/simple/package1/')
+            self.assertEqual(status, '200 OK')
+            status, dummy_headers, content = app.request('GET', '/download/package1/1.0.0/package1-1.0.0.tar.gz')
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(content, b'package1-1.0.0')
+            profile_names = sorted(os.listdir(profile_dir), key=lambda profile_name: int(profile_name.split('-')[2]))
+            self.assertEqual([profile_name.split('-', 3)[3] for profile_name in profile_names], [
+                'pypi_index-package1-MemoryIndex.prof',
+                'pypi_download-package1-MemoryIndex.prof'
+            ])
+            stats = pstats.Stats(os.path.join(profile_dir, profile_names[0]))
+            self.assertTrue(any(function_name == 'pypi_index' for dummy_filename, dummy_line, function_name in stats.stats))
+
+            # Profile requests with the admin header token
+            shutil.rmtree(profile_dir)
+            app = MrPyPi(self._test_index(), profiler=RequestProfiler(profile_dir, token='secret'))
+            app.request('GET', '/simple/')
+            app.request('GET', '/simple/', environ={'HTTP_X_MRPYPI_PROFILE': 'wrong'})
+            self.assertFalse(os.path.exists(profile_dir))
+            app.request('GET', '/simple/', environ={'HTTP_X_MRPYPI_PROFILE': 'secret'})
+            self.assertEqual([profile_name.split('-', 3)[3] for profile_name in os.listdir(profile_dir)],
+                             ['pypi_root_index--MemoryIndex.prof'])
+        finally:
+            shutil.rmtree(profile_dir, ignore_errors=True)
+
+    def test_profiler_from_environ(self):
+
+        self.assertEqual(RequestProfiler.from_environ({}), None)
+        profiler = RequestProfiler.from_environ({'MRPYPI_PROFILE_DIR': '/tmp/profiles', 'MRPYPI_PROFILE_RATE': '0.25'})
+        self.assertEqual((profiler.profile_dir, profiler.sample_rate, profiler.token), ('/tmp/profiles', 0.25, None))
+
+    def test_package_digest(self):
+
+        digest = PackageDigest()
+        digest.update(b'package1-')
+        digest.update(b'1.0.0')
+        self.assertEqual(digest.size, 14)
+        self.assertEqual(digest.hexdigest('sha256'), '027c27fc8cb60a5f44e5914e26899d1ddab529e52fc57e8e930041d7998e2fac')
+        self.assertEqual(digest.hexdigest('md5'), '5f832e6e6b2107ba3b0463fc171623d7')
+
     def test_download_package_not_found(self):
 
         app = MrPyPi(self._test_index())
@@ -174,7 +1712,7 @@ package3
   </head>
   <body>
     <h1>Links for package3</h1>
-    <a href="../../download/package3/1.0.0/package3-1.0.0.tar.gz#md5=df9f61bece81c091f7044368fcf62501" rel="internal">package3-1.0.0.tar.gz</a><br>
+    <a href="../../download/package3/1.0.0/package3-1.0.0.tar.gz#sha256=8c25a76282a097afecbf6f95d31b84cba3e5c4a2ca4fefcc3ccdf9ea073746cd" rel="internal">package3-1.0.0.tar.gz</a><br>
   </body>
 </html>'''
         self.assertEqual(content, expected_content)
@@ -225,6 +1763,152 @@ package1
         self.assertTrue(('Content-Type', 'text/plain') in headers)
         self.assertEqual(content, b'')
 
+    def test_upload_wheel(self):
+
+        upload_environ = {
+            'CONTENT_TYPE': 'multipart/form-data; boundary=--------------GHSKFJDLGDS7543FJKLFHRE75642756743254',
+        }
+        upload_content = b'''
+----------------GHSKFJDLGDS7543FJKLFHRE75642756743254
+Content-Disposition: form-data; name="filetype"
+
+bdist_wheel
+----------------GHSKFJDLGDS7543FJKLFHRE75642756743254
+Content-Disposition: form-data; name="content";filename="package1-1.0.0-py2.py3-none-any.whl"
+
+package1 wheel
+----------------GHSKFJDLGDS7543FJKLFHRE75642756743254
+Content-Disposition: form-data; name="version"
+
+1.0.0
+----------------GHSKFJDLGDS7543FJKLFHRE75642756743254
+Content-Disposition: form-data; name=":action"
+
+file_upload
+----------------GHSKFJDLGDS7543FJKLFHRE75642756743254
+Content-Disposition: form-data; name="name"
+
+package1
+----------------GHSKFJDLGDS7543FJKLFHRE75642756743254--
+
+'''
+
+        app = MrPyPi(self._test_index())
+        status, headers, content = app.request('POST', '/simple', environ=dict(upload_environ), wsgi_input=upload_content)
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(('Content-Type', 'text/plain') in headers)
+        self.assertEqual(content, b'')
+
+        status, headers, content = app.request('POST', '/simple', environ=upload_environ, wsgi_input=upload_content)
+        self.assertEqual(status, '400 File Exists')
+        self.assertTrue(('Content-Type', 'text/plain') in headers)
+        self.assertEqual(content, b'')
+
+        status, headers, content = app.request('GET', '/simple/package1')
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(('Content-Type', 'text/html') in headers)
+        expected_content = b'''\
+<!doctype html>
+<html lang="en">
+  <head>
+    <title>Links for package1</title>
+    <meta name="api-version" value="2">
+  </head>
+  <body>
+    <h1>Links for package1</h1>
+    <a href="../../download/package1/1.0.0/package1-1.0.0-py2.py3-none-any.whl#sha256=0e693c35d8a7fe6abacae859abc9132b9c9f1254af2fe2e7815e3e17bbb515f5" rel="internal">package1-1.0.0-py2.py3-none-any.whl</a><br>
+    <a href="../../download/package1/1.0.0/package1-1.0.0.tar.gz#sha256=027c27fc8cb60a5f44e5914e26899d1ddab529e52fc57e8e930041d7998e2fac" rel="internal">package1-1.0.0.tar.gz</a><br>
+    <a href="../../download/package1/1.0.1/package1-1.0.1.tar.gz#sha256=ccfa0969bd944ef581ccd5b66d27f3f90d7365146c9494172a426c0aa3da712b" rel="internal">package1-1.0.1.tar.gz</a><br>
+  </body>
+</html>'''
+        self.assertEqual(content, expected_content)
+
+        status, headers, content = app.request('GET', '/download/package1/1.0.0/package1-1.0.0-py2.py3-none-any.whl')
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(('Content-Type', 'application/octet-stream') in headers)
+        self.assertEqual(content, b'package1 wheel')
+
+        status, headers, content = app.request('GET', '/download/package1/1.0.0/package1-1.0.0.tar.gz')
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(('Content-Type', 'application/octet-stream') in headers)
+        self.assertEqual(content, b'package1-1.0.0')
+
+    def test_upload_wheel_bad_filename(self):
+
+        upload_environ = {
+            'CONTENT_TYPE': 'multipart/form-data; boundary=--------------GHSKFJDLGDS7543FJKLFHRE75642756743254',
+        }
+        upload_content = '''
+----------------GHSKFJDLGDS7543FJKLFHRE75642756743254
+Content-Disposition: form-data; name="filetype"
+
+{0}
+----------------GHSKFJDLGDS7543FJKLFHRE75642756743254
+Content-Disposition: form-data; name="content";filename="{1}"
+
+package3 content
+----------------GHSKFJDLGDS7543FJKLFHRE75642756743254
+Content-Disposition: form-data; name="version"
+
+1.0.0
+----------------GHSKFJDLGDS7543FJKLFHRE75642756743254
+Content-Disposition: form-data; name=":action"
+
+file_upload
+----------------GHSKFJDLGDS7543FJKLFHRE75642756743254
+Content-Disposition: form-data; name="name"
+
+package3
+----------------GHSKFJDLGDS7543FJKLFHRE75642756743254--
+
+'''
+
+        app = MrPyPi(self._test_index())
+        for filetype, filename in (('bdist_wheel', 'package3-1.0.0.tar.gz'),
+                                   ('bdist_wheel', 'evil-9.9-py3-none-any.whl'),
+                                   ('bdist_wheel', 'package3-1.0.1-py3-none-any.whl'),
+                                   ('bdist_wheel', 'package3.whl'),
+                                   ('sdist', 'whatever.zip'),
+                                   ('sdist', 'package3-1.0.1.tar.gz'),
+                                   ('sdist', 'evil-package3-1.0.0.tar.gz')):
+            status, headers, content = app.request('POST', '/simple', environ=upload_environ,
+                                                   wsgi_input=upload_content.format(filetype, filename).encode('utf-8'))
+            self.assertEqual(status, '400 Bad Request', filename)
+            self.assertTrue(('Content-Type', 'text/plain') in headers)
+            self.assertEqual(content, b'')
+        self.assertEqual(list(app.index.get_package_names(None)), ['package1', 'package2'])
+
+    def test_package_filename_matches(self):
+
+        self.assertTrue(package_filename_matches('zope.interface-5.0.0.tar.gz', 'zope.interface', '5.0.0'))
+        self.assertTrue(package_filename_matches('zope.interface-5.0.0-cp39-cp39-manylinux1_x86_64.whl', 'Zope.Interface', '5.0.0'))
+        self.assertTrue(package_filename_matches('foo_bar-1.0-py2.py3-none-any.whl', 'foo-bar', '1.0'))
+        self.assertTrue(package_filename_matches('Foo-Bar-1.0.zip', 'foo_bar', '1.0'))
+        self.assertFalse(package_filename_matches('foo_bar-1.0-py2.py3-none-any.whl', 'foo', '1.0'))
+        self.assertFalse(package_filename_matches('foo-bar-1.0.zip', 'foo', '1.0'))
+        self.assertFalse(package_filename_matches('foo-1.0.exe', 'foo', '1.0'))
+
+    def test_pip_package_versions_dotted_name(self):
+
+        index_html = b'''\
+<html><body>
+<a href="zope.interface-5.0.0.tar.gz">zope.interface-5.0.0.tar.gz</a>
+<a href="zope.interface-5.0.0-cp39-cp39-manylinux1_x86_64.whl">zope.interface-5.0.0-cp39-cp39-manylinux1_x86_64.whl</a>
+<a href="zope.interface-5.0.0-cp39-cp39-win_amd64.whl">zope.interface-5.0.0-cp39-cp39-win_amd64.whl</a>
+<a href="zope_interface_extra-5.0.0-py3-none-any.whl">zope_interface_extra-5.0.0-py3-none-any.whl</a>
+</body></html>'''
+        server, url, dummy_requests = self._test_upstream_server([], index_html, content_type='text/html')
+        try:
+            pip_packages = pip_package_versions(url + '/simple', 'zope.interface', session=UpstreamSession())
+            self.assertEqual([(pip_package.version, pip_package.link.filename) for pip_package in pip_packages], [
+                ('5.0.0', 'zope.interface-5.0.0.tar.gz'),
+                ('5.0.0', 'zope.interface-5.0.0-cp39-cp39-manylinux1_x86_64.whl'),
+                ('5.0.0', 'zope.interface-5.0.0-cp39-cp39-win_amd64.whl')
+            ])
+        finally:
+            server.shutdown()
+            server.server_close()
+
     def test_upload_bad_content_type(self):
 
         upload_environ = {
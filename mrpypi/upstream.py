@@ -0,0 +1,272 @@
+#
+# Copyright (C) 2014-2015 Craig Hobbs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import random
+import threading
+import time
+
+from .compat import urllib_parse_urlsplit
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Raised without contacting upstream while a host's circuit breaker is open
+    """
+
+    __slots__ = ('host', 'retry_after')
+
+    def __init__(self, host, retry_after):
+        Exception.__init__(self, 'Upstream host "{0}" is unavailable (retry after {1:.0f} seconds)'.format(host, retry_after))
+        self.host = host
+        self.retry_after = retry_after
+
+
+class UpstreamOverloaded(UpstreamUnavailable):
+    """
+    Raised when upstream-bound work isn't admitted - too many requests are waiting, or the wait deadline passed
+    """
+
+    __slots__ = ()
+
+    def __init__(self, retry_after): # pylint: disable=super-init-not-called
+        Exception.__init__(self, 'Upstream requests are overloaded (retry after {0:.0f} seconds)'.format(retry_after))
+        self.host = None
+        self.retry_after = retry_after
+
+
+class UpstreamAdmission(object):
+    """
+    Admission control for upstream-bound work (index refreshes and package file downloads). At most max_concurrent
+    upstream operations run at once and at most max_queue wait for a slot, each until the deadline. Overflow raises
+    UpstreamOverloaded, so overloaded requests are shed (or served stale data) rather than tying up every worker, and
+    requests answered from local data keep their latency.
+    """
+
+    __slots__ = ('max_concurrent', 'max_queue', 'deadline', '_condition', '_active', '_waiting')
+
+    def __init__(self, max_concurrent=32, max_queue=64, deadline=5.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+
+    def check(self):
+        """
+        Raise UpstreamOverloaded, without waiting, if work would not be admitted now
+        """
+
+        with self._condition:
+            if self._active >= self.max_concurrent and self._waiting >= self.max_queue:
+                raise UpstreamOverloaded(self.deadline)
+
+    def acquire(self):
+        deadline = time.time() + self.deadline
+        with self._condition:
+            if self._active < self.max_concurrent:
+                self._active += 1
+                return
+            if self._waiting >= self.max_queue:
+                raise UpstreamOverloaded(self.deadline)
+
+            # Wait for a slot until the deadline
+            self._waiting += 1
+            try:
+                while self._active >= self.max_concurrent:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise UpstreamOverloaded(self.deadline)
+                    self._condition.wait(remaining)
+                self._active += 1
+            finally:
+                self._waiting -= 1
+
+    def try_acquire(self):
+        """
+        Acquire a slot without waiting - return True if acquired. Slots aren't taken ahead of waiting work.
+        """
+
+        with self._condition:
+            if self._active < self.max_concurrent and not self._waiting:
+                self._active += 1
+                return True
+            return False
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class _CircuitBreaker(object):
+    __slots__ = ('failures', 'opened')
+
+    def __init__(self):
+        self.failures = 0
+        self.opened = None
+
+
+class UpstreamSession(object):
+    """
+    Upstream HTTP session shared by the pip index finder and package downloads. Connections are pooled and kept alive
+    per host, idempotent requests are retried with jittered exponential backoff, and a per-host circuit breaker fails
+    requests fast once a host has failed repeatedly. Requests are made with a pip session, which is imported on first
+    use.
+    """
+
+    __slots__ = ('session', 'timeout', 'retries', 'backoff', 'backoff_max', 'failure_threshold', 'reset_timeout',
+                 '_breakers', '_breakers_lock')
+
+    # Status codes of transient upstream failures
+    RETRY_STATUS_CODES = (500, 502, 503, 504)
+    RETRY_METHODS = ('GET', 'HEAD')
+
+    def __init__(self, connect_timeout=5.0, read_timeout=30.0, retries=3, backoff=0.25, backoff_max=4.0,
+                 failure_threshold=5, reset_timeout=30.0, pool_size=16):
+        from pip._vendor.requests.adapters import HTTPAdapter
+        from pip.download import PipSession
+
+        self.session = PipSession()
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+        # Larger keep-alive connection pools for a threaded server - retries are handled by request()
+        self.session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0))
+        self.session.mount('http://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0))
+
+    def _backoff_delay(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+
+    def _check_breaker(self, host, trial=True):
+        with self._breakers_lock:
+            breaker = self._breakers.get(host)
+            if breaker is None or breaker.opened is None:
+                return
+
+            # Open circuit - fail fast until the reset timeout passes, then let a single trial request through
+            retry_after = breaker.opened + self.reset_timeout - time.time()
+            if retry_after > 0:
+                raise UpstreamUnavailable(host, retry_after)
+            if trial:
+                breaker.opened = time.time()
+
+    def _record_result(self, host, success):
+        with self._breakers_lock:
+            breaker = self._breakers.setdefault(host, _CircuitBreaker())
+            if success:
+                breaker.failures = 0
+                breaker.opened = None
+            else:
+                breaker.failures += 1
+                if breaker.failures >= self.failure_threshold:
+                    breaker.opened = time.time()
+
+    def check_available(self, url):
+        """
+        Raise UpstreamUnavailable if the URL host's circuit breaker is open
+        """
+
+        self._check_breaker(urllib_parse_urlsplit(url).netloc, trial=False)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        from pip._vendor import requests
+
+        host = urllib_parse_urlsplit(url).netloc
+        retries = self.retries if method.upper() in self.RETRY_METHODS else 0
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            self._check_breaker(host)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record_result(host, False)
+                if attempt >= retries:
+                    raise
+            else:
+                success = response.status_code not in self.RETRY_STATUS_CODES
+                self._record_result(host, success)
+                if success or attempt >= retries:
+                    return response
+                response.close()
+            time.sleep(self._backoff_delay(attempt))
+            attempt += 1
+
+
+_UPSTREAM_SESSION = None
+_UPSTREAM_SESSION_LOCK = threading.Lock()
+
+
+def upstream_session():
+    """
+    Return the process-wide shared upstream session
+    """
+
+    global _UPSTREAM_SESSION # pylint: disable=global-statement
+    if _UPSTREAM_SESSION is None:
+        with _UPSTREAM_SESSION_LOCK:
+            if _UPSTREAM_SESSION is None:
+                _UPSTREAM_SESSION = UpstreamSession()
+    return _UPSTREAM_SESSION
+
+
+_UPSTREAM_ADMISSION = UpstreamAdmission()
+
+
+def upstream_admission():
+    """
+    Return the process-wide upstream admission control
+    """
+
+    return _UPSTREAM_ADMISSION
+
+
+def configure_upstream_admission(admission):
+    """
+    Replace the process-wide upstream admission control - returns the previous admission control
+    """
+
+    global _UPSTREAM_ADMISSION # pylint: disable=global-statement
+    admission_previous, _UPSTREAM_ADMISSION = _UPSTREAM_ADMISSION, admission
+    return admission_previous